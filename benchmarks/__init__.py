@@ -0,0 +1,7 @@
+""" asv benchmarks of the conversion hot paths, results are kept per
+commit in .asv/results:
+
+    asv run                      # benchmark the current commit
+    asv continuous master HEAD   # flag regressions against master
+    asv compare <sha1> <sha2>
+"""
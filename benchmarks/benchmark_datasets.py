@@ -0,0 +1,31 @@
+""" opening history files """
+from history2CMIParchive.datasets import open_dataset
+from history2CMIParchive.datasets import define_component_code
+from .common import define_grid_dataset
+from .common import resolutions
+import tempfile
+import shutil
+
+
+class OpenHistoryFile:
+    """ the first steps of export_nc_out_to_zarr_stores """
+    params = [resolutions]
+    param_names = ['resolution']
+    timeout = 600
+
+    chunks = {'time': 1, 'z_l': 1}
+
+    def setup(self, resolution):
+        self.tmpdir = tempfile.mkdtemp()
+        self.ncfile = f'{self.tmpdir}/19000101.ocean_month.nc'
+        define_grid_dataset(resolution).to_netcdf(self.ncfile)
+
+    def teardown(self, resolution):
+        shutil.rmtree(self.tmpdir)
+
+    def time_open_dataset(self, resolution):
+        ds = open_dataset(self.ncfile, self.chunks)
+        ds.close()
+
+    def time_define_component_code(self, resolution):
+        define_component_code(self.ncfile)
@@ -0,0 +1,94 @@
+""" reading netcdf members out of a history tar file """
+from history2CMIParchive.tar_utilities import get_tar_index
+from history2CMIParchive.tar_utilities import extract_ncfile_from_archive
+from history2CMIParchive.tar_utilities import open_ncfile_from_archive
+from history2CMIParchive.tar_utilities import list_files_archive
+from history2CMIParchive.datasets import open_dataset
+from .common import define_test_dataset
+from .common import create_history_archive
+from .common import define_grid_dataset
+from .common import resolutions
+import tempfile
+import shutil
+import os
+
+
+class TarMemberAccess:
+    """ load every variable of a member, either extracted to a work
+    directory first or read in place from the tar """
+    params = [['NETCDF4', 'NETCDF3_64BIT']]
+    param_names = ['format']
+    timeout = 600
+
+    ncfile = '19000101.ocean_month.nc'
+    chunks = {'time': 1, 'z_l': 1}
+
+    def setup(self, fmt):
+        self.tmpdir = tempfile.mkdtemp()
+        self.archive = f'{self.tmpdir}/19000101.nc.tar'
+        ds = define_test_dataset(resolution=0.5, nz=15, nt=12)
+        create_history_archive(self.archive, {self.ncfile: ds}, fmt=fmt)
+        self.index = get_tar_index(self.archive)
+        self.workdir = f'{self.tmpdir}/work'
+
+    def teardown(self, fmt):
+        shutil.rmtree(self.tmpdir)
+
+    def time_extract_then_open(self, fmt):
+        extract_ncfile_from_archive(self.archive, self.ncfile, self.workdir,
+                                    index=self.index)
+        ds = open_dataset(f'{self.workdir}/{self.ncfile}', self.chunks)
+        ds.load()
+        ds.close()
+        os.remove(f'{self.workdir}/{self.ncfile}')
+
+    def time_open_in_place(self, fmt):
+        fileobj = open_ncfile_from_archive(self.archive, self.ncfile,
+                                           self.index)
+        ds = open_dataset(fileobj, self.chunks)
+        ds.load()
+        ds.close()
+        fileobj.close()
+
+    def peakmem_extract_then_open(self, fmt):
+        self.time_extract_then_open(fmt)
+
+    def peakmem_open_in_place(self, fmt):
+        self.time_open_in_place(fmt)
+
+
+class ArchiveMembers:
+    """ listing and extracting the members of a year of history """
+    params = [resolutions]
+    param_names = ['resolution']
+    timeout = 600
+
+    members = ['ocean_month', 'ocean_month_z', 'ocean_annual',
+               'ocean_static']
+
+    def setup(self, resolution):
+        self.tmpdir = tempfile.mkdtemp()
+        self.archive = f'{self.tmpdir}/19000101.nc.tar'
+        ds = define_grid_dataset(resolution)
+        create_history_archive(self.archive,
+                               {f'19000101.{member}.nc': ds
+                                for member in self.members})
+        self.index = get_tar_index(self.archive)
+        self.ncfile = '19000101.ocean_month.nc'
+        self.workdir = f'{self.tmpdir}/work'
+
+    def teardown(self, resolution):
+        shutil.rmtree(self.tmpdir)
+
+    def time_list_files_archive(self, resolution):
+        list_files_archive(self.archive)
+
+    def time_list_files_archive_index(self, resolution):
+        list_files_archive(self.archive, index=self.index)
+
+    def time_extract_ncfile_from_archive(self, resolution):
+        extract_ncfile_from_archive(self.archive, self.ncfile, self.workdir)
+
+    def time_extract_ncfile_from_archive_index(self, resolution):
+        extract_ncfile_from_archive(self.archive, self.ncfile, self.workdir,
+                                    index=self.index)
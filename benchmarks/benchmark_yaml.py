@@ -0,0 +1,56 @@
+""" build history of stores with long file lists """
+from history2CMIParchive.yaml_utils import create_build_history
+from history2CMIParchive.yaml_utils import update_yaml
+from history2CMIParchive.build_catalog import record_builds
+import tempfile
+import shutil
+
+
+def build_history(files):
+    return create_build_history('/archive/history', '/pp', 'directory',
+                                True, 'time', {'time': 1}, 'gn', 'v1',
+                                'OM4p25', 'gfdl', 'thetao', files)
+
+
+def history_files(nfiles):
+    return [{f'{year:04d}0101.nc.tar': f'{year:04d}0101.ocean_month.nc'}
+            for year in range(nfiles)]
+
+
+class UpdateYaml:
+    """ adding a file to the history of a store built from nfiles """
+    params = [[10, 1000, 10000]]
+    param_names = ['nfiles']
+    timeout = 600
+
+    def setup(self, nfiles):
+        self.tmpdir = tempfile.mkdtemp()
+        self.files = history_files(nfiles + 1)
+        update_yaml(self.tmpdir, 'thetao', build_history(self.files[:-1]))
+
+    def teardown(self, nfiles):
+        shutil.rmtree(self.tmpdir)
+
+    def time_update_yaml(self, nfiles):
+        update_yaml(self.tmpdir, 'thetao', build_history(self.files[-1:]))
+
+
+class RecordBuild:
+    """ same, with the sqlite build history catalog """
+    params = [[10, 1000, 10000]]
+    param_names = ['nfiles']
+    timeout = 600
+
+    def setup(self, nfiles):
+        self.tmpdir = tempfile.mkdtemp()
+        self.catalog = f'{self.tmpdir}/build_history.sqlite'
+        self.files = history_files(nfiles + 1)
+        record_builds(self.catalog,
+                      [(self.tmpdir, build_history(self.files[:-1]))])
+
+    def teardown(self, nfiles):
+        shutil.rmtree(self.tmpdir)
+
+    def time_record_build(self, nfiles):
+        record_builds(self.catalog,
+                      [(self.tmpdir, build_history(self.files[-1:]))])
@@ -0,0 +1,67 @@
+""" creating and appending to variable stores """
+from history2CMIParchive.zarr_stores import write_to_zarr_store
+from history2CMIParchive.zarr_stores import appending_needed
+from history2CMIParchive.zarr_stores import time_manifest_path
+from .common import define_grid_dataset
+from .common import resolutions
+import tempfile
+import shutil
+import os
+
+
+class WriteStore:
+    """ write_to_zarr_store of one variable, creating the store or
+    appending a file worth of records to it """
+    params = [resolutions, ['directory', 'zip']]
+    param_names = ['resolution', 'storetype']
+    timeout = 600
+    number = 1
+
+    def setup(self, resolution, storetype):
+        self.tmpdir = tempfile.mkdtemp()
+        self.storepath = f'{self.tmpdir}/Omon/thetao/gn/v1'
+        ds = define_grid_dataset(resolution)
+        self.da = ds['thetao'].chunk({'time': 1, 'z_l': 1})
+        write_to_zarr_store(self.da, self.storepath, storetype=storetype)
+        self.nt = len(ds['time'])
+        self.t0 = self.nt
+
+    def teardown(self, resolution, storetype):
+        shutil.rmtree(self.tmpdir)
+
+    def time_create(self, resolution, storetype):
+        write_to_zarr_store(self.da, self.storepath, storetype=storetype,
+                            overwrite=True)
+
+    def time_append(self, resolution, storetype):
+        # every call appends the next records
+        da = self.da.assign_coords(time=self.da['time'] + self.t0)
+        self.t0 += self.nt
+        write_to_zarr_store(da, self.storepath, storetype=storetype)
+
+
+class AppendingNeeded:
+    """ decision to append, from the time manifest or from the store """
+    params = [['directory', 'zip'], [True, False]]
+    param_names = ['storetype', 'manifest']
+    timeout = 600
+    # the store rebuilds its manifest when it is missing, so each sample
+    # is a single call after a fresh setup
+    number = 1
+    repeat = 10
+
+    def setup(self, storetype, manifest):
+        self.tmpdir = tempfile.mkdtemp()
+        self.storepath = f'{self.tmpdir}/Omon/thetao/gn/v1'
+        ds = define_grid_dataset(1, nt=120)
+        write_to_zarr_store(ds['thetao'].chunk({'time': 1, 'z_l': 1}),
+                            self.storepath, storetype=storetype)
+        self.new = define_grid_dataset(1, t0=120)['thetao']
+        if not manifest:
+            os.remove(time_manifest_path(self.storepath, 'thetao'))
+
+    def teardown(self, storetype, manifest):
+        shutil.rmtree(self.tmpdir)
+
+    def time_appending_needed(self, storetype, manifest):
+        appending_needed(self.storepath, 'thetao', storetype, self.new)
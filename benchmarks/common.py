@@ -0,0 +1,47 @@
+""" synthetic history files shared by the benchmarks """
+import xarray as xr
+import numpy as np
+import tarfile
+
+# 1, 0.25 and 0.125 degree grids
+resolutions = [1, 0.25, 0.125]
+
+
+def define_test_dataset(resolution=1, nz=15, nt=12):
+    """ create OM4-like test dataset with variable size """
+    lon1 = np.arange(0, 360, resolution)
+    lat1 = np.arange(-90, 90, resolution)
+    z = np.arange(nz)
+    lon, lat = np.meshgrid(lon1, lat1)
+    temp = 20 * np.cos(np.pi * lat / 180) * np.ones((nt, nz,) + lon.shape)
+    salt = 34 * np.ones((nt, nz,) + lon.shape)
+    for k in np.arange(nz):
+        temp[:, k, :, :] = temp[:, k, :, :] * np.exp(-k/nz)
+        salt[:, k, :, :] = salt[:, k, :, :] + (k / nz)
+
+    ds = xr.Dataset({'thetao': (['time', 'z_l', 'yh', 'xh'], temp),
+                     'so': (['time', 'z_l', 'yh', 'xh'], salt)},
+                    coords={'xh': (['xh'], lon1),
+                            'yh': (['yh'], lat1),
+                            'z_l': (['z_l'], z),
+                            'time': (['time'], np.arange(nt))})
+    return ds
+
+
+def define_grid_dataset(resolution, nz=2, nt=2, t0=0):
+    """ few levels and records of OM4-like fields, so that the finest
+    grids stay in memory """
+    ds = define_test_dataset(resolution=resolution, nz=nz, nt=nt)
+    ds['time'] = ds['time'] + t0
+    return ds
+
+
+def create_history_archive(archive, ncfiles, fmt='NETCDF4'):
+    """ write each dataset of the dict ncfiles (member name: dataset)
+    and pack them into archive """
+    with tarfile.open(archive, 'w') as arch:
+        for name, ds in ncfiles.items():
+            ncpath = f'{archive}.{name}'
+            ds.to_netcdf(ncpath, format=fmt)
+            arch.add(ncpath, arcname=name)
+    return None
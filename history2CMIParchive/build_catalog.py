@@ -0,0 +1,245 @@
+from contextlib import contextmanager
+import sqlite3
+import fcntl
+import json
+import yaml
+import os
+
+# name of the catalog, at the root of the stores
+catalog_name = 'build_history.sqlite'
+
+# stores are indexed by path and variable, their files by source file.
+# files keep the order in which they were added (id).
+schema = """
+CREATE TABLE IF NOT EXISTS stores (
+    id INTEGER PRIMARY KEY,
+    storepath TEXT NOT NULL,
+    varname TEXT NOT NULL,
+    path TEXT NOT NULL,
+    options TEXT NOT NULL,
+    UNIQUE (storepath, varname)
+);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    store_id INTEGER NOT NULL REFERENCES stores (id),
+    tarfile TEXT NOT NULL,
+    ncfile TEXT NOT NULL,
+    UNIQUE (store_id, tarfile, ncfile)
+);
+CREATE INDEX IF NOT EXISTS files_by_source ON files (tarfile, ncfile);
+"""
+
+
+def catalog_path(outputdir):
+    """ path of the build history catalog of the stores under outputdir """
+    return f'{outputdir}/{catalog_name}'
+
+
+def connect_catalog(catalog):
+    """ open (and create if needed) the catalog. The catalog lives with
+    the stores, on a file system shared by conversions running on several
+    nodes: it keeps the default rollback journal (the shared memory of WAL
+    only works between processes of the same host), and its writes are
+    serialized by a lock file (see catalog_transaction), so the file
+    system must support fcntl locks. """
+    os.makedirs(os.path.dirname(os.path.abspath(catalog)), exist_ok=True)
+    conn = sqlite3.connect(catalog, timeout=600, isolation_level=None)
+    # catalogs created in WAL mode go back to the rollback journal
+    conn.execute('PRAGMA journal_mode=DELETE')
+    conn.executescript(schema)
+    return conn
+
+
+@contextmanager
+def catalog_transaction(catalog):
+    """ immediate transaction on the catalog, holding an exclusive lock
+    on {catalog}.lock so that writers (on any node) wait for each other.
+    Yields the connection, commits at the end of the block or rolls back
+    on error. """
+    os.makedirs(os.path.dirname(os.path.abspath(catalog)), exist_ok=True)
+    with open(f'{catalog}.lock', 'w') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            conn = connect_catalog(catalog)
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    yield conn
+                except BaseException:
+                    conn.execute('ROLLBACK')
+                    raise
+                conn.execute('COMMIT')
+            finally:
+                conn.close()
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def encode(value):
+    """ path and options are stored as (sorted) json """
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+def record_builds(catalog, builds, overwrite=False, failed=None):
+    """ add the files of several builds (e.g. all the variables of an
+    archive) to the catalog in a single transaction. Same rules as
+    yaml_utils.update_yaml: files already in the history of a store are
+    kept as they are, path and options of a store cannot change, and
+    overwrite starts the history of the store over. With a failed list,
+    a store that cannot be recorded is left out and added to it as
+    (storepath, build, error), the other stores are recorded; otherwise
+    the error rolls back the whole transaction.
+
+    PARAMETERS:
+    ===========
+
+    catalog: str
+        path of the catalog
+    builds: list
+        (storepath, build history) of each store, see
+        yaml_utils.create_build_history
+    overwrite: bool
+        replace the history of the stores
+    failed: list
+        stores that could not be recorded, see above
+
+    RETURNS:
+    ========
+
+    nfiles: int
+        number of files added
+    """
+    nfiles = 0
+    with catalog_transaction(catalog) as conn:
+        for storepath, build in builds:
+            conn.execute('SAVEPOINT store')
+            try:
+                store_id = store_row(conn, storepath, build, overwrite)
+                rows = [(store_id, tarfile, ncfile)
+                        for kv in build['files']
+                        for tarfile, ncfile in kv.items()]
+                cursor = conn.executemany(
+                    'INSERT OR IGNORE INTO files (store_id, tarfile, ncfile) '
+                    'VALUES (?, ?, ?)', rows)
+            except Exception as e:
+                if failed is None:
+                    raise
+                conn.execute('ROLLBACK TO store')
+                conn.execute('RELEASE store')
+                failed.append((storepath, build, e))
+                continue
+            conn.execute('RELEASE store')
+            nfiles += cursor.rowcount
+    return nfiles
+
+
+def store_row(conn, storepath, build, overwrite=False):
+    """ id of the store in the catalog, created if needed """
+    path, options = encode(build['path']), encode(build['options'])
+    row = conn.execute('SELECT id, path, options FROM stores '
+                       'WHERE storepath = ? AND varname = ?',
+                       (storepath, build['varname'])).fetchone()
+    if row is not None and overwrite:
+        conn.execute('DELETE FROM files WHERE store_id = ?', (row[0],))
+        conn.execute('UPDATE stores SET path = ?, options = ? WHERE id = ?',
+                     (path, options, row[0]))
+        return row[0]
+    if row is not None:
+        # this is not supposed to change
+        if row[1] != path or row[2] != options:
+            raise ValueError(f'build path/options of {storepath} '
+                             f'({build["varname"]}) changed')
+        return row[0]
+    cursor = conn.execute('INSERT INTO stores (storepath, varname, path, '
+                          'options) VALUES (?, ?, ?, ?)',
+                          (storepath, build['varname'], path, options))
+    return cursor.lastrowid
+
+
+def read_build_history(catalog, storepath, varname):
+    """ build history of a store, same content as its history yaml
+    (None if the store is not in the catalog) """
+    conn = connect_catalog(catalog)
+    try:
+        row = conn.execute('SELECT id, path, options FROM stores '
+                           'WHERE storepath = ? AND varname = ?',
+                           (storepath, varname)).fetchone()
+        if row is None:
+            return None
+        files = [{tarfile: ncfile} for tarfile, ncfile in conn.execute(
+            'SELECT tarfile, ncfile FROM files WHERE store_id = ? '
+            'ORDER BY id', (row[0],))]
+    finally:
+        conn.close()
+    return {'path': json.loads(row[1]), 'options': json.loads(row[2]),
+            'varname': varname, 'files': files}
+
+
+def list_stores(catalog):
+    """ (storepath, varname) of the stores in the catalog """
+    conn = connect_catalog(catalog)
+    try:
+        stores = conn.execute('SELECT storepath, varname FROM stores '
+                              'ORDER BY storepath, varname').fetchall()
+    finally:
+        conn.close()
+    return stores
+
+
+def stores_built_from(catalog, tarfile, ncfile=None):
+    """ (storepath, varname) of the stores containing the data of an
+    archive, or of one of its files, e.g. to rebuild them """
+    conn = connect_catalog(catalog)
+    query = 'SELECT DISTINCT s.storepath, s.varname FROM files f ' \
+        'JOIN stores s ON s.id = f.store_id WHERE f.tarfile = ?'
+    args = [tarfile]
+    if ncfile is not None:
+        query += ' AND f.ncfile = ?'
+        args.append(ncfile)
+    try:
+        stores = conn.execute(query + ' ORDER BY s.storepath, s.varname',
+                              args).fetchall()
+    finally:
+        conn.close()
+    return stores
+
+
+def export_yaml(catalog, stores=None):
+    """ write the history yaml of stores ({storepath}/{varname}.yml) from
+    the catalog, in the format of yaml_utils.update_yaml. Layouts already
+    recorded in the yaml (see yaml_utils.update_yaml_layout) are kept.
+
+    PARAMETERS:
+    ===========
+
+    catalog: str
+        path of the catalog
+    stores: list
+        (storepath, varname) of the stores to export, default all
+
+    RETURNS:
+    ========
+
+    ymlfiles: list
+        paths of the yaml files written
+    """
+    if stores is None:
+        stores = list_stores(catalog)
+    ymlfiles = []
+    for storepath, varname in stores:
+        store_history = read_build_history(catalog, storepath, varname)
+        if store_history is None:
+            continue
+        ymlhistory = f'{storepath}/{varname}.yml'
+        if os.path.exists(ymlhistory):
+            with open(ymlhistory) as f:
+                previous = yaml.load(f, Loader=yaml.FullLoader)
+                f.close()
+            if previous is not None and 'layouts' in previous:
+                store_history['layouts'] = previous['layouts']
+        os.makedirs(storepath, exist_ok=True)
+        with open(f'{ymlhistory}.tmp', 'w') as fnew:
+            yaml.dump(store_history, fnew, default_flow_style=False)
+        os.replace(f'{ymlhistory}.tmp', ymlhistory)
+        ymlfiles.append(ymlhistory)
+    return ymlfiles
@@ -0,0 +1,97 @@
+import numpy as _np
+
+# size of the chunks aimed at by the planner (uncompressed bytes)
+default_chunk_target = 32 * 1024 * 1024
+
+# vertical dimensions of the ocean model output, split before the
+# horizontal ones when a single record is too large
+vertical_dims = ['z_i', 'z_l', 'rho2_l', 'rho2_i', 'zi', 'zl']
+
+
+def read_chunks(timedim='time'):
+    """ chunks used to open the netcdf files when the chunks are planned:
+    one record of one level, merged afterwards up to the planned size """
+    chunks = {dim: 1 for dim in vertical_dims}
+    chunks[timedim] = 1
+    return chunks
+
+
+def plan_variable_chunks(shape, dims, itemsize, timedim='time',
+                         records_per_file=None,
+                         target_bytes=default_chunk_target):
+    """ chunks of a variable that come close to target_bytes
+
+    a record (one time step) is split along the vertical dimensions
+    first, then along the other dimensions (outermost first) until it
+    fits in target_bytes. Records that fit are grouped along timedim,
+    the time chunk always divides the number of records per file so
+    that each append fills whole chunks (the frequency of the output
+    only matters through records_per_file).
+
+    PARAMETERS:
+    ===========
+
+    shape: tuple
+        shape of the variable
+    dims: tuple
+        dimensions of the variable
+    itemsize: int
+        size in bytes of one element
+    timedim: str
+        append dimension
+    records_per_file: int
+        length of timedim in each file, defaults to the variable length
+    target_bytes: int
+        chunk size to aim for
+
+    RETURNS:
+    ========
+
+    chunks: dict
+        chunk size for each dimension of the variable
+    """
+    chunks = {dim: int(size) for dim, size in zip(dims, shape)}
+    if timedim in chunks:
+        nrecords = chunks[timedim] if records_per_file is None \
+            else int(records_per_file)
+        chunks[timedim] = 1
+
+    # split the records that are too large
+    order = [d for d in dims if d in vertical_dims] + \
+        [d for d in dims if d != timedim and d not in vertical_dims]
+    for dim in order:
+        nbytes = itemsize * int(_np.prod(list(chunks.values())))
+        if nbytes <= target_bytes:
+            break
+        other_bytes = nbytes // chunks[dim]
+        chunks[dim] = max(1, target_bytes // other_bytes)
+
+    # group the records that are small
+    if timedim in chunks and nrecords > 0:
+        nbytes = itemsize * int(_np.prod(list(chunks.values())))
+        nt = min(max(1, target_bytes // nbytes), nrecords)
+        while nrecords % nt != 0:
+            nt -= 1
+        chunks[timedim] = int(nt)
+    return chunks
+
+
+def plan_dataset_chunks(ds, timedim='time', records_per_file=None,
+                        target_bytes=default_chunk_target):
+    """ chunk plan of each variable of ds (see plan_variable_chunks)
+
+    RETURNS:
+    ========
+
+    plans: dict
+        chunks of each variable, by variable name
+    """
+    if records_per_file is None and timedim in ds.dims:
+        records_per_file = len(ds[timedim])
+    plans = {}
+    for variable in ds.variables:
+        da = ds[variable]
+        plans[variable] = plan_variable_chunks(
+            da.shape, da.dims, da.dtype.itemsize, timedim=timedim,
+            records_per_file=records_per_file, target_bytes=target_bytes)
+    return plans
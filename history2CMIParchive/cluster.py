@@ -0,0 +1,107 @@
+import dask
+from .profiling import stage
+from .profiling import memory_sampler
+from .profiling import profile_file
+from .profiling import enable_profiling
+from .profiling import disable_profiling
+
+
+def scheduler_spec(address=None, workers=None, threads_per_worker=1,
+                   memory_limit='auto'):
+    """ scheduler of a conversion from the command line options: the
+    address of an existing scheduler, a local cluster of workers, or None
+    (no dask cluster) """
+    if address is not None:
+        return address
+    if workers is None:
+        return None
+    return {'workers': workers, 'threads_per_worker': threads_per_worker,
+            'memory_limit': memory_limit}
+
+
+def open_client(scheduler, local_directory=None, debug=False):
+    """ connect to the scheduler of a conversion
+
+    PARAMETERS:
+    ===========
+
+    scheduler: None, str, dict or Client
+        None for no dask cluster, the address of a running scheduler
+        (e.g. tcp://host:8786), a local cluster as a dict of workers,
+        threads_per_worker and memory_limit (per worker, e.g. '4GB'), or
+        an open client, which is returned as is
+    local_directory: str
+        scratch directory of the workers of a local cluster
+    debug: bool
+        print debug information
+
+    RETURNS:
+    ========
+
+    client: Client or None
+    """
+    if scheduler is None:
+        return None
+    # dask.distributed is only needed by conversions on a cluster
+    from dask.distributed import Client
+    from dask.distributed import LocalCluster
+    if isinstance(scheduler, Client):
+        return scheduler
+    if isinstance(scheduler, str):
+        client = Client(scheduler)
+    else:
+        cluster = LocalCluster(
+            n_workers=scheduler.get('workers', 1),
+            threads_per_worker=scheduler.get('threads_per_worker', 1),
+            memory_limit=scheduler.get('memory_limit', 'auto'),
+            local_directory=local_directory, processes=True,
+            dashboard_address=':0')
+        client = Client(cluster)
+    if debug:
+        print(f'dask client: {client}')
+    return client
+
+
+def close_client(client, scheduler):
+    """ close a client opened by open_client, and its local cluster.
+    A client passed as the scheduler is left open for its owner. """
+    if client is None or client is scheduler:
+        return None
+    cluster = client.cluster
+    client.close()
+    if cluster is not None:
+        cluster.close()
+    return None
+
+
+def submit_task(client, func, *args, **kwargs):
+    """ run func(*args, **kwargs) on a worker of the cluster, returns its
+    future (see run_task) """
+    return client.submit(run_task, func, args, kwargs,
+                         profile=profile_file(), pure=False)
+
+
+def run_task(func, args, kwargs, profile=None):
+    """ body of the tasks submitted to the cluster. The task is recorded
+    in the profile of the client that submitted it (workers are reused
+    by later runs, each task sets its own profile) as a dask_task stage
+    with the memory of the worker during the task (see memory_sampler).
+    The dask arrays of the task are computed in its own thread, the
+    worker threads set the parallelism. """
+    from dask.distributed import get_worker
+    if profile is not None:
+        enable_profiling(profile)
+    else:
+        disable_profiling()
+    with stage('dask_task', task=func.__name__,
+               worker=get_worker().address) as record:
+        with memory_sampler(record, enabled=profile is not None):
+            with dask.config.set(scheduler='synchronous'):
+                result = func(*args, **kwargs)
+    return result
+
+
+def completed(futures):
+    """ iterate over the futures of the cluster as they finish """
+    from dask.distributed import as_completed
+    return as_completed(list(futures))
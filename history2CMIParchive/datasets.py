@@ -1,9 +1,37 @@
 import xarray as _xr
+import numpy as _np
 from .tar_utilities import list_files_archive
 from .tar_utilities import extract_ncfile_from_archive
+from .tar_utilities import get_tar_index
+from .tar_utilities import open_ncfile_from_archive
+from .tar_utilities import stream_ncfiles_from_archive
+from .tar_utilities import is_ignored
 from .zarr_stores import write_to_zarr_store
-import subprocess as sp
+from .zarr_stores import store_name
+from .zarr_stores import store_chunks
+from .regions import write_to_region
+from .regions import check_region_options
+from .site_specific import recall_from_tape
+from .site_specific import finish_recall
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+import multiprocessing as _mp
 from .yaml_utils import create_build_history
+from .build_catalog import catalog_path
+from .build_catalog import record_builds
+from .chunk_planner import default_chunk_target
+from .chunk_planner import read_chunks
+from .chunk_planner import plan_dataset_chunks
+from .encoding import variable_compressor
+from .profiling import stage
+from .profiling import profile_context
+from .cluster import open_client
+from .cluster import close_client
+from .cluster import submit_task
+from .cluster import completed
 
 
 # list of straits used in the MOM model
@@ -15,6 +43,14 @@ list_straits = ['Agulhas_section', 'Barents_opening', 'Bering_Strait',
                 'Mozambique_Channel', 'Pacific_undercurrent', 'Taiwan_Luzon',
                 'Windward_Passage']
 
+# calendars whose years all have the same number of days
+fixed_length_calendars = ['noleap', '365_day', 'all_leap', '366_day',
+                          '360_day']
+
+# specs of the files inspected recently (see inspect_ncfile)
+spec_cache_size = 256
+_specs = OrderedDict()
+
 
 def convert_archive_to_zarr_store(archive='', outputdir='', workdir='',
                                   ignore_types=[],
@@ -22,46 +58,386 @@ def convert_archive_to_zarr_store(archive='', outputdir='', workdir='',
                                   timedim='time', chunks=None,
                                   storetype='directory', grid='gn', tag='v1',
                                   domain='OM4p25', site=None, debug=False,
-                                  write_yaml=True):
-    '''extract files from tar archive and convert to zarr stores '''
+                                  write_yaml=True, indexdir=None,
+                                  extract=True, stream=False, jobs=1,
+                                  parallel='thread', nprocs=1,
+                                  zip_append='inplace',
+                                  chunk_target=default_chunk_target,
+                                  compressor=None, codec_overrides=None,
+                                  recall_command=None, prefetched=False,
+                                  history_backend='yaml', preallocate=None,
+                                  scheduler=None, max_mem=None):
+    '''extract files from tar archive and convert to zarr stores
 
-    # figure out what files are in the archive
-    ncfiles = list_files_archive(archive)
+    with extract=False, members of an uncompressed archive are read in
+    place from the tar and nothing is written to workdir
 
-    if debug:
-        print(ncfiles)
+    with stream=True, the archive (possibly compressed, or '-' for stdin)
+    is read once front to back and each member is converted, then removed
+    from workdir, as it arrives
 
-    # build a list of acceptable files
-    files_to_convert = []
-    for ncfile in ncfiles:
-        addfile = True  # first guess: add file to list
-        for filetype in ignore_types:
-            if filetype in ncfile:
-                addfile = False
-            else:
-                pass
-        if addfile:
-            files_to_convert.append(ncfile)
+    with prefetched=True, the members have already been extracted into
+    workdir (see pipeline.convert_year_range) and are read from there
 
-    if debug:
-        print(files_to_convert)
+    jobs and parallel set the pool writing the variables of each file,
+    see export_nc_out_to_zarr_stores. With nprocs > 1, the members are
+    converted concurrently by a pool of nprocs processes, largest first.
+
+    zip stores touched by an uncompressed archive are recalled from tape
+    in a single batch (recall_command, or the command of the site, see
+    site_specific.recall_from_tape) before the conversion starts.
+
+    with preallocate=(firstyear, lastyear), the stores are created for the
+    whole run and the archive writes its own region of them, so archives
+    can be converted in any order and at the same time (see
+    export_nc_out_to_zarr_stores).
+
+    with a scheduler (see cluster.open_client: address of a running
+    scheduler, or dict of workers, threads_per_worker and memory_limit of
+    a local cluster working in workdir), the members are converted as
+    tasks of the dask cluster instead of a process pool. In stream mode,
+    members arrive one at a time and the cluster writes their variables.
+
+    variables larger than max_mem bytes are written by slabs of at most
+    max_mem bytes (see export_nc_out_to_zarr_stores).
+    Returns the list of errors.
+    '''
+
+    export_kwargs = {'outputdir': outputdir, 'archive': archive,
+                     'overwrite': overwrite, 'consolidated': consolidated,
+                     'timedim': timedim, 'chunks': chunks,
+                     'storetype': storetype, 'grid': grid, 'tag': tag,
+                     'domain': domain, 'site': site, 'debug': debug,
+                     'write_yaml': write_yaml, 'jobs': jobs,
+                     'parallel': parallel, 'zip_append': zip_append,
+                     'chunk_target': chunk_target, 'compressor': compressor,
+                     'codec_overrides': codec_overrides,
+                     'recall_command': recall_command,
+                     'history_backend': history_backend,
+                     'preallocate': preallocate, 'max_mem': max_mem}
+
+    errors = []
+    if stream and nprocs > 1:
+        raise ValueError('stream mode reads members sequentially, '
+                         'it cannot be used with nprocs > 1')
+    if scheduler is not None and nprocs > 1:
+        raise ValueError('members are converted by the dask cluster, '
+                         'nprocs > 1 cannot be used with a scheduler')
+    check_region_options(preallocate, max_mem)
+    client = open_client(scheduler, local_directory=workdir, debug=debug)
+    try:
+        if stream:
+            # members are filtered on their header, ignored ones never
+            # reach the disk
+            for ncfile in stream_ncfiles_from_archive(
+                    archive, workdir, ignore_types=ignore_types):
+                if debug:
+                    print(f'streamed {ncfile}')
+                errors += export_nc_out_to_zarr_stores(
+                    ncfile=f'{workdir}/{ncfile}', scheduler=client,
+                    **export_kwargs)
+                os.remove(f'{workdir}/{ncfile}')
+            return errors
+
+        # scan the archive once, the index is reused for every member
+        index = get_tar_index(archive, cachedir=indexdir, debug=debug)
+
+        # figure out what files are in the archive
+        ncfiles = list_files_archive(archive, index=index)
+
+        if debug:
+            print(ncfiles)
+
+        # build a list of acceptable files
+        files_to_convert = []
+        for ncfile in ncfiles:
+            if not is_ignored(ncfile, ignore_types):
+                files_to_convert.append(ncfile)
+
+        if debug:
+            print(files_to_convert)
+
+        # recall all the zip stores of the archive at once
+        recall = None
+        if storetype == 'zip' and not overwrite:
+            paths = archive_store_paths(archive, files_to_convert, index,
+                                        outputdir, grid=grid, tag=tag,
+                                        timedim=timedim)
+            if paths is not None:
+                # the status of the recall is shared with the workers
+                recall = recall_from_tape(paths, site=site,
+                                          command=recall_command, debug=debug,
+                                          statusdir=workdir)
+        export_kwargs['recall'] = recall
+
+        if nprocs > 1 or client is not None:
+            # largest members first, so the last ones to finish are short
+            sizes = {member['name']: member['size']
+                     for member in index['members']}
+            files_to_convert.sort(key=lambda ncfile: sizes[ncfile],
+                                  reverse=True)
+        if client is not None:
+            futures = {}
+            for ncfile in files_to_convert:
+                future = submit_task(client, convert_member, archive, ncfile,
+                                     workdir, index, extract, export_kwargs,
+                                     prefetched=prefetched)
+                futures[future] = ncfile
+            for future in completed(futures):
+                try:
+                    errors += future.result()
+                except Exception as e:
+                    errors.append(error_record(futures[future], None, e))
+        elif nprocs > 1:
+            executor = ProcessPoolExecutor(max_workers=nprocs,
+                                           mp_context=_mp.get_context('spawn'))
+            futures = {}
+            for ncfile in files_to_convert:
+                future = executor.submit(convert_member, archive, ncfile,
+                                         workdir, index, extract,
+                                         export_kwargs,
+                                         prefetched=prefetched)
+                futures[future] = ncfile
+            for future in as_completed(futures):
+                try:
+                    errors += future.result()
+                except Exception as e:
+                    errors.append(error_record(futures[future], None, e))
+            executor.shutdown()
+        else:
+            for ncfile in files_to_convert:
+                errors += convert_member(archive, ncfile, workdir, index,
+                                         extract, export_kwargs,
+                                         prefetched=prefetched)
+        finish_recall(recall)
+    finally:
+        close_client(client, scheduler)
+
+    return errors
+
+
+def convert_archives_to_zarr_store(archives=[], outputdir='', workdir='',
+                                   ignore_types=[], batch_years=None,
+                                   batch_bytes=None, overwrite=False,
+                                   consolidated=True, timedim='time',
+                                   chunks=None, storetype='directory',
+                                   grid='gn', tag='v1', domain='OM4p25',
+                                   site=None, debug=False, write_yaml=True,
+                                   indexdir=None, extract=True, jobs=1,
+                                   parallel='thread', zip_append='inplace',
+                                   chunk_target=default_chunk_target,
+                                   compressor=None, codec_overrides=None,
+                                   recall_command=None,
+                                   history_backend='yaml', preallocate=None,
+                                   scheduler=None, max_mem=None):
+    '''convert a range of yearly archives, batching the appends
+
+    archives are processed in batches of consecutive archives, either
+    batch_years archives or as many as fit in batch_bytes of netcdf
+    members (by default, all archives form a single batch). Within a
+    batch, the members of the same type (e.g. ocean_month) are
+    concatenated lazily along timedim so each variable store is checked
+    and appended to once per batch instead of once per year.
+    Extracted members are removed from workdir after each batch.
+    The zip stores touched by a batch of uncompressed archives are
+    recalled from tape at once (see convert_archive_to_zarr_store).
+    With preallocate=(firstyear, lastyear), each batch writes its region
+    of preallocated stores (see export_nc_out_to_zarr_stores).
+    With a scheduler, the variables of each batch are written by the dask
+    cluster (see convert_archive_to_zarr_store). Variables larger than
+    max_mem bytes are written by slabs (see export_nc_out_to_zarr_stores).
+    Returns the list of errors.
+    '''
+
+    export_kwargs = {'outputdir': outputdir, 'overwrite': overwrite,
+                     'consolidated': consolidated, 'timedim': timedim,
+                     'chunks': chunks, 'storetype': storetype, 'grid': grid,
+                     'tag': tag, 'domain': domain, 'site': site,
+                     'debug': debug, 'write_yaml': write_yaml, 'jobs': jobs,
+                     'parallel': parallel, 'zip_append': zip_append,
+                     'chunk_target': chunk_target, 'compressor': compressor,
+                     'codec_overrides': codec_overrides,
+                     'recall_command': recall_command,
+                     'history_backend': history_backend,
+                     'preallocate': preallocate, 'max_mem': max_mem}
+
+    check_region_options(preallocate, max_mem)
+
+    # members to convert in each archive, with their size
+    members = []
+    for archive in archives:
+        index = get_tar_index(archive, cachedir=indexdir, debug=debug)
+        selected = [member for member in index['members']
+                    if member['name'].endswith('.nc') and
+                    not is_ignored(member['name'], ignore_types)]
+        members.append((archive, index, selected))
+
+    client = open_client(scheduler, local_directory=workdir, debug=debug)
+    try:
+        export_kwargs['scheduler'] = client
+
+        errors = []
+        for batch in archive_batches(members, batch_years=batch_years,
+                                     batch_bytes=batch_bytes):
+            # group the members by type, in archive (time) order
+            filetypes = {}
+            for archive, index, selected in batch:
+                for member in selected:
+                    key = member_type(member['name'])
+                    filetypes.setdefault(key, []).append((archive, index,
+                                                          member['name']))
+            if debug:
+                print(f'batch of {len(batch)} archives: {list(filetypes)}')
 
-    for ncfile in files_to_convert:
+            # recall all the zip stores of the batch at once
+            recall = None
+            if storetype == 'zip' and not overwrite:
+                paths = []
+                for archive, index, selected in batch:
+                    archive_paths = archive_store_paths(
+                        archive, [member['name'] for member in selected],
+                        index, outputdir, grid=grid, tag=tag,
+                        timedim=timedim)
+                    if archive_paths is None:
+                        # compressed, each file recalls its own stores
+                        paths = None
+                        break
+                    paths += archive_paths
+                if paths is not None:
+                    recall = recall_from_tape(paths, site=site,
+                                              command=recall_command,
+                                              debug=debug, statusdir=workdir)
+
+            for key, entries in filetypes.items():
+                ncpaths, fileobjs = [], []
+                for archive, index, ncfile in entries:
+                    if extract:
+                        extract_member(archive, ncfile, workdir, index)
+                        ncpaths.append(f'{workdir}/{ncfile}')
+                        fileobjs.append(None)
+                    else:
+                        ncpaths.append(ncfile)
+                        fileobjs.append(open_ncfile_from_archive(
+                            archive, ncfile, index))
+                archive_list = [archive for archive, index, ncfile in entries]
+                try:
+                    with stage('export_file', file=key):
+                        errors += export_nc_out_to_zarr_stores(
+                            ncfile=ncpaths, archive=archive_list,
+                            fileobj=fileobjs if not extract else None,
+                            recall=recall, **export_kwargs)
+                except Exception as e:
+                    errors.append(error_record(ncpaths[0], None, e))
+                for ncpath, fileobj in zip(ncpaths, fileobjs):
+                    if fileobj is not None:
+                        fileobj.close()
+                    else:
+                        os.remove(ncpath)
+            finish_recall(recall)
+    finally:
+        close_client(client, scheduler)
+    return errors
+
+
+def archive_batches(members, batch_years=None, batch_bytes=None):
+    """ split the list of (archive, index, selected members) into batches
+    of consecutive archives, by count (batch_years) or by total size of
+    the selected members (batch_bytes) """
+    batches = []
+    current, current_bytes = [], 0
+    for entry in members:
+        size = sum([member['size'] for member in entry[2]])
+        full = False
+        if batch_years is not None and len(current) >= batch_years:
+            full = True
+        if batch_bytes is not None and len(current) > 0 and \
+           current_bytes + size > batch_bytes:
+            full = True
+        if full:
+            batches.append(current)
+            current, current_bytes = [], 0
+        current.append(entry)
+        current_bytes += size
+    if len(current) > 0:
+        batches.append(current)
+    return batches
+
+
+def member_type(ncfile):
+    """ type of a history file, its name without the date prefix
+    (19580101.ocean_month.nc -> ocean_month.nc) """
+    basename = os.path.basename(ncfile)
+    prefix = basename.split('.')[0]
+    if prefix.isdigit():
+        basename = basename[len(prefix) + 1:]
+    return basename
+
+
+def file_year(ncfile):
+    """ year of a history file, from its date prefix
+    (19580101.ocean_month.nc -> 1958) """
+    prefix = os.path.basename(ncfile).split('.')[0]
+    if not prefix.isdigit() or len(prefix) < 5:
+        raise ValueError(f'cannot tell the year of {ncfile}')
+    return int(prefix[:-4])
+
+
+def region_of_files(ncfiles, specs, preallocate, storetype='directory'):
+    """ region of preallocated stores (see regions.write_to_region)
+    written by consecutive yearly files. Every year of the store has the
+    same number of records, so files more frequent than monthly need a
+    calendar whose years all have the same length. """
+    if storetype != 'directory':
+        raise ValueError('preallocated stores must be directory stores')
+    calendar = specs[0].get('calendar')
+    if specs[0]['frequency'] not in ['fx', 'yr', 'mon'] and \
+       calendar not in fixed_length_calendars:
+        raise ValueError(f'files {ncfiles} use the {calendar} calendar, '
+                         'whose years have different lengths: only files of '
+                         f'the {", ".join(fixed_length_calendars)} calendars '
+                         'can be written into preallocated stores')
+    years = [file_year(name) for name in ncfiles]
+    if years != list(range(years[0], years[0] + len(years))):
+        raise ValueError(f'files {ncfiles} are not consecutive years')
+    records = set([spec['ntimes'] for spec in specs])
+    if len(records) > 1:
+        raise ValueError(f'files {ncfiles} have different lengths')
+    firstyear, lastyear = preallocate
+    return {'firstyear': firstyear, 'lastyear': lastyear,
+            'year': years[0], 'records_per_year': specs[0]['ntimes']}
+
+
+def convert_member(archive, ncfile, workdir, index, extract, export_kwargs,
+                   prefetched=False):
+    """ extract (or open in place) a member of archive and export it
+    to zarr stores, returns the list of errors. A prefetched member is
+    already in workdir. """
+    if prefetched:
+        fileobj = None
+        ncpath = f'{workdir}/{ncfile}'
+    elif extract:
         # extract the file
-        extract_ncfile_from_archive(archive, ncfile, workdir)
-        # and process it
-        export_nc_out_to_zarr_stores(ncfile=f'{workdir}/{ncfile}',
-                                     outputdir=outputdir,
-                                     archive=archive,
-                                     overwrite=overwrite,
-                                     consolidated=consolidated,
-                                     timedim=timedim,
-                                     chunks=chunks,
-                                     storetype=storetype,
-                                     grid=grid, tag=tag,
-                                     domain=domain, site=site,
-                                     debug=debug, write_yaml=write_yaml)
+        extract_member(archive, ncfile, workdir, index)
+        fileobj = None
+        ncpath = f'{workdir}/{ncfile}'
+    else:
+        # or read it from its offset in the tar
+        fileobj = open_ncfile_from_archive(archive, ncfile, index)
+        ncpath = ncfile
+    # and process it
+    with stage('export_file', file=ncfile):
+        errors = export_nc_out_to_zarr_stores(ncfile=ncpath, fileobj=fileobj,
+                                              **export_kwargs)
+    if fileobj is not None:
+        fileobj.close()
+    return errors
 
+
+def extract_member(archive, ncfile, workdir, index):
+    """ extract a member of archive into workdir (profiled) """
+    with stage('extract', file=ncfile) as record:
+        extract_ncfile_from_archive(archive, ncfile, workdir, index=index)
+        record['bytes_written'] = os.path.getsize(f'{workdir}/{ncfile}')
     return None
 
 
@@ -75,56 +451,351 @@ def export_nc_out_to_zarr_stores(ncfile='',
                                  storetype='directory',
                                  grid='gn', tag='v1',
                                  domain='OM4p25', site=None,
-                                 debug=False, write_yaml=True):
+                                 debug=False, write_yaml=True,
+                                 fileobj=None, jobs=1, parallel='thread',
+                                 zip_append='inplace',
+                                 chunk_target=default_chunk_target,
+                                 compressor=None, codec_overrides=None,
+                                 recall=None, recall_command=None,
+                                 history_backend='yaml', variables=None,
+                                 preallocate=None, scheduler=None,
+                                 max_mem=None):
 
     """convert all variables form netcdf file and distribute into
-    zarr stores"""
+    zarr stores. If fileobj is provided, data is read from it and
+    ncfile is only used as the name of the file.
+
+    ncfile (and archive, fileobj) can also be lists of consecutive files
+    of the same type, e.g. several years of ocean_month. They are
+    concatenated lazily along timedim and each store is appended once.
+
+    With jobs > 1, the variable stores are written concurrently by a pool
+    of jobs workers (parallel = 'thread' or 'process'). With a scheduler
+    (see cluster.open_client), they are written as tasks of the dask
+    cluster, whose memory is recorded in the profile.
+
+    With domain='auto' and no chunks, the chunks of each variable are
+    planned from its shape and dtype to come close to chunk_target bytes
+    (see chunk_planner.plan_variable_chunks). The chunks of an existing
+    store are reused (see zarr_stores.store_chunks).
+
+    compressor (e.g. 'zstd:3:bitshuffle', see encoding.make_compressor)
+    is used for the new stores, codec_overrides maps variable names to
+    their own compressor.
+
+    zip_append selects how zip stores are appended to: 'inplace' adds the
+    new members at the end of the zip, 'rewrite' writes a fresh zip
+    without the superseded metadata (see zip_stores.rewrite_append_zip).
+
+    The existing zip stores of the file are recalled from tape in a single
+    batch (recall_command, or the command of the site), unless the caller
+    already started a recall covering them (recall).
+
+    With write_yaml, the build history of each store goes to its yaml file
+    (history_backend='yaml') or, for all the stores written from the
+    file at once, to the sqlite catalog at the root of outputdir
+    (history_backend='sqlite', see build_catalog).
+
+    variables restricts the conversion to some of the variables of the
+    file (e.g. the ones left to convert, see sync.sync_history).
+
+    With preallocate=(firstyear, lastyear), each (directory) store is
+    created on the first write with room for all the years of the run,
+    and the file is written into the region of its year, given by the
+    date prefix of its name (see regions.write_to_region). Years can then
+    be converted in any order, by several processes at once.
+
+    With max_mem, a variable larger than max_mem bytes (e.g. daily 3D
+    fields of OM4p125) is loaded and written slab by slab, groups of
+    records or levels of a record of at most max_mem bytes, instead of in
+    one piece (see slabs.plan_slabs). The peak memory of the process
+    during the write of each variable is printed and profiled. Regions of
+    preallocated stores are written in one piece, max_mem cannot be used
+    with preallocate.
+
+    Returns the list of errors, one dict (file, variable, error) per
+    variable that could not be written."""
+
+    check_region_options(preallocate, max_mem)
+
+    if isinstance(ncfile, list):
+        ncfiles = ncfile
+        archives = archive if isinstance(archive, list) else \
+            [archive] * len(ncfiles)
+        fileobjs = fileobj if fileobj is not None else [None] * len(ncfiles)
+        # the first file of the batch stands for the others
+        ncfile, archive, fileobj = ncfiles[0], archives[0], fileobjs[0]
+    else:
+        ncfiles, archives, fileobjs = [ncfile], [archive], [fileobj]
+
+    # read the header of each file once, every step below uses its spec
+    specs = []
+    for name, fobj in zip(ncfiles, fileobjs):
+        with stage('inspect_ncfile', file=os.path.basename(name)):
+            specs.append(inspect_ncfile(name, timedim=timedim, fileobj=fobj))
 
     # the name of ncfile and its time is used to create a code
-    component_code = define_component_code(ncfile, timedim=timedim)
+    component_code = define_component_code(ncfile, timedim=timedim,
+                                           fileobj=fileobj, spec=specs[0])
     # decide chunking if none provided
-    if chunks is None:
+    plan_chunks = (chunks is None and domain == 'auto')
+    if plan_chunks:
+        chunks = read_chunks(timedim=timedim)
+    elif chunks is None:
         chunks = chunk_choice(component_code, domain=domain)
     if debug:
         print(f'component_code is {component_code}')
         print(f'domain is {domain}')
         print(f'chunks are {chunks}')
     # open dataset
-    ds = open_dataset(ncfile, chunks, decode_times=False)
-
-    for variable in ds.variables:
-        # define path to zarr store
-        storepath = infer_store_path(ncfile, variable, outputdir,
-                                     component_code, grid=grid,
-                                     tag=tag)
-        # and create path
-        check = sp.check_call(f'mkdir -p {storepath}', shell=True)
-        exit_code(check)
+    datasets = []
+    for name, fobj, spec in zip(ncfiles, fileobjs, specs):
+        with stage('open_dataset', file=os.path.basename(name)):
+            datasets.append(open_dataset(name if fobj is None else fobj,
+                                         chunks, decode_times=False,
+                                         spec=spec))
+    try:
+        if len(datasets) > 1:
+            ds = concat_along_time(datasets, timedim=timedim)
+        else:
+            ds = datasets[0]
+        # one chunk plan per variable, time chunks divide the file length
+        plans = {}
+        if plan_chunks:
+            records = specs[0]['ntimes'] if timedim in specs[0]['dims'] \
+                else None
+            plans = plan_dataset_chunks(ds, timedim=timedim,
+                                        records_per_file=records,
+                                        target_bytes=chunk_target)
+            if debug:
+                print(f'planned chunks are {plans}')
+
         # build dict for yaml file
         if len(archive) > 0:
             tarfile = archive.replace('/', ' ').split()[-1]
             historydir = archive.replace(tarfile, '')
         else:
-            tarfile = 'unknown'
             historydir = 'unknown'
-        files = [{tarfile: ncfile.replace('/', ' ').split()[-1]}]
-        rebuild_dict = create_build_history(historydir, outputdir,
-                                            storetype, consolidated,
-                                            timedim, chunks, grid, tag,
-                                            domain, site, variable, files)
-        # write the store
-        if debug:
-            print(f'writing {variable} into {storepath}')
-        write_to_zarr_store(ds[variable], storepath,
-                            concat_dim=timedim, storetype=storetype,
-                            consolidated=consolidated,
-                            overwrite=overwrite, site=site, debug=debug,
-                            write_yaml=write_yaml, rebuild_dict=rebuild_dict)
+        files = []
+        for name, arch in zip(ncfiles, archives):
+            tarfile = arch.replace('/', ' ').split()[-1] if len(arch) > 0 \
+                else 'unknown'
+            files.append({tarfile: name.replace('/', ' ').split()[-1]})
+
+        # define paths to zarr stores
+        if variables is None:
+            variables = list(specs[0]['variables'])
+        storepaths = {variable: infer_store_path(ncfile, variable, outputdir,
+                                                 component_code, grid=grid,
+                                                 tag=tag)
+                      for variable in specs[0]['variables']
+                      if variable in variables}
+
+        # recall the zip stores of the file at once, unless the caller did
+        own_recall = None
+        if recall is None and storetype == 'zip' and not overwrite:
+            own_recall = recall_from_tape(existing_stores(storepaths,
+                                                          storetype),
+                                          site=site, command=recall_command,
+                                          debug=debug, statusdir=outputdir)
+            recall = own_recall
+
+        # existing stores keep their chunks, only new stores are planned
+        if plan_chunks and not overwrite:
+            for variable, storepath in storepaths.items():
+                if variable not in plans:
+                    continue
+                current = store_chunks(storepath, variable, storetype,
+                                       site=site, debug=debug, recall=recall)
+                if current is not None and \
+                   set(current) == set(plans[variable]):
+                    plans[variable] = {dim: int(current[dim])
+                                       for dim in plans[variable]}
+            if debug:
+                print(f'chunks of the existing stores are {plans}')
+
+        write_kwargs = {'concat_dim': timedim, 'storetype': storetype,
+                        'consolidated': consolidated, 'overwrite': overwrite,
+                        'site': site, 'debug': debug, 'write_yaml': write_yaml,
+                        'zip_append': zip_append, 'recall': recall,
+                        'history_backend': history_backend, 'max_mem': max_mem}
+
+        if preallocate is not None:
+            write_kwargs['preallocate'] = region_of_files(ncfiles, specs,
+                                                          preallocate,
+                                                          storetype=storetype)
+
+        tasks = []
+        for variable in ds.variables:
+            if variable not in storepaths:
+                continue
+            storepath = storepaths[variable]
+            da = ds[variable]
+            if variable in plans:
+                da = da.chunk(plans[variable])
+            rebuild_dict = create_build_history(historydir, outputdir,
+                                                storetype, consolidated,
+                                                timedim,
+                                                plans.get(variable, chunks),
+                                                grid, tag, domain, site,
+                                                variable, files)
+            tasks.append((variable, da, storepath, rebuild_dict,
+                          dict(write_kwargs,
+                               compressor=variable_compressor(
+                                   variable, compressor, codec_overrides))))
+
+        errors = []
+        written = []
+        client = open_client(scheduler, debug=debug)
+        if client is not None:
+            try:
+                futures = {}
+                for variable, da, storepath, rebuild_dict, var_kwargs in tasks:
+                    future = submit_task(client, export_variable, da,
+                                         storepath, rebuild_dict, var_kwargs,
+                                         ncfile=os.path.basename(ncfile))
+                    futures[future] = (variable, storepath, rebuild_dict)
+                for future in completed(futures):
+                    variable, storepath, rebuild_dict = futures[future]
+                    try:
+                        if future.result():
+                            written.append((storepath, rebuild_dict))
+                    except Exception as e:
+                        errors.append(error_record(ncfile, variable, e))
+            finally:
+                close_client(client, scheduler)
+        elif jobs > 1:
+            if parallel == 'process':
+                # fork is not safe once dask/HDF5 threads are running
+                executor = ProcessPoolExecutor(
+                    max_workers=jobs, mp_context=_mp.get_context('spawn'))
+            else:
+                executor = ThreadPoolExecutor(max_workers=jobs)
+            futures = {}
+            for variable, da, storepath, rebuild_dict, var_kwargs in tasks:
+                future = executor.submit(export_variable, da,
+                                         storepath, rebuild_dict, var_kwargs,
+                                         ncfile=os.path.basename(ncfile))
+                futures[future] = (variable, storepath, rebuild_dict)
+            for future in as_completed(futures):
+                variable, storepath, rebuild_dict = futures[future]
+                try:
+                    if future.result():
+                        written.append((storepath, rebuild_dict))
+                except Exception as e:
+                    errors.append(error_record(ncfile, variable, e))
+            executor.shutdown()
+        else:
+            for variable, da, storepath, rebuild_dict, var_kwargs in tasks:
+                try:
+                    if export_variable(da, storepath, rebuild_dict, var_kwargs,
+                                       ncfile=os.path.basename(ncfile)):
+                        written.append((storepath, rebuild_dict))
+                except Exception as e:
+                    errors.append(error_record(ncfile, variable, e))
+        finish_recall(own_recall)
+        if write_yaml and history_backend == 'sqlite' and len(written) > 0:
+            # a store that cannot be recorded does not stop the others
+            failed = []
+            with stage('update_catalog', file=os.path.basename(ncfile)):
+                record_builds(catalog_path(outputdir), written,
+                              overwrite=overwrite, failed=failed)
+            for storepath, build, e in failed:
+                errors.append(error_record(ncfile, build['varname'], e))
+        ds.close()
+    finally:
+        for dsfile in datasets:
+            dsfile.close()
+
+    if len(errors) > 0:
+        report_errors(errors)
+    return errors
+
+
+def concat_along_time(datasets, timedim='time'):
+    """ lazily concatenate consecutive files along timedim, variables
+    without timedim are taken from the first file """
+    ds = _xr.concat(datasets, dim=timedim, data_vars='minimal',
+                    coords='minimal', compat='override')
+    if timedim in ds.dims:
+        times = ds[timedim].values
+        if not (_np.diff(times) > 0).all():
+            raise ValueError(f'{timedim} is not increasing across the batch')
+    return ds
+
+
+def export_variable(da, storepath, rebuild_dict, write_kwargs, ncfile=None):
+    """ create the store path and write a single variable into it,
+    this is the unit of work of export_nc_out_to_zarr_stores. ncfile
+    (the name of the source file) labels the profiled stages. Returns
+    True if data was written """
+    os.makedirs(storepath, exist_ok=True)
+    if write_kwargs['debug']:
+        print(f'writing {da.name} into {storepath}')
+    with profile_context(file=ncfile):
+        if 'preallocate' in write_kwargs:
+            written = write_to_region(da, storepath,
+                                      rebuild_dict=rebuild_dict,
+                                      **write_kwargs)
+        else:
+            written = write_to_zarr_store(da, storepath,
+                                          rebuild_dict=rebuild_dict,
+                                          **write_kwargs)
+    return written
+
+
+def existing_stores(storepaths, storetype):
+    """ stores (by variable, see infer_store_path) already on disk """
+    fstores = [store_name(storepath, variable, storetype)
+               for variable, storepath in storepaths.items()]
+    return [fstore for fstore in fstores if os.path.exists(fstore)]
+
+
+def archive_store_paths(archive, ncfiles, index, outputdir, grid='gn',
+                        tag='v1', timedim='time'):
+    """ existing zip stores that the conversion of the members ncfiles
+    of archive will touch. The headers of the members are read in place,
+    None if the archive is compressed. """
+    if index['compression'] is not None:
+        return None
+    paths = []
+    for ncfile in ncfiles:
+        fileobj = open_ncfile_from_archive(archive, ncfile, index)
+        try:
+            spec = inspect_ncfile(ncfile, timedim=timedim, fileobj=fileobj)
+            component_code = define_component_code(ncfile, timedim=timedim,
+                                                   fileobj=fileobj, spec=spec)
+            variables = list(spec['variables'])
+        except Exception:
+            # not readable, the conversion will report it
+            continue
+        finally:
+            fileobj.close()
+        storepaths = {variable: infer_store_path(ncfile, variable, outputdir,
+                                                 component_code, grid=grid,
+                                                 tag=tag)
+                      for variable in variables}
+        paths += existing_stores(storepaths, 'zip')
+    return paths
+
+
+def error_record(ncfile, variable, error):
+    """ describe a failed variable write """
+    return {'file': ncfile, 'variable': variable,
+            'error': f'{type(error).__name__}: {error}'}
+
+
+def report_errors(errors):
+    """ print the list of failed variable writes """
+    print(f'ERROR: {len(errors)} variable(s) could not be written')
+    for record in errors:
+        print(f"  {record['file']} {record['variable']}: {record['error']}")
     return None
 
 
 def chunk_choice(component_code, domain='OM4p25'):
-    """ default chunking for standard domains """
+    """ default chunking for standard domains (domain='auto' plans the
+    chunks of each variable instead, see chunk_planner) """
     if domain == 'OM4p25':
         chunks = chunk_choice_OM4p25(component_code)
     elif domain == 'OM4p125':
@@ -233,7 +904,7 @@ def infer_store_path(ncfile, varname, ppdir, component_code,
     return store_path
 
 
-def define_component_code(ncfile, timedim='time'):
+def define_component_code(ncfile, timedim='time', fileobj=None, spec=None):
     """ based on filename, infer what component it belongs to
 
     PARAMETERS:
@@ -243,6 +914,11 @@ def define_component_code(ncfile, timedim='time'):
         input netcdf file
     timedim: str
         time dimension in file
+    fileobj: file-like
+        opened ncfile, used instead of ncfile to read the time counter
+    spec: dict
+        spec of ncfile (see inspect_ncfile), gives the time counter
+        without opening the file
 
     RETURNS:
     --------
@@ -272,67 +948,174 @@ def define_component_code(ncfile, timedim='time'):
         code += 'day'
     else:
         # infer from the file time variable
-        print('Infer frequency from time counter (slower)')
-        tmp = _xr.open_dataset(ncfile, decode_times=False)
-        if timedim in tmp.dims:
-            ntimes = len(tmp[timedim])
-        else:
-            ntimes = 0
-        tmp.close()
-        if ntimes == 0:
-            code += 'fx'
-        elif ntimes == 1:
-            code += 'yr'
-        elif ntimes == 12:
-            code += 'mon'
-        elif (ntimes > 359) and (ntimes < 367):
-            code += 'day'
+        if spec is None:
+            print('Infer frequency from time counter (slower)')
+            spec = inspect_ncfile(ncfile, timedim=timedim, fileobj=fileobj)
+        if spec['frequency'] is not None:
+            code += spec['frequency']
         else:
             print('Cannot infer frequency of file', ncfile)
 
     return code
 
 
-def open_dataset(ncfile, chunks, decode_times=False):
+def frequency_from_ntimes(ntimes):
+    """ frequency of a yearly history file from its number of records """
+    if ntimes == 0:
+        return 'fx'
+    elif ntimes == 1:
+        return 'yr'
+    elif ntimes == 12:
+        return 'mon'
+    elif (ntimes > 359) and (ntimes < 367):
+        return 'day'
+    return None
+
+
+def inspect_ncfile(ncfile, timedim='time', fileobj=None):
+    """ read the header of a netcdf file once and describe it. Specs are
+    cached (by path, size and modification time, or by archive member) so
+    the later steps of the conversion do not open the file again.
+
+    PARAMETERS:
+    ===========
+
+    ncfile: str
+        input netcdf file
+    timedim: str
+        time dimension in file
+    fileobj: file-like
+        opened ncfile, read instead of ncfile
+
+    RETURNS:
+    ========
+
+    spec: dict
+        dims (size of each dimension), variables (dims, shape and dtype
+        of each variable), ntimes (length of timedim, 0 if absent) and
+        frequency (inferred from ntimes, see frequency_from_ntimes) and
+        calendar (of timedim, lower case, None if absent)
+    """
+    source = ncfile if fileobj is None else fileobj
+    identity = ncfile_identity(source)
+    key = (identity, timedim)
+    if identity is not None and key in _specs:
+        _specs.move_to_end(key)
+        return _specs[key]
+
+    kwargs = {'decode_times': False}
+    if not isinstance(source, str):
+        kwargs['engine'] = netcdf_engine(source)
+    tmp = _xr.open_dataset(source, **kwargs)
+    dims = {dim: int(size) for dim, size in tmp.sizes.items()}
+    calendar = None
+    if timedim in tmp.variables:
+        attrs = tmp[timedim].attrs
+        calendar = attrs.get('calendar', attrs.get('calendar_type'))
+        calendar = None if calendar is None else str(calendar).lower()
+    variables = {}
+    for variable in tmp.variables:
+        da = tmp[variable]
+        variables[variable] = {'dims': list(da.dims),
+                               'shape': [int(n) for n in da.shape],
+                               'dtype': str(da.dtype)}
+    tmp.close()
+    # file objects need to be rewound for the next reader
+    if not isinstance(source, str):
+        source.seek(0)
+    ntimes = dims.get(timedim, 0)
+    spec = {'dims': dims, 'variables': variables, 'ntimes': ntimes,
+            'frequency': frequency_from_ntimes(ntimes),
+            'calendar': calendar}
+
+    if identity is not None:
+        _specs[key] = spec
+        if len(_specs) > spec_cache_size:
+            _specs.popitem(last=False)
+    return spec
+
+
+def ncfile_identity(source):
+    """ key of a netcdf file in the spec cache: path, inode, size and
+    times of a file (extracted members keep the mtime of the archive, the
+    ctime changes when they are written again), or archive, offset and
+    size of a tar member. None for other file objects, whose specs are
+    not cached (their id can be reused by the next file object). """
+    if isinstance(source, str):
+        stat = os.stat(source)
+        return (os.path.abspath(source), stat.st_ino, stat.st_size,
+                stat.st_mtime_ns, stat.st_ctime_ns)
+    if hasattr(source, 'archivefile'):
+        stat = os.stat(source.archivefile)
+        return (os.path.abspath(source.archivefile), stat.st_mtime_ns,
+                source.offset, source.size)
+    return None
+
+
+def open_dataset(ncfile, chunks, decode_times=False, spec=None):
     """ A wrapper around xarray.open_dataset, in case some
     custom code is needed.
 
     PARAMETERS:
     ===========
 
-    ncfile: str
+    ncfile: str or file-like
 
     chunks: list
 
     decode_times: bool
 
+    spec: dict
+        spec of ncfile (see inspect_ncfile), read if not provided
+
     RETURNS:
     ========
 
     ds: xarray.Dataset
     """
-    # first open without chunks to get dimensions:
-    tmp = _xr.open_dataset(ncfile, decode_times=decode_times)
+    # file objects (e.g. tar members) need an explicit engine
+    kwargs = {'decode_times': decode_times}
+    if not isinstance(ncfile, str):
+        kwargs['engine'] = netcdf_engine(ncfile)
+    # the dimensions come from the header, read once
+    if spec is None:
+        if isinstance(ncfile, str):
+            spec = inspect_ncfile(ncfile)
+        else:
+            spec = inspect_ncfile('', fileobj=ncfile)
     # check if dimensions in chunk exist in dataset (else xarray returns error)
     useable_chunks = {}
     for k in chunks.keys():
-        if k in tmp.dims:
+        if k in spec['dims']:
             useable_chunks[k] = chunks[k]
     # chunks on other dimensions should be size of dims
     # and not infered from input netcdf file
-    for d in tmp.dims:
+    for d in spec['dims']:
         if d not in useable_chunks:
-            useable_chunks[d] = len(tmp[d])
-    tmp.close()
-    # re-open with correct chunking
+            useable_chunks[d] = spec['dims'][d]
+    # open with correct chunking
     if len(useable_chunks) > 1:
-        ds = _xr.open_dataset(ncfile, chunks=useable_chunks,
-                              decode_times=decode_times)
+        ds = _xr.open_dataset(ncfile, chunks=useable_chunks, **kwargs)
     else:
-        ds = _xr.open_dataset(ncfile, decode_times=decode_times)
+        ds = _xr.open_dataset(ncfile, **kwargs)
     return ds
 
 
+def netcdf_engine(fileobj):
+    """ pick the xarray engine able to read a netcdf file object:
+    scipy for netcdf3 (classic, 64-bit offset), h5netcdf for netcdf4 """
+    fileobj.seek(0)
+    magic = fileobj.read(4)
+    fileobj.seek(0)
+    if magic.startswith(b'CDF'):
+        engine = 'scipy'
+    elif magic.startswith(b'\x89HDF'):
+        engine = 'h5netcdf'
+    else:
+        raise IOError('file object is not a netcdf file')
+    return engine
+
+
 def exit_code(return_code):
     import sys
     """exit with return code """
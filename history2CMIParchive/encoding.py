@@ -0,0 +1,135 @@
+from numcodecs import Blosc
+from numcodecs import blosc as _blosc
+import numpy as _np
+import time
+
+# candidate codecs of the benchmark, as cname:clevel:shuffle
+default_candidates = ['lz4:5:shuffle', 'lz4:5:bitshuffle',
+                      'zstd:1:shuffle', 'zstd:3:shuffle',
+                      'zstd:3:bitshuffle', 'zstd:9:bitshuffle']
+
+shuffles = {'noshuffle': Blosc.NOSHUFFLE, 'shuffle': Blosc.SHUFFLE,
+            'bitshuffle': Blosc.BITSHUFFLE}
+
+
+def make_compressor(spec):
+    """ Blosc compressor described by spec
+
+    PARAMETERS:
+    ===========
+
+    spec: str or numcodecs codec
+        cname[:clevel[:shuffle]] e.g. 'zstd:3:bitshuffle', with shuffle
+        one of noshuffle, shuffle, bitshuffle (default clevel 5, shuffle).
+        None leaves the choice to zarr.
+
+    RETURNS:
+    ========
+
+    compressor: numcodecs codec or None
+    """
+    if spec is None or not isinstance(spec, str):
+        return spec
+    fields = spec.split(':')
+    cname = fields[0]
+    clevel = int(fields[1]) if len(fields) > 1 else 5
+    shuffle = fields[2] if len(fields) > 2 else 'shuffle'
+    if cname not in _blosc.list_compressors():
+        raise ValueError(f'unknown blosc compressor {cname}')
+    if shuffle not in shuffles:
+        raise ValueError(f'unknown shuffle {shuffle}, '
+                         f'use one of {list(shuffles)}')
+    return Blosc(cname=cname, clevel=clevel, shuffle=shuffles[shuffle])
+
+
+def variable_compressor(varname, compressor=None, codec_overrides=None):
+    """ compressor spec of varname: its override if any, else the default
+    compressor """
+    if codec_overrides is not None and varname in codec_overrides:
+        return codec_overrides[varname]
+    return compressor
+
+
+def variable_encoding(varname, compressor=None):
+    """ zarr encoding of varname for to_zarr, empty if compressor is None
+    (zarr default) """
+    if compressor is None:
+        return {}
+    return {varname: {'compressor': make_compressor(compressor)}}
+
+
+def sample_chunks(da, nsample=4):
+    """ up to nsample chunks of da, evenly spread over its dask blocks """
+    if da.chunks is None:
+        return [_np.asarray(da.values)]
+    nblocks = int(_np.prod(da.data.numblocks))
+    flat = _np.unique(_np.linspace(0, nblocks - 1,
+                                   min(nsample, nblocks)).astype(int))
+    samples = []
+    for k in flat:
+        index = _np.unravel_index(k, da.data.numblocks)
+        samples.append(_np.ascontiguousarray(
+            da.data.blocks[index].compute()))
+    return samples
+
+
+def codec_performance(compressor, samples, repeat=3):
+    """ compression ratio and compress/decompress speed (MB/s, best of
+    repeat) of compressor over the samples """
+    nbytes = sum(s.nbytes for s in samples)
+    best_encode, best_decode = None, None
+    for k in range(repeat):
+        start = time.perf_counter()
+        encoded = [compressor.encode(s) for s in samples]
+        encode_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for buf in encoded:
+            compressor.decode(buf)
+        decode_time = time.perf_counter() - start
+        best_encode = encode_time if best_encode is None else \
+            min(best_encode, encode_time)
+        best_decode = decode_time if best_decode is None else \
+            min(best_decode, decode_time)
+    nencoded = sum(len(buf) for buf in encoded)
+    mb = nbytes / 1e6
+    return {'ratio': nbytes / max(nencoded, 1),
+            'compress_MBps': mb / max(best_encode, 1e-9),
+            'decompress_MBps': mb / max(best_decode, 1e-9)}
+
+
+def benchmark_codecs(ds, candidates=default_candidates, variables=None,
+                     nsample=4, repeat=3):
+    """ try candidate codecs on a sample of chunks of each variable
+
+    PARAMETERS:
+    ===========
+
+    ds: xarray.Dataset
+        dataset opened with the chunks of the stores (see
+        datasets.open_dataset)
+    candidates: list
+        codec specs (see make_compressor)
+    variables: list
+        variables to test, defaults to the data variables
+    nsample: int
+        number of chunks sampled per variable
+    repeat: int
+        timings are the best of repeat runs
+
+    RETURNS:
+    ========
+
+    report: list of dict
+        variable, codec, ratio, compress_MBps, decompress_MBps
+    """
+    if variables is None:
+        variables = list(ds.data_vars)
+    report = []
+    for variable in variables:
+        samples = sample_chunks(ds[variable], nsample=nsample)
+        for spec in candidates:
+            record = {'variable': variable, 'codec': spec}
+            record.update(codec_performance(make_compressor(spec), samples,
+                                            repeat=repeat))
+            report.append(record)
+    return report
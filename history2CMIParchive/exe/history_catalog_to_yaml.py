@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+
+from history2CMIParchive.build_catalog import catalog_path
+from history2CMIParchive.build_catalog import export_yaml
+from history2CMIParchive.build_catalog import stores_built_from
+import argparse
+
+parser = argparse.ArgumentParser(description='write the history yaml of \
+                                              the stores from the sqlite \
+                                              build history catalog')
+
+parser.add_argument('-o', '--outputdir', type=str, required=True,
+                    help="root of the zarr stores (holds the catalog)")
+
+parser.add_argument('-a', '--archive', type=str, required=False,
+                    default=None,
+                    help="only the stores built from this tar file")
+
+args = parser.parse_args()
+
+catalog = catalog_path(args.outputdir)
+stores = None
+if args.archive is not None:
+    stores = stores_built_from(catalog, args.archive)
+for ymlfile in export_yaml(catalog, stores=stores):
+    print(ymlfile)
@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+
+from history2CMIParchive.profiling import summarize_profile
+from history2CMIParchive.profiling import print_profile_summary
+import argparse
+
+parser = argparse.ArgumentParser(description='summarize the profile of a \
+                                              conversion run')
+
+parser.add_argument('-i', '--profile', type=str, required=True,
+                    help="json lines file written with --profile")
+
+parser.add_argument('-n', '--top', type=int, required=False,
+                    default=10, help="number of hot spots")
+
+args = parser.parse_args()
+
+print_profile_summary(summarize_profile(args.profile, top=args.top))
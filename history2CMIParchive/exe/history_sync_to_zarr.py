@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+from history2CMIParchive.sync import sync_history
+from history2CMIParchive.sync import ledger_path
+from history2CMIParchive.sync import ledger_status
+from history2CMIParchive.profiling import enable_profiling
+import warnings
+import sys
+import argparse
+
+parser = argparse.ArgumentParser(description='bring the zarr stores up to \
+                                              date with a history \
+                                              directory, converting only \
+                                              what is missing or failed')
+
+parser.add_argument('-H', '--historydir', type=str, required=True,
+                    help="path to history tar files")
+
+parser.add_argument('-o', '--outputdir', type=str, required=True,
+                    help="path to output zarr store")
+
+parser.add_argument('-w', '--workdir', type=str, required=True,
+                    help="path to scratch dir for extracted nc")
+
+parser.add_argument('-l', '--ledger', type=str, required=False,
+                    default=None,
+                    help="sync ledger (default: in outputdir)")
+
+parser.add_argument('--pattern', type=str, required=False,
+                    default='*.nc.tar', help="glob pattern of the archives")
+
+parser.add_argument('-s', '--storetype', type=str, required=False,
+                    default='directory', help="zarr store type")
+
+parser.add_argument('-d', '--domain', type=str, required=False,
+                    default='OM4', help="model domain (auto: planned chunks)")
+
+parser.add_argument('-G', '--grid', type=str, required=False,
+                    default='gn', help="grid type (gn/gr)")
+
+parser.add_argument('-t', '--tag', type=str, required=False,
+                    default='v1', help="model version tag")
+
+parser.add_argument('-S', '--site', type=str, required=False,
+                    default='gfdl', help="site specific")
+
+parser.add_argument('--recall-command', dest='recall_command', type=str,
+                    required=False, default=None,
+                    help="tape recall command, {files} is replaced by the "
+                         "files (default: the one of the site)")
+
+parser.add_argument('-I', '--ignore', nargs='+', required=False,
+                    help="types to be ignored")
+
+parser.add_argument('-X', '--indexdir', type=str, required=False,
+                    default=None, help="directory of the tar indexes")
+
+parser.add_argument('--stale-after', dest='stale_after', type=float,
+                    required=False, default=None,
+                    help="seconds after which units claimed by a worker "
+                         "that did not finish them are taken over")
+
+parser.add_argument('--max-members', dest='max_members', type=int,
+                    required=False, default=None,
+                    help="stop after converting this many members")
+
+parser.add_argument('-j', '--jobs', type=int, required=False,
+                    default=1, help="number of workers writing variables")
+
+parser.add_argument('--zip-append', dest='zip_append', type=str,
+                    required=False, default='inplace',
+                    choices=['inplace', 'rewrite'],
+                    help="append to zip stores in place or rewrite them")
+
+parser.add_argument('--compressor', type=str, required=False,
+                    default=None,
+                    help="blosc codec of new stores, e.g. zstd:3:bitshuffle")
+
+parser.add_argument('--history-backend', dest='history_backend', type=str,
+                    required=False, default='yaml', choices=['yaml', 'sqlite'],
+                    help="build history in yaml files or in a sqlite catalog")
+
+parser.add_argument('--profile', type=str, nargs='?', required=False,
+                    default=None, const='profile.jsonl',
+                    help="record stage timings in a json lines file")
+
+parser.add_argument('-D', '--debug', type=bool, required=False,
+                    default=False, help="print debug information")
+
+parser.add_argument("--Wall", help='show warnings')
+
+# worker processes (spawned) re-import this script
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if not args.Wall:
+        warnings.filterwarnings("ignore")
+
+    kwargs = vars(args)
+    ignore = kwargs.pop('ignore', None)
+    if ignore is not None:
+        kwargs['ignore_types'] = ignore
+    kwargs.pop('Wall', None)
+    profile = kwargs.pop('profile', None)
+    if profile is not None:
+        enable_profiling(profile)
+
+    errors = sync_history(**kwargs)
+    ledger = args.ledger if args.ledger is not None else \
+        ledger_path(args.outputdir)
+    for status, count in sorted(ledger_status(ledger).items()):
+        print(f'{count} units {status}')
+    if len(errors) > 0:
+        sys.exit(1)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+from history2CMIParchive.synthetic import create_synthetic_history
+from history2CMIParchive.synthetic import run_load_test
+from history2CMIParchive.synthetic import default_members
+import warnings
+import argparse
+import yaml
+
+parser = argparse.ArgumentParser(description='generate synthetic history \
+                                              archives and convert them')
+
+parser.add_argument('-o', '--rundir', type=str, required=True,
+                    help="directory for archives, work files and stores")
+
+parser.add_argument('-y', '--years', type=int, nargs=2, required=False,
+                    default=[1, 5], help="first and last model year")
+
+parser.add_argument('-r', '--resolution', type=float, required=False,
+                    default=1, help="horizontal resolution (degrees)")
+
+parser.add_argument('-N', '--nvars', type=int, required=False,
+                    default=4, help="number of variables per member")
+
+parser.add_argument('-z', '--nz', type=int, required=False,
+                    default=5, help="number of vertical levels")
+
+parser.add_argument('-m', '--members', nargs='+', required=False,
+                    default=None, choices=list(default_members),
+                    help="member types (default: all)")
+
+parser.add_argument('-c', '--compression', type=str, required=False,
+                    default=None, choices=['gz', 'bz2', 'xz'],
+                    help="compression of the archives")
+
+parser.add_argument('-s', '--storetype', type=str, required=False,
+                    default='directory', help="zarr store type")
+
+parser.add_argument('-d', '--domain', type=str, required=False,
+                    default='OM4p25',
+                    help="model domain (auto: planned chunks)")
+
+parser.add_argument('-j', '--jobs', type=int, required=False,
+                    default=1, help="number of workers writing variables")
+
+parser.add_argument('-n', '--nprocs', type=int, required=False,
+                    default=1, help="number of processes converting members")
+
+parser.add_argument('--batch-years', dest='batch_years', type=int,
+                    required=False, default=None,
+                    help="number of archives appended at once")
+
+parser.add_argument('--skip-generate', dest='generate',
+                    action='store_false',
+                    help="reuse the archives of a previous run")
+
+parser.add_argument("--Wall", help='show warnings')
+
+# worker processes (spawned) re-import this script
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if not args.Wall:
+        warnings.filterwarnings("ignore")
+
+    years = list(range(args.years[0], args.years[1] + 1))
+    historydir = f'{args.rundir}/history'
+    if args.generate:
+        archives = create_synthetic_history(historydir, years,
+                                            resolution=args.resolution,
+                                            nvars=args.nvars, nz=args.nz,
+                                            members=args.members,
+                                            compression=args.compression)
+    else:
+        suffix = '' if args.compression is None else f'.{args.compression}'
+        archives = [f'{historydir}/{year:04d}0101.nc.tar{suffix}'
+                    for year in years]
+
+    kwargs = {'storetype': args.storetype, 'domain': args.domain,
+              'jobs': args.jobs, 'site': None}
+    if args.batch_years is not None:
+        kwargs['batch_years'] = args.batch_years
+    else:
+        kwargs['nprocs'] = args.nprocs
+
+    report = run_load_test(archives, f'{args.rundir}/pp',
+                           f'{args.rundir}/work', **kwargs)
+    print(yaml.dump(report, default_flow_style=False))
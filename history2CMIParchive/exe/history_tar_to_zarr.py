@@ -1,14 +1,21 @@
 #!/usr/bin/env python
 
 from history2CMIParchive.datasets import convert_archive_to_zarr_store
+from history2CMIParchive.datasets import convert_archives_to_zarr_store
+from history2CMIParchive.profiling import enable_profiling
+from history2CMIParchive.cluster import scheduler_spec
+from history2CMIParchive.regions import check_region_options
 import warnings
+import sys
 import argparse
 
 parser = argparse.ArgumentParser(description='convert history tar file to \
                                               zarr stores')
 
-parser.add_argument('-i', '--archive', type=str, required=True,
-                    help="input tar file")
+parser.add_argument('-i', '--archive', type=str, nargs='+', required=True,
+                    help="input tar file(s), '-' for stdin (with --stream). \
+                          Several consecutive archives are converted in \
+                          batches")
 
 parser.add_argument('-o', '--outputdir', type=str, required=True,
                     help="path to output zarr store")
@@ -20,7 +27,7 @@ parser.add_argument('-s', '--storetype', type=str, required=True,
                     default='directory', help="zarr store type")
 
 parser.add_argument('-d', '--domain', type=str, required=True,
-                    default='OM4', help="model domain")
+                    default='OM4', help="model domain (auto: planned chunks)")
 
 parser.add_argument('-O', '--overwrite', type=bool, required=False,
                     default=False, help="overwrite stores")
@@ -52,16 +59,141 @@ parser.add_argument('-D', '--debug', type=bool, required=False,
 parser.add_argument('-Y', '--write_yaml', type=bool, required=False,
                     default=True, help="write companion yaml file")
 
-parser.add_argument("--Wall", help='show warnings')
+parser.add_argument('-X', '--indexdir', type=str, required=False,
+                    default=None, help="cache directory for tar index")
+
+parser.add_argument('--no-extract', dest='extract', action='store_false',
+                    help="read members in place from uncompressed tar \
+                          instead of extracting them to workdir")
+
+parser.add_argument('--stream', action='store_true',
+                    help="read the archive in a single sequential pass \
+                          (compressed archives, pipes, single archive)")
+
+parser.add_argument('-j', '--jobs', type=int, required=False,
+                    default=1, help="number of workers writing variables")
+
+parser.add_argument('--parallel', type=str, required=False,
+                    default='thread', choices=['thread', 'process'],
+                    help="type of workers (thread/process)")
+
+parser.add_argument('-n', '--nprocs', type=int, required=False,
+                    default=1, help="number of processes converting members \
+                                     (single archive)")
+
+parser.add_argument('--batch-years', dest='batch_years', type=int,
+                    required=False, default=None,
+                    help="number of archives appended at once")
+
+parser.add_argument('--batch-bytes', dest='batch_bytes', type=int,
+                    required=False, default=None,
+                    help="size of netcdf members appended at once")
+
+parser.add_argument('--zip-append', dest='zip_append', type=str,
+                    required=False, default='inplace',
+                    choices=['inplace', 'rewrite'],
+                    help="append to zip stores in place or rewrite them")
+
+parser.add_argument('--chunk-target', dest='chunk_target', type=int,
+                    required=False, default=32 * 1024 * 1024,
+                    help="chunk size in bytes aimed at with domain auto")
 
-args = parser.parse_args()
+parser.add_argument('--compressor', type=str, required=False,
+                    default=None,
+                    help="blosc codec of new stores, e.g. zstd:3:bitshuffle")
 
-if not args.Wall:
-    warnings.filterwarnings("ignore")
+parser.add_argument('--codec-override', dest='codec_override', nargs='+',
+                    required=False, default=None,
+                    help="codec of some variables, e.g. thetao=lz4:5:shuffle")
 
-# build kwargs from args
-kwargs = vars(args)
-kwargs.pop('ignore', None)
-kwargs.pop('Wall', None)
+parser.add_argument('--recall-command', dest='recall_command', type=str,
+                    required=False, default=None,
+                    help="batched tape recall command, {files} is replaced "
+                         "by the zip stores (default: the one of the site)")
+
+parser.add_argument('--history-backend', dest='history_backend', type=str,
+                    required=False, default='yaml', choices=['yaml', 'sqlite'],
+                    help="build history in yaml files or in a sqlite catalog")
+
+parser.add_argument('--preallocate', type=int, nargs=2, required=False,
+                    default=None, metavar=('FIRSTYEAR', 'LASTYEAR'),
+                    help="create the (directory) stores for the whole run \
+                          and write the region of each year, years can \
+                          then be converted in any order and concurrently")
+
+parser.add_argument('--max-mem', dest='max_mem', type=int, required=False,
+                    default=None,
+                    help="memory budget in bytes: larger variables are \
+                          written by slabs, peak memory is reported \
+                          (not with --preallocate)")
+
+parser.add_argument('--scheduler', dest='scheduler_address', type=str,
+                    required=False, default=None,
+                    help="address of a running dask scheduler")
+
+parser.add_argument('--dask-workers', dest='dask_workers', type=int,
+                    required=False, default=None,
+                    help="number of workers of a local dask cluster")
+
+parser.add_argument('--dask-threads', dest='dask_threads', type=int,
+                    required=False, default=1,
+                    help="threads per worker of the local dask cluster")
+
+parser.add_argument('--dask-memory-limit', dest='dask_memory_limit',
+                    type=str, required=False, default='auto',
+                    help="memory limit per worker of the local dask "
+                         "cluster, e.g. 4GB (a worker going over it is "
+                         "restarted, see --max-mem to bound the writes)")
+
+parser.add_argument('--profile', type=str, nargs='?', required=False,
+                    default=None, const='profile.jsonl',
+                    help="record stage timings in a json lines file")
+
+parser.add_argument("--Wall", help='show warnings')
 
-convert_archive_to_zarr_store(**kwargs)
+# worker processes (spawned) re-import this script
+if __name__ == '__main__':
+    args = parser.parse_args()
+    try:
+        check_region_options(args.preallocate, args.max_mem)
+    except ValueError as e:
+        parser.error(str(e))
+    if len(args.archive) > 1 and args.stream:
+        parser.error('--stream reads a single archive, several archives '
+                     'are converted in batches')
+    if len(args.archive) > 1 and args.nprocs > 1:
+        parser.error('-n/--nprocs converts the members of a single archive, '
+                     'use -j/--jobs with several archives')
+
+    if not args.Wall:
+        warnings.filterwarnings("ignore")
+
+    # build kwargs from args
+    kwargs = vars(args)
+    ignore = kwargs.pop('ignore', None)
+    if ignore is not None:
+        kwargs['ignore_types'] = ignore
+    kwargs.pop('Wall', None)
+    profile = kwargs.pop('profile', None)
+    if profile is not None:
+        enable_profiling(profile)
+    kwargs['scheduler'] = scheduler_spec(
+        address=kwargs.pop('scheduler_address'),
+        workers=kwargs.pop('dask_workers'),
+        threads_per_worker=kwargs.pop('dask_threads'),
+        memory_limit=kwargs.pop('dask_memory_limit'))
+    overrides = kwargs.pop('codec_override', None)
+    if overrides is not None:
+        kwargs['codec_overrides'] = dict(item.split('=') for item in overrides)
+
+    archives = kwargs.pop('archive')
+    if len(archives) > 1:
+        kwargs.pop('stream')
+        kwargs.pop('nprocs')
+        errors = convert_archives_to_zarr_store(archives=archives, **kwargs)
+    else:
+        kwargs.pop('batch_years')
+        kwargs.pop('batch_bytes')
+        errors = convert_archive_to_zarr_store(archive=archives[0], **kwargs)
+    if len(errors) > 0:
+        sys.exit(1)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+from history2CMIParchive.pipeline import convert_year_range
+from history2CMIParchive.pipeline import default_archive_pattern
+from history2CMIParchive.profiling import enable_profiling
+from history2CMIParchive.cluster import scheduler_spec
+import warnings
+import sys
+import argparse
+
+parser = argparse.ArgumentParser(description='convert a range of yearly \
+                                              history tar files to zarr \
+                                              stores, prefetching the next \
+                                              years during the conversion')
+
+parser.add_argument('-H', '--historydir', type=str, required=True,
+                    help="path to history tar files")
+
+parser.add_argument('-o', '--outputdir', type=str, required=True,
+                    help="path to output zarr store")
+
+parser.add_argument('-w', '--workdir', type=str, required=True,
+                    help="path to scratch dir for extracted nc")
+
+parser.add_argument('-y', '--years', type=int, nargs=2, required=True,
+                    help="first and last year to convert")
+
+parser.add_argument('-s', '--storetype', type=str, required=False,
+                    default='directory', help="zarr store type")
+
+parser.add_argument('-d', '--domain', type=str, required=False,
+                    default='OM4', help="model domain (auto: planned chunks)")
+
+parser.add_argument('-L', '--lookahead', type=int, required=False,
+                    default=1, help="years prefetched ahead of conversion")
+
+parser.add_argument('--scratch-limit', dest='scratch_limit', type=int,
+                    required=False, default=None,
+                    help="bytes of extracted files allowed in workdir")
+
+parser.add_argument('--archive-pattern', dest='archive_pattern', type=str,
+                    required=False, default=default_archive_pattern,
+                    help="name of the archive of a year")
+
+parser.add_argument('-G', '--grid', type=str, required=False,
+                    default='gn', help="grid type (gn/gr)")
+
+parser.add_argument('-t', '--tag', type=str, required=False,
+                    default='v1', help="model version tag")
+
+parser.add_argument('-S', '--site', type=str, required=False,
+                    default='gfdl', help="site specific")
+
+parser.add_argument('--recall-command', dest='recall_command', type=str,
+                    required=False, default=None,
+                    help="tape recall command, {files} is replaced by the "
+                         "files (default: the one of the site)")
+
+parser.add_argument('-I', '--ignore', nargs='+', required=False,
+                    help="types to be ignored")
+
+parser.add_argument('-X', '--indexdir', type=str, required=False,
+                    default=None, help="directory of the tar indexes")
+
+parser.add_argument('-j', '--jobs', type=int, required=False,
+                    default=1, help="number of workers writing variables")
+
+parser.add_argument('-n', '--nprocs', type=int, required=False,
+                    default=1, help="number of processes converting members")
+
+parser.add_argument('--zip-append', dest='zip_append', type=str,
+                    required=False, default='inplace',
+                    choices=['inplace', 'rewrite'],
+                    help="append to zip stores in place or rewrite them")
+
+parser.add_argument('--compressor', type=str, required=False,
+                    default=None,
+                    help="blosc codec of new stores, e.g. zstd:3:bitshuffle")
+
+parser.add_argument('--history-backend', dest='history_backend', type=str,
+                    required=False, default='yaml', choices=['yaml', 'sqlite'],
+                    help="build history in yaml files or in a sqlite catalog")
+
+parser.add_argument('--max-mem', dest='max_mem', type=int, required=False,
+                    default=None,
+                    help="memory budget in bytes: larger variables are \
+                          written by slabs, peak memory is reported")
+
+parser.add_argument('--scheduler', dest='scheduler_address', type=str,
+                    required=False, default=None,
+                    help="address of a running dask scheduler")
+
+parser.add_argument('--dask-workers', dest='dask_workers', type=int,
+                    required=False, default=None,
+                    help="number of workers of a local dask cluster")
+
+parser.add_argument('--dask-threads', dest='dask_threads', type=int,
+                    required=False, default=1,
+                    help="threads per worker of the local dask cluster")
+
+parser.add_argument('--dask-memory-limit', dest='dask_memory_limit',
+                    type=str, required=False, default='auto',
+                    help="memory limit per worker of the local dask "
+                         "cluster, e.g. 4GB (a worker going over it is "
+                         "restarted, see --max-mem to bound the writes)")
+
+parser.add_argument('--profile', type=str, nargs='?', required=False,
+                    default=None, const='profile.jsonl',
+                    help="record stage timings in a json lines file")
+
+parser.add_argument('-D', '--debug', type=bool, required=False,
+                    default=False, help="print debug information")
+
+parser.add_argument("--Wall", help='show warnings')
+
+# worker processes (spawned) re-import this script
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if not args.Wall:
+        warnings.filterwarnings("ignore")
+
+    kwargs = vars(args)
+    ignore = kwargs.pop('ignore', None)
+    if ignore is not None:
+        kwargs['ignore_types'] = ignore
+    kwargs.pop('Wall', None)
+    profile = kwargs.pop('profile', None)
+    if profile is not None:
+        enable_profiling(profile)
+    kwargs['scheduler'] = scheduler_spec(
+        address=kwargs.pop('scheduler_address'),
+        workers=kwargs.pop('dask_workers'),
+        threads_per_worker=kwargs.pop('dask_threads'),
+        memory_limit=kwargs.pop('dask_memory_limit'))
+    firstyear, lastyear = kwargs.pop('years')
+
+    errors = convert_year_range(firstyear=firstyear, lastyear=lastyear,
+                                **kwargs)
+    if len(errors) > 0:
+        sys.exit(1)
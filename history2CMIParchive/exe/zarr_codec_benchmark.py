@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+from history2CMIParchive.datasets import define_component_code
+from history2CMIParchive.datasets import chunk_choice
+from history2CMIParchive.datasets import open_dataset
+from history2CMIParchive.chunk_planner import read_chunks
+from history2CMIParchive.chunk_planner import plan_dataset_chunks
+from history2CMIParchive.encoding import benchmark_codecs
+from history2CMIParchive.encoding import default_candidates
+import warnings
+import argparse
+import yaml
+
+parser = argparse.ArgumentParser(description='compare compression codecs \
+                                              on chunks of a history file')
+
+parser.add_argument('-i', '--ncfile', type=str, required=True,
+                    help="input netcdf file")
+
+parser.add_argument('-d', '--domain', type=str, required=False,
+                    default='OM4p25',
+                    help="model domain (auto: planned chunks)")
+
+parser.add_argument('-c', '--codecs', nargs='+', required=False,
+                    default=default_candidates,
+                    help="codecs to compare, as cname:clevel:shuffle")
+
+parser.add_argument('-v', '--variables', nargs='+', required=False,
+                    default=None, help="variables to test (default: all)")
+
+parser.add_argument('-n', '--nsample', type=int, required=False,
+                    default=4, help="number of chunks sampled per variable")
+
+parser.add_argument('-T', '--timedim', type=str, required=False,
+                    default='time', help="name of time dimension")
+
+parser.add_argument('--chunk-target', dest='chunk_target', type=int,
+                    required=False, default=32 * 1024 * 1024,
+                    help="chunk size in bytes aimed at with domain auto")
+
+parser.add_argument('-o', '--output', type=str, required=False,
+                    default=None, help="write the report to a yaml file")
+
+parser.add_argument("--Wall", help='show warnings')
+
+args = parser.parse_args()
+
+if not args.Wall:
+    warnings.filterwarnings("ignore")
+
+# sample the chunks the stores would be written with
+if args.domain == 'auto':
+    ds = open_dataset(args.ncfile, read_chunks(timedim=args.timedim))
+    plans = plan_dataset_chunks(ds, timedim=args.timedim,
+                                target_bytes=args.chunk_target)
+    for variable in ds.data_vars:
+        ds[variable] = ds[variable].chunk(plans[variable])
+else:
+    component_code = define_component_code(args.ncfile, timedim=args.timedim)
+    ds = open_dataset(args.ncfile, chunk_choice(component_code,
+                                                domain=args.domain))
+
+report = benchmark_codecs(ds, candidates=args.codecs,
+                          variables=args.variables, nsample=args.nsample)
+ds.close()
+
+print(f'{"variable":<20} {"codec":<20} {"ratio":>8} '
+      f'{"comp MB/s":>10} {"decomp MB/s":>12}')
+for record in report:
+    print(f'{record["variable"]:<20} {record["codec"]:<20} '
+          f'{record["ratio"]:8.2f} {record["compress_MBps"]:10.1f} '
+          f'{record["decompress_MBps"]:12.1f}')
+
+if args.output is not None:
+    with open(args.output, 'w') as fnew:
+        yaml.dump(report, fnew, default_flow_style=False)
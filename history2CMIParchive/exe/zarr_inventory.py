@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+from history2CMIParchive.inventory import inventory_stores
+from history2CMIParchive.inventory import write_inventory
+from history2CMIParchive.zarr_stores import time_rtol
+import warnings
+import sys
+import argparse
+
+parser = argparse.ArgumentParser(description='inventory of the zarr stores \
+                                              and audit of their time axis')
+
+parser.add_argument('-o', '--outputdir', type=str, required=True,
+                    help="root of the zarr stores")
+
+parser.add_argument('-f', '--csvfile', type=str, required=True,
+                    help="inventory table (csv)")
+
+parser.add_argument('-j', '--jobs', type=int, required=False, default=1,
+                    help="number of stores inspected concurrently")
+
+parser.add_argument('-p', '--parallel', type=str, required=False,
+                    default='thread', choices=['thread', 'process'],
+                    help="pool inspecting the stores")
+
+parser.add_argument('-r', '--rtol', type=float, required=False,
+                    default=time_rtol,
+                    help="relative tolerance on the time step")
+
+parser.add_argument('-D', '--debug', type=bool, required=False,
+                    help="print debug information")
+
+parser.add_argument("--Wall", help='show warnings')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if not args.Wall:
+        warnings.filterwarnings("ignore")
+
+    rows = inventory_stores(args.outputdir, jobs=args.jobs,
+                            parallel=args.parallel, rtol=args.rtol,
+                            debug=args.debug)
+    write_inventory(rows, args.csvfile)
+
+    flagged = [row for row in rows if row['flags'] != '']
+    for row in flagged:
+        store = row['store'] if row['store'] is not None else \
+            '/'.join([row['component'], row['variable'], row['grid'],
+                      row['tag']])
+        print(f'{store}: {row["flags"]}')
+    print(f'{len(rows)} stores, {len(flagged)} flagged')
+    if len(flagged) > 0:
+        sys.exit(1)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+from history2CMIParchive.rechunk import rechunk_store
+import warnings
+import argparse
+
+parser = argparse.ArgumentParser(description='write a rechunked copy of a \
+                                              zarr store, e.g. for analysis')
+
+parser.add_argument('-i', '--storepath', type=str, required=True,
+                    help="path to the store")
+
+parser.add_argument('-v', '--varname', type=str, required=True,
+                    help="variable of the store")
+
+parser.add_argument('-c', '--chunks', nargs='+', required=True,
+                    help="target chunks as dim=size, size -1 for full dim")
+
+parser.add_argument('-s', '--storetype', type=str, required=False,
+                    default='directory', help="zarr store type")
+
+parser.add_argument('-L', '--layout', type=str, required=False,
+                    default='analysis', help="name of the new layout")
+
+parser.add_argument('-M', '--max-mem', dest='max_mem', type=int,
+                    required=False, default=512 * 1024 * 1024,
+                    help="memory budget in bytes")
+
+parser.add_argument('-w', '--tmpdir', type=str, required=False,
+                    default=None, help="directory for intermediate store")
+
+parser.add_argument('-C', '--consolidated', type=bool, required=False,
+                    default=True, help="use consolidated zarr metadata")
+
+parser.add_argument('-D', '--debug', type=bool, required=False,
+                    help="print debug information")
+
+parser.add_argument("--Wall", help='show warnings')
+
+args = parser.parse_args()
+
+if not args.Wall:
+    warnings.filterwarnings("ignore")
+
+# build kwargs from args
+kwargs = vars(args)
+kwargs.pop('Wall', None)
+chunks = {}
+for item in kwargs.pop('chunks'):
+    dim, size = item.split('=')
+    chunks[dim] = int(size)
+
+fout = rechunk_store(target_chunks=chunks, **kwargs)
+print(f'rechunked store written to {fout}')
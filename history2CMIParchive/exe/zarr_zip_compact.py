@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+from history2CMIParchive.zarr_stores import compact_store
+import warnings
+import sys
+import os
+import argparse
+
+parser = argparse.ArgumentParser(description='compact zarr zip stores, \
+                                              removing superseded members')
+
+parser.add_argument('-i', '--stores', type=str, nargs='+', required=True,
+                    help="zip stores, or directories searched for zip stores")
+
+parser.add_argument('-S', '--site', type=str, required=False,
+                    default='gfdl', help="site specific")
+
+parser.add_argument('-D', '--debug', type=bool, required=False,
+                    help="print debug information")
+
+parser.add_argument("--Wall", help='show warnings')
+
+args = parser.parse_args()
+
+if not args.Wall:
+    warnings.filterwarnings("ignore")
+
+# zip stores given directly or found under the directories
+fstores = []
+for path in args.stores:
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            for f in sorted(files):
+                if f.endswith('.zip'):
+                    fstores.append(os.path.join(root, f))
+    else:
+        fstores.append(path)
+
+failed = False
+total = 0
+for fstore in fstores:
+    storepath = os.path.dirname(os.path.abspath(fstore))
+    varname = os.path.basename(fstore).replace('.zip', '')
+    try:
+        report = compact_store(storepath, varname, site=args.site,
+                               debug=args.debug)
+    except Exception as e:
+        print(f'ERROR: cannot compact {fstore}: {e}')
+        failed = True
+        continue
+    total += report['bytes_reclaimed']
+    print(f'{fstore}: {report["bytes_before"]} -> {report["bytes_after"]} '
+          f'bytes, open {report["open_time_before"]:.3f}s -> '
+          f'{report["open_time_after"]:.3f}s')
+print(f'{total} bytes reclaimed in {len(fstores)} stores')
+if failed:
+    sys.exit(1)
@@ -0,0 +1,240 @@
+import zarr as _zarr
+import numpy as _np
+import glob
+import csv
+import os
+import multiprocessing as _mp
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+from .zarr_stores import time_rtol
+from .zarr_stores import store_name
+from .transactions import journal_path
+
+# columns of the inventory table
+inventory_columns = ['component', 'variable', 'grid', 'tag', 'storetype',
+                     'store', 'dims', 'shape', 'chunks', 'dtype', 'nt',
+                     'time_first', 'time_last', 'time_units', 'time_step',
+                     'gaps', 'duplicates', 'decreasing', 'irregular',
+                     'bytes', 'files', 'flags', 'error']
+
+
+def find_stores(outputdir):
+    """ stores of the tree {outputdir}/{code}/{var}/{grid}/{tag}. Only the
+    tag directories are listed, not the content of the stores. A store
+    only left as {store}_tmp (incomplete write of previous versions) is
+    listed with storetype None.
+
+    PARAMETERS:
+    ===========
+
+    outputdir: str
+        root of the zarr stores
+
+    RETURNS:
+    ========
+
+    stores: list
+        dict with component, variable, grid, tag, storepath, storetype
+    """
+    stores = []
+    for storepath in sorted(glob.glob(f'{outputdir}/*/*/*/*/')):
+        storepath = storepath.rstrip('/')
+        code, varname, grid, tag = storepath.split('/')[-4:]
+        entry = {'component': code, 'variable': varname, 'grid': grid,
+                 'tag': tag, 'storepath': storepath}
+        found = False
+        for storetype in ['directory', 'zip']:
+            fstore = store_name(storepath, varname, storetype)
+            if os.path.exists(fstore):
+                stores.append(dict(entry, storetype=storetype))
+                found = True
+        if not found:
+            for storetype in ['directory', 'zip']:
+                fstore = store_name(storepath, varname, storetype)
+                if os.path.exists(f'{fstore}_tmp'):
+                    stores.append(dict(entry, storetype=None))
+                    break
+    return stores
+
+
+def audit_time_axis(times, rtol=time_rtol):
+    """ check the continuity of a whole time axis, in one pass over its
+    steps. Each step is compared to the typical (median) step with the
+    tolerance of zarr_stores.appending_needed: larger steps are gaps,
+    smaller ones irregular.
+
+    PARAMETERS:
+    ===========
+
+    times: numpy.ndarray
+        values of the time axis
+    rtol: float
+        relative tolerance on the time step
+
+    RETURNS:
+    ========
+
+    audit: dict
+        nt, first, last, step and number of gaps, duplicates (zero steps),
+        decreasing (negative steps) and irregular steps
+    """
+    times = _np.asarray(times, dtype='f8')
+    audit = {'nt': len(times), 'first': None, 'last': None, 'step': None,
+             'gaps': 0, 'duplicates': 0, 'decreasing': 0, 'irregular': 0}
+    if len(times) == 0:
+        return audit
+    audit['first'] = times[0].item()
+    audit['last'] = times[-1].item()
+    steps = _np.diff(times)
+    audit['duplicates'] = int(_np.count_nonzero(steps == 0))
+    audit['decreasing'] = int(_np.count_nonzero(steps < 0))
+    positive = steps[steps > 0]
+    if len(positive) > 0:
+        step = _np.median(positive)
+        audit['step'] = step.item()
+        audit['gaps'] = int(_np.count_nonzero(positive >= step * (1 + rtol)))
+        audit['irregular'] = int(_np.count_nonzero(positive <=
+                                                   step * (1 - rtol)))
+    return audit
+
+
+def store_usage(fstore):
+    """ bytes and number of files on disk of a zip or directory store """
+    if not os.path.isdir(fstore):
+        return os.path.getsize(fstore), 1
+    size, nfiles = 0, 0
+    for root, dirs, files in os.walk(fstore):
+        for f in files:
+            size += os.path.getsize(os.path.join(root, f))
+            nfiles += 1
+    return size, nfiles
+
+
+def inspect_store(entry, concat_dim='time', rtol=time_rtol):
+    """ inventory row of a store (see find_stores), from its consolidated
+    metadata and its time coordinate only """
+    storepath, varname = entry['storepath'], entry['variable']
+    storetype = entry['storetype']
+    row = {column: None for column in inventory_columns}
+    for key in ['component', 'variable', 'grid', 'tag', 'storetype']:
+        row[key] = entry[key]
+    flags = []
+    for candidate in ['directory', 'zip']:
+        fstore = store_name(storepath, varname, candidate)
+        if os.path.exists(f'{fstore}_tmp'):
+            flags.append('tmp_store')
+            break
+    if storetype is None:
+        row['error'] = 'missing store'
+        row['flags'] = ';'.join(flags)
+        return row
+
+    fstore = store_name(storepath, varname, storetype)
+    row['store'] = fstore
+    if os.path.exists(journal_path(fstore)):
+        flags.append('journal')
+    row['bytes'], row['files'] = store_usage(fstore)
+    if storetype == 'zip':
+        store = _zarr.ZipStore(fstore, mode='r')
+    else:
+        store = _zarr.DirectoryStore(fstore)
+    try:
+        try:
+            group = _zarr.open_consolidated(store, mode='r')
+        except KeyError:
+            group = _zarr.open_group(store, mode='r')
+            flags.append('not_consolidated')
+        array = group[varname]
+        row['dims'] = array.attrs.get('_ARRAY_DIMENSIONS')
+        row['shape'] = list(array.shape)
+        row['chunks'] = list(array.chunks)
+        row['dtype'] = str(array.dtype)
+        if concat_dim in group:
+            time = group[concat_dim]
+            audit = audit_time_axis(time[:], rtol=rtol)
+            row['time_units'] = time.attrs.get('units')
+            for key in ['nt', 'gaps', 'duplicates', 'decreasing',
+                        'irregular']:
+                row[key] = audit[key]
+            for key in ['first', 'last', 'step']:
+                row[f'time_{key}'] = audit[key]
+            for key in ['gaps', 'duplicates', 'decreasing', 'irregular']:
+                if audit[key] > 0:
+                    flags.append(key)
+    except Exception as e:
+        row['error'] = f'{type(e).__name__}: {e}'
+        flags.append('unreadable')
+    finally:
+        if storetype == 'zip':
+            store.close()
+    row['flags'] = ';'.join(flags)
+    return row
+
+
+def inventory_stores(outputdir, jobs=1, parallel='thread', concat_dim='time',
+                     rtol=time_rtol, debug=False):
+    """ inventory and time axis audit of all the stores under outputdir.
+    Stores are inspected concurrently by a pool of jobs workers
+    (parallel = 'thread' or 'process').
+
+    PARAMETERS:
+    ===========
+
+    outputdir: str
+        root of the zarr stores
+    jobs: int
+        number of workers
+    parallel: str
+        'thread' or 'process'
+    concat_dim: str
+        name of the time dimension
+    rtol: float
+        relative tolerance on the time step (see audit_time_axis)
+    debug: bool
+        print debug information
+
+    RETURNS:
+    ========
+
+    rows: list
+        one dict per store, with the inventory_columns keys
+    """
+    stores = find_stores(outputdir)
+    if debug:
+        print(f'{len(stores)} stores found under {outputdir}')
+    kwargs = {'concat_dim': concat_dim, 'rtol': rtol}
+    if jobs > 1:
+        if parallel == 'process':
+            executor = ProcessPoolExecutor(max_workers=jobs,
+                                           mp_context=_mp.get_context('spawn'))
+        else:
+            executor = ThreadPoolExecutor(max_workers=jobs)
+        futures = [executor.submit(inspect_store, entry, **kwargs)
+                   for entry in stores]
+        rows = [future.result() for future in futures]
+        executor.shutdown()
+    else:
+        rows = [inspect_store(entry, **kwargs) for entry in stores]
+    return rows
+
+
+def write_inventory(rows, csvfile):
+    """ write the inventory as a csv table, one row per store. Shapes and
+    chunks are written as 12x35x180x360, dims as time,z_l,yh,xh """
+    def cell(key, value):
+        if value is None:
+            return ''
+        if key == 'dims':
+            return ','.join(value)
+        if isinstance(value, list):
+            return 'x'.join([str(v) for v in value])
+        return value
+
+    with open(f'{csvfile}.tmp', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=inventory_columns)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({key: cell(key, row[key]) for key in
+                             inventory_columns})
+    os.replace(f'{csvfile}.tmp', csvfile)
+    return None
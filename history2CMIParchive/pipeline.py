@@ -0,0 +1,202 @@
+import threading
+import shutil
+import os
+from .tar_utilities import get_tar_index
+from .tar_utilities import stream_ncfiles_from_archive
+from .tar_utilities import is_ignored
+from .datasets import convert_archive_to_zarr_store
+from .datasets import extract_member
+from .datasets import error_record
+from .site_specific import recall_from_tape
+from .site_specific import finish_recall
+from .profiling import stage
+from .cluster import open_client
+from .cluster import close_client
+
+# name of the yearly history archives
+default_archive_pattern = '{year:04d}0101.nc.tar'
+
+
+def convert_year_range(historydir, outputdir, workdir, firstyear, lastyear,
+                       lookahead=1, scratch_limit=None,
+                       archive_pattern=default_archive_pattern,
+                       ignore_types=[], site=None, recall_command=None,
+                       indexdir=None, scheduler=None, debug=False,
+                       **kwargs):
+    """ convert the yearly archives of a run, from firstyear to lastyear,
+    as a pipeline: while a year is converted, the next ones are recalled
+    from tape and extracted by a prefetch thread. Years are converted one
+    after the other, so each store is appended to in year order.
+
+    PARAMETERS:
+    ===========
+
+    historydir: str
+        directory of the history archives
+    outputdir: str
+        root of the zarr stores
+    workdir: str
+        scratch directory, each year is extracted into {workdir}/{year}
+    firstyear, lastyear: int
+        range of years to convert
+    lookahead: int
+        number of years prefetched ahead of the one being converted
+    scratch_limit: int
+        bytes of extracted members allowed in workdir (the year being
+        converted is always allowed), None for no limit
+    archive_pattern: str
+        name of the archive of a year
+    ignore_types: list
+        member types that are not extracted nor converted
+    site: str
+        tape system of the site (see site_specific)
+    recall_command: str
+        tape recall command, overrides the one of the site
+    indexdir: str
+        directory of the tar indexes, defaults to {workdir}/.index
+    scheduler: str or dict
+        dask cluster converting the members, started once for all the
+        years (see cluster.open_client)
+    debug: bool
+        print debug information
+    kwargs:
+        options of convert_archive_to_zarr_store
+
+    RETURNS:
+    ========
+
+    errors: list
+        conversion errors. If a year cannot be recalled or extracted, the
+        conversion stops there (later years cannot be appended before it)
+    """
+    years = list(range(firstyear, lastyear + 1))
+    archives = [os.path.join(historydir, archive_pattern.format(year=year))
+                for year in years]
+    if indexdir is None:
+        indexdir = f'{workdir}/.index'
+    prefetch_kwargs = {'lookahead': lookahead,
+                       'scratch_limit': scratch_limit,
+                       'ignore_types': ignore_types, 'site': site,
+                       'recall_command': recall_command,
+                       'indexdir': indexdir, 'debug': debug}
+
+    # prefetched years, by archive: (directory, bytes) or the exception
+    state = {'ready': {}, 'pending': 0, 'scratch': 0, 'stop': False}
+    client = open_client(scheduler, local_directory=workdir, debug=debug)
+    condition = threading.Condition()
+    prefetcher = threading.Thread(target=prefetch_archives,
+                                  args=(years, archives, workdir, state,
+                                        condition),
+                                  kwargs=prefetch_kwargs)
+    prefetcher.start()
+
+    errors = []
+    try:
+        for archive in archives:
+            with condition:
+                condition.wait_for(lambda: archive in state['ready'])
+                entry = state['ready'].pop(archive)
+            if isinstance(entry, Exception):
+                errors.append(error_record(archive, None, entry))
+                break
+            yeardir, nbytes = entry
+            if debug:
+                print(f'converting {archive}')
+            with stage('convert_archive', file=os.path.basename(archive),
+                       bytes_read=nbytes):
+                errors += convert_archive_to_zarr_store(
+                    archive=archive, outputdir=outputdir, workdir=yeardir,
+                    ignore_types=ignore_types, site=site,
+                    recall_command=recall_command, indexdir=indexdir,
+                    scheduler=client, debug=debug, prefetched=True,
+                    **kwargs)
+            shutil.rmtree(yeardir)
+            with condition:
+                state['pending'] -= 1
+                state['scratch'] -= nbytes
+                condition.notify_all()
+    finally:
+        with condition:
+            state['stop'] = True
+            condition.notify_all()
+        prefetcher.join()
+        close_client(client, scheduler)
+        # prefetched but not converted
+        for entry in state['ready'].values():
+            if not isinstance(entry, Exception):
+                shutil.rmtree(entry[0], ignore_errors=True)
+    return errors
+
+
+def prefetch_archives(years, archives, workdir, state, condition,
+                      lookahead=1, scratch_limit=None, ignore_types=[],
+                      site=None, recall_command=None, indexdir=None,
+                      debug=False):
+    """ recall and extract the archives in order, as far ahead of the
+    conversion as lookahead and scratch_limit allow (prefetch thread of
+    convert_year_range). The recalls of the look-ahead window are issued
+    early so the tape works while the disk extracts. """
+    recalls = {}
+    for k, (year, archive) in enumerate(zip(years, archives)):
+        try:
+            for ahead in archives[k:k + lookahead + 1]:
+                if ahead not in recalls:
+                    recalls[ahead] = recall_from_tape([ahead], site=site,
+                                                      command=recall_command,
+                                                      debug=debug)
+            with stage('recall_archive', file=os.path.basename(archive)):
+                check = finish_recall(recalls.pop(archive))
+            if check != 0:
+                raise IOError(f'recall of {archive} failed ({check})')
+            index = get_tar_index(archive, cachedir=indexdir, debug=debug)
+            members = [member for member in index['members']
+                       if member['name'].endswith('.nc') and
+                       not is_ignored(member['name'], ignore_types)]
+            nbytes = sum([member['size'] for member in members])
+
+            # wait for the conversion to catch up
+            with condition:
+                condition.wait_for(
+                    lambda: state['stop'] or
+                    room_for_archive(state['pending'], state['scratch'],
+                                     nbytes, lookahead, scratch_limit))
+                if state['stop']:
+                    break
+                state['pending'] += 1
+                state['scratch'] += nbytes
+
+            yeardir = f'{workdir}/{year:04d}'
+            os.makedirs(yeardir, exist_ok=True)
+            if debug:
+                print(f'prefetching {archive} into {yeardir}')
+            if index['compression'] is not None:
+                # read once front to back rather than once per member
+                for ncfile in stream_ncfiles_from_archive(
+                        archive, yeardir, ignore_types=ignore_types):
+                    pass
+            else:
+                for member in members:
+                    extract_member(archive, member['name'], yeardir, index)
+            entry = (yeardir, nbytes)
+        except Exception as e:
+            entry = e
+        with condition:
+            state['ready'][archive] = entry
+            condition.notify_all()
+        if isinstance(entry, Exception):
+            break
+    for recall in recalls.values():
+        finish_recall(recall)
+    return None
+
+
+def room_for_archive(pending, scratch, nbytes, lookahead=1,
+                     scratch_limit=None):
+    """ can an archive of nbytes be extracted, with pending archives
+    extracted and not converted yet (using scratch bytes). The next
+    archive to convert is always let through. """
+    if pending == 0:
+        return True
+    if pending > lookahead:
+        return False
+    return scratch_limit is None or scratch + nbytes <= scratch_limit
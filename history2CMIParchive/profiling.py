@@ -0,0 +1,202 @@
+from contextlib import contextmanager
+import threading
+import socket
+import json
+import time
+import os
+
+# the profile file is passed through the environment so that the
+# worker processes of the conversion pools record into it as well
+profile_env = 'HISTORY2CMIPARCHIVE_PROFILE'
+
+_lock = threading.Lock()
+_context = threading.local()
+
+
+def enable_profiling(profile_file):
+    """ record the stages of the conversion as json lines in profile_file """
+    os.environ[profile_env] = os.path.abspath(profile_file)
+    return None
+
+
+def disable_profiling():
+    os.environ.pop(profile_env, None)
+    return None
+
+
+def profile_file():
+    """ path of the profile, None if profiling is disabled """
+    return os.environ.get(profile_env)
+
+
+@contextmanager
+def profile_context(**fields):
+    """ fields (e.g. file) added to the stages recorded by this thread """
+    previous = getattr(_context, 'fields', {})
+    _context.fields = dict(previous, **fields)
+    try:
+        yield
+    finally:
+        _context.fields = previous
+
+
+@contextmanager
+def stage(name, **fields):
+    """ time a stage of the conversion. The record is yielded so the
+    caller can add bytes_read, bytes_written, chunks... and is written to
+    the profile when the stage ends (if profiling is enabled)
+
+    PARAMETERS:
+    ===========
+
+    name: str
+        name of the stage, e.g. open_dataset
+    fields:
+        description of the stage, e.g. file, variable
+    """
+    record = dict(getattr(_context, 'fields', {}), **fields)
+    record['stage'] = name
+    path = profile_file()
+    if path is None:
+        yield record
+        return
+    start = time.perf_counter()
+    record['start'] = time.time()
+    try:
+        yield record
+    finally:
+        record['wall_time'] = time.perf_counter() - start - \
+            record.pop('untimed', 0.)
+        record['host'] = socket.gethostname()
+        record['pid'] = os.getpid()
+        write_record(path, record)
+
+
+@contextmanager
+def untimed(record):
+    """ leave the block out of the wall time of the stage of record, e.g.
+    measurements that are only made for the profile """
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['untimed'] = record.get('untimed', 0.) + \
+            time.perf_counter() - start
+
+
+@contextmanager
+def memory_sampler(record, interval=0.05, enabled=True):
+    """ sample the resident memory of the process while the block runs
+    and add rss_start, rss_peak and rss_end (bytes) to record. The memory
+    is the one of the whole process, tasks running in other threads at the
+    same time are included. Does nothing unless enabled. """
+    if not enabled:
+        yield record
+        return
+    # psutil is only needed when the memory is sampled
+    import psutil
+    process = psutil.Process()
+    record['rss_start'] = process.memory_info().rss
+    peak = [record['rss_start']]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            peak[0] = max(peak[0], process.memory_info().rss)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        yield record
+    finally:
+        done.set()
+        sampler.join()
+        record['rss_end'] = process.memory_info().rss
+        record['rss_peak'] = max(peak[0], record['rss_end'])
+
+
+def write_record(path, record):
+    """ append one json line to the profile """
+    line = json.dumps(record, default=str) + '\n'
+    with _lock:
+        with open(path, 'a') as f:
+            f.write(line)
+    return None
+
+
+def read_profile(path):
+    """ records of a profile """
+    records = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+    return records
+
+
+def summarize_profile(path, top=10):
+    """ aggregate a profile by stage and find its hot spots
+
+    PARAMETERS:
+    ===========
+
+    path: str
+        profile written with --profile
+    top: int
+        number of hot spots
+
+    RETURNS:
+    ========
+
+    summary: dict
+        stages: per stage count, total and max wall time, bytes read and
+        written, chunks, peak resident memory (sorted by total time)
+        hotspots: the top slowest records (stage, file, variable)
+        wall_time: span of the run
+    """
+    records = read_profile(path)
+    stages = {}
+    for record in records:
+        entry = stages.setdefault(record['stage'],
+                                  {'stage': record['stage'], 'count': 0,
+                                   'total_time': 0., 'max_time': 0.,
+                                   'bytes_read': 0, 'bytes_written': 0,
+                                   'chunks': 0, 'rss_peak': 0})
+        entry['count'] += 1
+        entry['total_time'] += record['wall_time']
+        entry['max_time'] = max(entry['max_time'], record['wall_time'])
+        for key in ['bytes_read', 'bytes_written', 'chunks']:
+            entry[key] += record.get(key, 0) or 0
+        entry['rss_peak'] = max(entry['rss_peak'],
+                                record.get('rss_peak', 0) or 0)
+    hotspots = sorted(records, key=lambda r: r['wall_time'],
+                      reverse=True)[:top]
+    if len(records) > 0:
+        wall_time = max(r['start'] + r['wall_time'] for r in records) - \
+            min(r['start'] for r in records)
+    else:
+        wall_time = 0.
+    return {'stages': sorted(stages.values(), key=lambda e: e['total_time'],
+                             reverse=True),
+            'hotspots': hotspots,
+            'wall_time': wall_time}
+
+
+def print_profile_summary(summary):
+    """ print the summary of a profile """
+    print(f'run wall time: {summary["wall_time"]:.2f}s')
+    print(f'{"stage":<20} {"count":>7} {"total s":>10} {"max s":>9} '
+          f'{"MB read":>10} {"MB written":>11} {"chunks":>8} '
+          f'{"peak MB":>9}')
+    for entry in summary['stages']:
+        print(f'{entry["stage"]:<20} {entry["count"]:>7} '
+              f'{entry["total_time"]:>10.2f} {entry["max_time"]:>9.2f} '
+              f'{entry["bytes_read"] / 1e6:>10.1f} '
+              f'{entry["bytes_written"] / 1e6:>11.1f} '
+              f'{entry["chunks"]:>8} {entry["rss_peak"] / 1e6:>9.1f}')
+    print('hot spots:')
+    for record in summary['hotspots']:
+        where = ' '.join(str(record[key]) for key in ['file', 'variable']
+                         if record.get(key) is not None)
+        print(f'  {record["wall_time"]:9.2f}s {record["stage"]:<20} {where}')
+    return None
@@ -0,0 +1,259 @@
+import xarray as _xr
+import zarr as _zarr
+import numpy as _np
+import itertools
+import datetime
+import yaml
+import math
+import os
+from .transactions import remove_path
+from .transactions import swap_in_store
+from .yaml_utils import update_yaml_layout
+
+# memory allowed for the block being copied (bytes)
+default_max_mem = 512 * 1024 * 1024
+
+
+def rechunk_store(storepath, varname, target_chunks, storetype='directory',
+                  layout='analysis', max_mem=default_max_mem, tmpdir=None,
+                  consolidated=True, debug=False):
+    """ write a copy of the store of varname with another chunking, e.g.
+    full time series of spatial tiles for analysis, next to the store
+    ({varname}.{layout} or {varname}.{layout}.zip)
+
+    blocks of at most max_mem bytes are copied one at a time. When the
+    target chunks cannot be built from blocks of source chunks within
+    max_mem, the copy goes through an intermediate store (chunked as the
+    smallest of source and target chunks). Progress is saved after each
+    block and an interrupted rechunk resumes where it stopped. The new
+    layout is recorded in the history yaml of the store.
+
+    PARAMETERS:
+    ===========
+
+    storepath: str
+        path to the source store
+    varname: str
+        variable of the store
+    target_chunks: dict
+        chunk size for each dimension, None or -1 for the full dimension,
+        dimensions not given keep their source chunks
+    storetype: str
+        zarr store type (directory, zip) of source and copy
+    layout: str
+        name of the layout
+    max_mem: int
+        memory budget in bytes
+    tmpdir: str
+        directory for the intermediate store, defaults to storepath
+    consolidated: bool
+        consolidate zarr metadata
+    debug: bool
+        print debug information
+
+    RETURNS:
+    ========
+
+    fout: str
+        path of the rechunked store
+    """
+    if storetype == 'directory':
+        fstore = f'{storepath}/{varname}'
+        fout = f'{storepath}/{varname}.{layout}'
+        source_store = _zarr.DirectoryStore(fstore)
+    elif storetype == 'zip':
+        fstore = f'{storepath}/{varname}.zip'
+        fout = f'{storepath}/{varname}.{layout}.zip'
+        source_store = _zarr.ZipStore(fstore, mode='r')
+    if tmpdir is None:
+        tmpdir = storepath
+    staging = f'{fout}.staging'
+    intermediate = f'{tmpdir}/{varname}.{layout}.intermediate'
+    progress_file = f'{fout}.rechunk.yml'
+
+    source = _zarr.open_group(source_store, mode='r')[varname]
+    dims = source.attrs['_ARRAY_DIMENSIONS']
+    shape = list(source.shape)
+    source_chunks = list(source.chunks)
+    chunks = [target_chunk(target_chunks.get(dim, c), n)
+              for dim, n, c in zip(dims, shape, source_chunks)]
+    itemsize = source.dtype.itemsize
+
+    # direct copy if blocks of whole source and target chunks fit
+    direct = copy_block(source_chunks, chunks, shape, itemsize, max_mem,
+                        grow=False)
+    if direct is not None:
+        stages = [('source', 'target', direct)]
+        intermediate_chunks = None
+    else:
+        intermediate_chunks = [min(s, t) for s, t in
+                               zip(source_chunks, chunks)]
+        stages = [('source', 'intermediate',
+                   copy_block(source_chunks, intermediate_chunks, shape,
+                              itemsize, max_mem)),
+                  ('intermediate', 'target',
+                   copy_block(intermediate_chunks, chunks, shape,
+                              itemsize, max_mem))]
+
+    plan = {'source': fstore, 'varname': varname, 'dims': list(dims),
+            'shape': shape, 'source_chunks': source_chunks,
+            'target_chunks': chunks,
+            'intermediate_chunks': intermediate_chunks,
+            'blocks': [stage[2] for stage in stages]}
+
+    progress = read_progress(progress_file)
+    # interrupted once the copy was complete and moved to {fout}.new
+    moved = progress is not None and progress['plan'] == plan and \
+        progress['stage'] == len(stages) and not os.path.exists(staging)
+    if moved:
+        if debug:
+            print(f'resuming rechunk of {fstore} at the swap of {fout}')
+    elif progress is None or progress['plan'] != plan:
+        # nothing to resume, or the source changed since
+        remove_path(staging)
+        remove_path(intermediate)
+        create_target(fstore, staging, varname, chunks, consolidated)
+        if intermediate_chunks is not None:
+            _zarr.create(shape=shape, chunks=intermediate_chunks,
+                         dtype=source.dtype, compressor=source.compressor,
+                         fill_value=source.fill_value,
+                         store=_zarr.DirectoryStore(intermediate))
+        progress = {'plan': plan, 'stage': 0, 'blocks_done': 0}
+        write_progress(progress_file, progress)
+    elif debug:
+        print(f'resuming rechunk of {fstore} at stage {progress["stage"]}, '
+              f'block {progress["blocks_done"]}')
+
+    if not moved:
+        arrays = {'source': source,
+                  'target': _zarr.open_group(_zarr.DirectoryStore(staging),
+                                             mode='r+')[varname]}
+        if intermediate_chunks is not None:
+            arrays['intermediate'] = _zarr.open_array(
+                _zarr.DirectoryStore(intermediate), mode='r+')
+
+        for kstage in range(progress['stage'], len(stages)):
+            src, dst, block = stages[kstage]
+            start = progress['blocks_done'] if kstage == progress['stage'] \
+                else 0
+            slices = list(block_slices(shape, block))
+            for kblock in range(start, len(slices)):
+                arrays[dst][slices[kblock]] = arrays[src][slices[kblock]]
+                progress['stage'] = kstage
+                progress['blocks_done'] = kblock + 1
+                write_progress(progress_file, progress)
+            if debug:
+                print(f'rechunk {src} -> {dst}: {len(slices)} blocks')
+            progress['stage'] = kstage + 1
+            progress['blocks_done'] = 0
+            write_progress(progress_file, progress)
+    if storetype == 'zip':
+        source_store.close()
+
+    # swap the copy in, same as transactions.replace_store
+    if storetype == 'directory' and not moved:
+        remove_path(f'{fout}.new')
+        os.rename(staging, f'{fout}.new')
+    elif storetype == 'zip' and not moved:
+        zipstore = _zarr.ZipStore(f'{fout}.new', mode='w')
+        _zarr.copy_store(_zarr.DirectoryStore(staging), zipstore)
+        zipstore.close()
+    swap_in_store(fout)
+    remove_path(staging)
+    remove_path(intermediate)
+    remove_path(progress_file)
+
+    description = {'store': fout, 'storetype': storetype,
+                   'chunks': dict(zip(dims, chunks)),
+                   'shape': dict(zip(dims, shape)),
+                   'date': datetime.datetime.now().isoformat()}
+    update_yaml_layout(storepath, varname, layout, description)
+    return fout
+
+
+def target_chunk(chunk, size):
+    """ chunk along one dimension, None or -1 is the full dimension """
+    if chunk is None or chunk == -1:
+        return int(size)
+    return int(min(chunk, size))
+
+
+def copy_block(read_chunks, write_chunks, shape, itemsize, max_mem,
+               grow=True):
+    """ shape of the blocks copied from an array chunked as read_chunks to
+    one chunked as write_chunks. Blocks are made of whole write chunks
+    and grown (grow=True) to whole read chunks where max_mem allows. With
+    grow=False, returns None unless blocks of whole read and write chunks
+    fit in max_mem. """
+    aligned = [min(lcm(r, w), n)
+               for r, w, n in zip(read_chunks, write_chunks, shape)]
+    if not grow:
+        return aligned if block_bytes(aligned, itemsize) <= max_mem \
+            else None
+    block = [min(w, n) for w, n in zip(write_chunks, shape)]
+    if block_bytes(block, itemsize) > max_mem:
+        raise ValueError(f'chunks {write_chunks} do not fit in '
+                         f'{max_mem} bytes')
+    for dim, size in enumerate(aligned):
+        trial = list(block)
+        trial[dim] = size
+        if block_bytes(trial, itemsize) <= max_mem:
+            block = trial
+    return block
+
+
+def lcm(a, b):
+    return a * b // math.gcd(a, b)
+
+
+def block_bytes(block, itemsize):
+    return itemsize * int(_np.prod(block))
+
+
+def block_slices(shape, block):
+    """ tuples of slices covering the array, block by block """
+    ranges = [range(0, n, b) for n, b in zip(shape, block)]
+    for starts in itertools.product(*ranges):
+        yield tuple(slice(s, min(s + b, n))
+                    for s, b, n in zip(starts, block, shape))
+
+
+def create_target(fstore, staging, varname, chunks, consolidated=True):
+    """ write the coordinates and metadata of the rechunked store, the
+    data of varname is copied block by block afterwards """
+    ds = _xr.open_zarr(fstore, decode_times=False,
+                       consolidated=consolidated)
+    template = ds.copy()
+    # everything but the variable is small, write it now
+    for name in template.variables:
+        if name != varname:
+            template[name] = template[name].load()
+    encoding = dict(template[varname].encoding)
+    encoding.pop('preferred_chunks', None)
+    encoding['chunks'] = tuple(chunks)
+    template[varname].encoding = {}
+    template[varname] = template[varname].chunk(
+        dict(zip(template[varname].dims, chunks)))
+    template.to_zarr(_zarr.DirectoryStore(staging), mode='w',
+                     compute=False, consolidated=consolidated,
+                     encoding={varname: encoding})
+    ds.close()
+    return None
+
+
+def read_progress(progress_file):
+    """ progress of an interrupted rechunk, None if there is none """
+    if not os.path.exists(progress_file):
+        return None
+    with open(progress_file) as f:
+        progress = yaml.load(f, Loader=yaml.FullLoader)
+        f.close()
+    return progress
+
+
+def write_progress(progress_file, progress):
+    """ save the progress of the rechunk atomically """
+    with open(f'{progress_file}.tmp', 'w') as fnew:
+        yaml.dump(progress, fnew, default_flow_style=False)
+    os.replace(f'{progress_file}.tmp', progress_file)
+    return None
@@ -0,0 +1,283 @@
+import xarray as _xr
+import zarr as _zarr
+import dask.array as _dsa
+import numpy as _np
+import yaml
+import os
+from .zarr_stores import store_lock
+from .zarr_stores import store_name
+from .transactions import remove_path
+from .transactions import replace_store
+from .encoding import make_compressor
+from .encoding import variable_encoding
+from .yaml_utils import update_yaml
+from .profiling import stage
+
+
+def regions_path(storepath, varname):
+    """ path of the completeness bitmap, next to the store """
+    return f'{storepath}/{varname}.regions.yml'
+
+
+def read_regions(storepath, varname):
+    """ completeness bitmap of a preallocated store: firstyear, lastyear,
+    records_per_year and filled (one character per year, 1 once the
+    region of the year is written). None if the store is not
+    preallocated. """
+    rfile = regions_path(storepath, varname)
+    if not os.path.exists(rfile):
+        return None
+    with open(rfile) as f:
+        regions = yaml.load(f, Loader=yaml.FullLoader)
+        f.close()
+    return regions
+
+
+def save_regions(storepath, varname, regions):
+    """ write the completeness bitmap atomically """
+    rfile = regions_path(storepath, varname)
+    with open(f'{rfile}.tmp', 'w') as fnew:
+        yaml.dump(regions, fnew, default_flow_style=False)
+    os.replace(f'{rfile}.tmp', rfile)
+    return None
+
+
+def missing_years(storepath, varname):
+    """ years of a preallocated store whose region is not written yet """
+    regions = read_regions(storepath, varname)
+    if regions is None:
+        return None
+    return [regions['firstyear'] + k
+            for k, bit in enumerate(regions['filled']) if bit == '0']
+
+
+def preallocated_template(da, nrecords, records_per_year, concat_dim='time',
+                          compressor=None):
+    """ dataset of the variable da extended to nrecords along concat_dim.
+    The variable is a lazy array that is never computed, coordinates along
+    concat_dim are filled with NaN until their region is written. Chunks
+    along concat_dim never span two years, so that regions of different
+    years can be written at the same time. """
+    varname = da.name
+    axis = da.dims.index(concat_dim)
+    shape = list(da.shape)
+    shape[axis] = nrecords
+    if da.chunks is not None:
+        chunks = [int(c[0]) for c in da.chunks]
+    else:
+        chunks = list(da.shape)
+    chunks[axis] = min(chunks[axis], records_per_year)
+    if records_per_year % chunks[axis] != 0:
+        raise ValueError(f'time chunk of {varname} ({chunks[axis]}) does '
+                         f'not divide the records of a year '
+                         f'({records_per_year})')
+
+    def filled(coord, cshape):
+        fill = _np.nan if coord.dtype.kind == 'f' else 0
+        return (coord.dims, _np.full(cshape, fill, dtype=coord.dtype),
+                coord.attrs)
+
+    coords = {}
+    for name, coord in da.coords.items():
+        if concat_dim in coord.dims:
+            coords[name] = filled(coord, [nrecords if dim == concat_dim
+                                          else coord.sizes[dim]
+                                          for dim in coord.dims])
+        else:
+            coords[name] = coord.load()
+    if varname in da.coords:
+        # store of a coordinate, e.g. time
+        template = _xr.Dataset(coords=coords)
+    else:
+        template = _xr.Dataset({varname: (da.dims,
+                                          _dsa.zeros(shape, chunks=chunks,
+                                                     dtype=da.dtype),
+                                          da.attrs)}, coords=coords)
+        template[varname].encoding = {key: value for key, value in
+                                      da.encoding.items()
+                                      if key not in ['chunks',
+                                                     'preferred_chunks']}
+    for name in template.variables:
+        if concat_dim in template[name].dims:
+            if name == varname:
+                template[name].encoding['chunks'] = tuple(chunks)
+            else:
+                template[name].encoding['chunks'] = tuple(
+                    records_per_year if dim == concat_dim
+                    else template[name].sizes[dim]
+                    for dim in template[name].dims)
+    if compressor is not None:
+        template[varname].encoding['compressor'] = \
+            make_compressor(compressor)
+    return template
+
+
+def create_preallocated_store(da, storepath, firstyear, lastyear,
+                              records_per_year, concat_dim='time',
+                              consolidated=True, compressor=None):
+    """ create the store of da with room for all the years of the run
+    (metadata only, no chunk is written) and its completeness bitmap.
+    Must be called with the store locked. """
+    varname = da.name
+    fstore = store_name(storepath, varname, 'directory')
+    nyears = lastyear - firstyear + 1
+    template = preallocated_template(da, nyears * records_per_year,
+                                     records_per_year,
+                                     concat_dim=concat_dim,
+                                     compressor=compressor)
+    fnew = f'{fstore}.new'
+    remove_path(fnew)
+    template.to_zarr(fnew, mode='w', compute=False,
+                     consolidated=consolidated)
+    save_regions(storepath, varname, {'firstyear': firstyear,
+                                      'lastyear': lastyear,
+                                      'records_per_year': records_per_year,
+                                      'filled': '0' * nyears})
+    os.rename(fnew, fstore)
+    return None
+
+
+def check_region_options(preallocate, max_mem):
+    """ regions of preallocated stores are written in one piece, not by
+    slabs: raise if a memory budget comes with preallocate """
+    if preallocate is not None and max_mem is not None:
+        raise ValueError('regions of preallocated stores are not written '
+                         'by slabs, max_mem cannot be used with preallocate')
+    return None
+
+
+def write_to_region(da, storepath, preallocate, concat_dim='time',
+                    storetype='directory', consolidated=True,
+                    overwrite=False, debug=False, write_yaml=False,
+                    rebuild_dict={}, compressor=None, history_backend='yaml',
+                    max_mem=None, **kwargs):
+    """ write da into its region of a preallocated store, created on the
+    first write. Regions of different years can be written at the same
+    time by different processes: only the creation of the store and the
+    update of its completeness bitmap hold the store lock.
+
+    PARAMETERS:
+    ===========
+
+    da: xarray.DataArray
+        data of consecutive years
+    storepath: str
+        path of the store
+    preallocate: dict
+        firstyear, lastyear (range of the run), year (of the first
+        record of da) and records_per_year
+    concat_dim: str
+        time dimension
+    storetype: str
+        only directory stores can be written by regions
+    consolidated: bool
+        consolidated metadata
+    overwrite: bool
+        write the region even if it is already filled
+    debug: bool
+        print debug information
+    write_yaml: bool
+        update the build history (history_backend='yaml')
+    rebuild_dict: dict
+        build history of the data (see yaml_utils.create_build_history)
+    compressor: str
+        compressor of the store (see encoding.make_compressor)
+    history_backend: str
+        'yaml' or 'sqlite' (the catalog is updated by the caller)
+    max_mem: int
+        regions are written in one piece, a memory budget is rejected
+    kwargs:
+        options of zarr_stores.write_to_zarr_store that do not apply here
+        (recalls, zip appends)
+
+    RETURNS:
+    ========
+
+    written: bool
+        False if the region was already filled
+    """
+    if storetype != 'directory':
+        raise ValueError('preallocated stores must be directory stores')
+    check_region_options(preallocate, max_mem)
+    varname = da.name
+    fstore = store_name(storepath, varname, storetype)
+    firstyear, lastyear = preallocate['firstyear'], preallocate['lastyear']
+    records_per_year = preallocate['records_per_year']
+
+    if concat_dim not in da.dims:
+        # written once, as a normal store
+        with store_lock(storepath, varname):
+            if os.path.exists(fstore) and not overwrite:
+                return False
+            ds = _xr.Dataset()
+            ds[varname] = da
+            replace_store(ds, fstore, storetype, consolidated=consolidated,
+                          encoding=variable_encoding(varname, compressor))
+            if write_yaml and history_backend == 'yaml':
+                update_yaml(storepath, varname, rebuild_dict,
+                            overwrite=overwrite)
+        return True
+
+    nrecords = da.sizes[concat_dim]
+    if nrecords % records_per_year != 0:
+        raise ValueError(f'{varname}: {nrecords} records are not whole '
+                         f'years of {records_per_year} records')
+    first = preallocate['year'] - firstyear
+    nyears = nrecords // records_per_year
+    if first < 0 or preallocate['year'] + nyears - 1 > lastyear:
+        raise ValueError(f'{varname}: years {preallocate["year"]} to '
+                         f'{preallocate["year"] + nyears - 1} are outside '
+                         f'of the store ({firstyear}-{lastyear})')
+
+    with store_lock(storepath, varname):
+        if not os.path.exists(fstore):
+            with stage('preallocate_store', variable=varname):
+                create_preallocated_store(da, storepath, firstyear,
+                                          lastyear, records_per_year,
+                                          concat_dim=concat_dim,
+                                          consolidated=consolidated,
+                                          compressor=compressor)
+        regions = read_regions(storepath, varname)
+    if regions is None:
+        raise ValueError(f'{fstore} is not a preallocated store')
+    if (regions['firstyear'], regions['lastyear'],
+            regions['records_per_year']) != (firstyear, lastyear,
+                                             records_per_year):
+        raise ValueError(f'{fstore} was preallocated for years '
+                         f'{regions["firstyear"]}-{regions["lastyear"]} '
+                         f'of {regions["records_per_year"]} records')
+    if not overwrite and \
+       '0' not in regions['filled'][first:first + nyears]:
+        if debug:
+            print(f'{varname}: region of {preallocate["year"]} already '
+                  'written, skipping')
+        return False
+
+    # the region does not change the metadata of the store
+    region = slice(first * records_per_year,
+                   (first + nyears) * records_per_year)
+    ds = _xr.Dataset()
+    ds[varname] = da
+    ds = ds.drop_vars([name for name in ds.variables
+                       if concat_dim not in ds[name].dims])
+    for name in ds.variables:
+        ds[name].encoding = {}
+    if debug:
+        print(f'writing {varname} into {fstore} region {region}')
+    with stage('write_region', variable=varname) as record:
+        ds.to_zarr(fstore, region={concat_dim: region}, consolidated=False)
+        # xarray leaves the index coordinates out of region writes
+        group = _zarr.open_group(fstore, mode='r+')
+        for name in ds.indexes:
+            group[name][region] = ds[name].values
+        record['bytes_read'] = int(da.nbytes)
+
+    with store_lock(storepath, varname):
+        regions = read_regions(storepath, varname)
+        filled = list(regions['filled'])
+        filled[first:first + nyears] = '1' * nyears
+        regions['filled'] = ''.join(filled)
+        save_regions(storepath, varname, regions)
+        if write_yaml and history_backend == 'yaml':
+            update_yaml(storepath, varname, rebuild_dict)
+    return True
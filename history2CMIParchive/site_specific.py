@@ -1,4 +1,19 @@
 import subprocess as sp
+import tempfile
+import shutil
+import shlex
+import time
+import os
+
+# batched recall command of each site, {files} is replaced by the paths
+recall_commands = {'gfdl': 'dmget {files}'}
+
+# recalls started by this process, by status file
+_recalls = {}
+
+# longest wait for a batched recall (seconds), the caller then recalls
+# its file alone
+default_recall_timeout = 6 * 3600
 
 
 def get_from_tape(mydir, myfile, site=None, debug=False):
@@ -14,3 +29,92 @@ def get_from_tape(mydir, myfile, site=None, debug=False):
 
     check = sp.check_call(command, shell=True)
     return check
+
+
+def recall_from_tape(files, site=None, command=None, debug=False,
+                     statusdir=None):
+    """ start a single recall of all the files in the background, the
+    conversion goes on and only waits (see wait_for_recall) when it needs
+    one of the files
+
+    PARAMETERS:
+    ===========
+
+    files: list
+        paths of the files (zip stores) to recall
+    site: str
+        site of the tape system, selects the default command
+    command: str
+        recall command, overrides the one of the site. {files} is replaced
+        by the paths, which are appended if it is absent
+    debug: bool
+        print debug information
+    statusdir: str
+        directory of the status file, shared with the workers the recall
+        is handed to (e.g. the workdir of the conversion). Defaults to a
+        local temporary directory, for the processes of this host only.
+
+    RETURNS:
+    ========
+
+    recall: dict or None
+        files and status file of the recall (can be passed to worker
+        processes), None if there is no tape system
+    """
+    if command is None:
+        command = recall_commands.get(site)
+    if command is None or len(files) == 0:
+        return None
+    files = sorted(set(os.path.abspath(f) for f in files))
+    quoted = ' '.join(shlex.quote(f) for f in files)
+    if '{files}' in command:
+        command = command.replace('{files}', quoted)
+    else:
+        command = f'{command} {quoted}'
+    # the exit code is written to the status file when the recall ends
+    if statusdir:
+        statusdir = os.path.abspath(statusdir)
+        os.makedirs(statusdir, exist_ok=True)
+    status = f'{tempfile.mkdtemp(prefix="recall_", dir=statusdir or None)}' \
+        '/status'
+    script = f'( {command} ) ; echo $? > {status}.tmp ; ' \
+        f'mv {status}.tmp {status}'
+    if debug:
+        print(f'recalling {len(files)} files from tape')
+    _recalls[status] = sp.Popen(script, shell=True)
+    return {'files': files, 'status': status}
+
+
+def wait_for_recall(recall, poll=0.05, timeout=default_recall_timeout):
+    """ block until the recall is done, returns its exit code (1 if
+    it did not end within timeout seconds) """
+    start = time.time()
+    while not os.path.exists(recall['status']):
+        if time.time() - start > timeout:
+            return 1
+        # started here and killed before it could write its status
+        process = _recalls.get(recall['status'])
+        if process is not None and process.poll() is not None and \
+           not os.path.exists(recall['status']):
+            return process.returncode or 1
+        time.sleep(poll)
+    with open(recall['status']) as f:
+        check = int(f.read().strip())
+    return check
+
+
+def is_recalled(recall, myfile):
+    """ is myfile part of the recall """
+    return recall is not None and os.path.abspath(myfile) in recall['files']
+
+
+def finish_recall(recall):
+    """ wait for the end of a recall and clean up, returns its exit code """
+    if recall is None:
+        return 0
+    check = wait_for_recall(recall)
+    process = _recalls.pop(recall['status'], None)
+    if process is not None:
+        process.wait()
+    shutil.rmtree(os.path.dirname(recall['status']), ignore_errors=True)
+    return check
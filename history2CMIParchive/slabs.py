@@ -0,0 +1,140 @@
+import xarray as _xr
+import zarr as _zarr
+import numpy as _np
+from .profiling import stage
+
+
+def plan_slabs(shape, dims, itemsize, chunks, max_mem, concat_dim='time',
+               offset=0):
+    """ split an array into slabs of at most max_mem bytes, written one
+    after the other. Slabs are made of whole chunks of the store, so that
+    no chunk is written twice: along concat_dim they end on the chunks of
+    the store (shifted by offset, the length of the store before the
+    write). When the records of a chunk are larger than max_mem, they are
+    split into whole chunks of levels along the first other dimension.
+
+    PARAMETERS:
+    ===========
+
+    shape: list
+        shape of the array
+    dims: list
+        dimensions of the array
+    itemsize: int
+        bytes per value
+    chunks: list
+        chunks of the store
+    max_mem: int
+        memory budget of a slab, in bytes
+    concat_dim: str
+        time dimension
+    offset: int
+        index along concat_dim of the first record in the store
+
+    RETURNS:
+    ========
+
+    slabs: list
+        one dict of slices (by dimension, relative to the array) per slab
+    """
+    taxis = dims.index(concat_dim)
+    nt = shape[taxis]
+    tchunk = chunks[taxis]
+    record = [n for dim, n in zip(dims, shape) if dim != concat_dim]
+    record_bytes = itemsize * int(_np.prod(record))
+
+    # records of each chunk of the store along concat_dim
+    edges = [offset] + list(range(offset - offset % tchunk + tchunk,
+                                  offset + nt, tchunk)) + [offset + nt]
+    blocks = [slice(start - offset, end - offset)
+              for start, end in zip(edges[:-1], edges[1:]) if end > start]
+
+    slabs = []
+    if tchunk * record_bytes <= max_mem:
+        nblocks = max_mem // (tchunk * record_bytes)
+        for k in range(0, len(blocks), nblocks):
+            group = blocks[k:k + nblocks]
+            slabs.append({concat_dim: slice(group[0].start,
+                                            group[-1].stop)})
+        return slabs
+
+    if len(record) == 0:
+        raise ValueError(f'a chunk of {tchunk} records '
+                         f'({tchunk * record_bytes} bytes) does not fit '
+                         f'in {max_mem} bytes')
+    laxis = 1 if taxis == 0 else 0
+    level_dim = dims[laxis]
+    lchunk = chunks[laxis]
+    level_bytes = record_bytes // shape[laxis]
+    if tchunk * lchunk * level_bytes > max_mem:
+        raise ValueError(f'a chunk of {tchunk} records and {lchunk} '
+                         f'{level_dim} ({tchunk * lchunk * level_bytes} '
+                         f'bytes) does not fit in {max_mem} bytes')
+    nlevels = max_mem // (tchunk * level_bytes)
+    nlevels -= nlevels % lchunk
+    for block in blocks:
+        for k in range(0, shape[laxis], nlevels):
+            slabs.append({concat_dim: block,
+                          level_dim: slice(k, min(k + nlevels,
+                                                  shape[laxis]))})
+    return slabs
+
+
+def prepare_slabs(ds, varname, concat_dim='time'):
+    """ dataset of varname ready to be written by slabs: its coordinates
+    are loaded, they are written with the metadata of the store, and the
+    variable is a dask array (by record if it was read whole), whose
+    computation is left to write_slabs """
+    for name in ds.coords:
+        ds[name].load()
+    if ds[varname].chunks is None:
+        ds = ds.chunk({concat_dim: 1})
+    return ds
+
+
+def slab_filler(da, max_mem, concat_dim='time', consolidated=True,
+                debug=False, report=None):
+    """ fill function of transactions.replace_store and append_to_store
+    writing da by slabs (see write_slabs). The number of slabs is added
+    to report. """
+    def fill(store):
+        nslabs = write_slabs(store, da, max_mem, concat_dim=concat_dim,
+                             debug=debug)
+        # the metadata of the store is consolidated once it is complete
+        if consolidated:
+            _zarr.consolidate_metadata(store)
+        if report is not None:
+            report['slabs'] = nslabs
+        return None
+    return fill
+
+
+def write_slabs(store, da, max_mem, concat_dim='time', debug=False):
+    """ write da, whose place is already allocated at the end of the store
+    (written with compute=False, see transactions.replace_store and
+    append_to_store), slab by slab. Each slab is loaded, then written as
+    a region of the store, so that at most a slab is held in memory.
+    Returns the number of slabs. """
+    varname = da.name
+    zarray = _zarr.open_group(store, mode='r')[varname]
+    taxis = da.dims.index(concat_dim)
+    offset = zarray.shape[taxis] - da.sizes[concat_dim]
+    slabs = plan_slabs(list(da.shape), list(da.dims), da.dtype.itemsize,
+                       list(zarray.chunks), max_mem, concat_dim=concat_dim,
+                       offset=offset)
+    for k, slab in enumerate(slabs):
+        with stage('write_slab', variable=varname, slab=k) as record:
+            values = da.variable.isel(slab).load()
+            values.encoding = {}
+            # the encoding (fill value, scale) is the one of the store
+            region = {dim: slab.get(dim, slice(0, n))
+                      for dim, n in zip(da.dims, da.shape)}
+            region[concat_dim] = slice(region[concat_dim].start + offset,
+                                       region[concat_dim].stop + offset)
+            if debug:
+                print(f'writing {varname} slab {k + 1}/{len(slabs)} '
+                      f'{region}')
+            _xr.Dataset({varname: values}).to_zarr(store, region=region,
+                                                   consolidated=False)
+            record['bytes_read'] = int(values.nbytes)
+    return len(slabs)
@@ -0,0 +1,483 @@
+from contextlib import contextmanager
+import sqlite3
+import socket
+import fcntl
+import glob
+import time
+import uuid
+import os
+from .tar_utilities import get_tar_index
+from .tar_utilities import list_files_archive
+from .tar_utilities import stream_ncfiles_from_archive
+from .tar_utilities import open_ncfile_from_archive
+from .tar_utilities import is_ignored
+from .datasets import convert_member
+from .datasets import inspect_ncfile
+from .datasets import define_component_code
+from .datasets import infer_store_path
+from .datasets import open_dataset
+from .datasets import error_record
+from .zarr_stores import store_name
+from .site_specific import recall_from_tape
+from .site_specific import finish_recall
+
+# name of the ledger, at the root of the stores
+ledger_name = 'sync_ledger.sqlite'
+
+# a unit is a variable of a member of an archive, written to one store.
+# archives are scanned once (with their compression, None if they are
+# plain tars), units go from todo to running to done or failed (failed
+# ones are retried by the next runs).
+schema = """
+CREATE TABLE IF NOT EXISTS archives (
+    archive TEXT PRIMARY KEY,
+    scanned TEXT NOT NULL,
+    compression TEXT
+);
+CREATE TABLE IF NOT EXISTS units (
+    id INTEGER PRIMARY KEY,
+    archive TEXT NOT NULL,
+    member TEXT NOT NULL,
+    variable TEXT NOT NULL,
+    store TEXT NOT NULL,
+    time_first REAL,
+    time_last REAL,
+    status TEXT NOT NULL DEFAULT 'todo',
+    worker TEXT,
+    run TEXT,
+    claimed REAL,
+    error TEXT,
+    UNIQUE (archive, member, variable)
+);
+CREATE INDEX IF NOT EXISTS units_by_status ON units (status);
+CREATE INDEX IF NOT EXISTS units_by_store ON units (store, time_first);
+"""
+
+# units a worker can take: new ones, the ones failed in another run and
+# the ones claimed before :stale by a worker that did not finish them,
+# once all the earlier units of their store are done (stores are
+# appended to in time order)
+claimable = """
+(u.status = 'todo'
+ OR (u.status = 'failed' AND u.run IS NOT :run)
+ OR (u.status = 'running' AND u.claimed < :stale))
+AND NOT EXISTS (
+    SELECT 1 FROM units p
+    WHERE p.store = u.store AND p.id != u.id AND p.status != 'done'
+    AND (p.time_first < u.time_first
+         OR ((p.time_first IS NULL OR u.time_first IS NULL)
+             AND p.id < u.id)))
+"""
+
+
+def ledger_path(outputdir):
+    """ path of the sync ledger of the stores under outputdir """
+    return f'{outputdir}/{ledger_name}'
+
+
+def connect_ledger(ledger):
+    """ open (and create if needed) the ledger. The ledger is shared by
+    workers on several nodes, on a network file system: it keeps the
+    default rollback journal (the shared memory of WAL only works between
+    processes of the same host), and its writes are serialized by a lock
+    file (see ledger_transaction), so the file system must support fcntl
+    locks. """
+    os.makedirs(os.path.dirname(os.path.abspath(ledger)), exist_ok=True)
+    conn = sqlite3.connect(ledger, timeout=600, isolation_level=None)
+    # ledgers created in WAL mode go back to the rollback journal
+    conn.execute('PRAGMA journal_mode=DELETE')
+    conn.executescript(schema)
+    # ledgers of earlier versions did not record the compression, their
+    # archives are converted member by member
+    columns = [row[1] for row in
+               conn.execute('PRAGMA table_info(archives)')]
+    if 'compression' not in columns:
+        conn.execute('ALTER TABLE archives ADD COLUMN compression TEXT')
+    return conn
+
+
+@contextmanager
+def ledger_transaction(ledger):
+    """ immediate transaction on the ledger, holding an exclusive lock on
+    {ledger}.lock so that two workers (on any node) never claim the same
+    unit. Yields the connection, commits at the end of the block or rolls
+    back on error. """
+    os.makedirs(os.path.dirname(os.path.abspath(ledger)), exist_ok=True)
+    with open(f'{ledger}.lock', 'w') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            conn = connect_ledger(ledger)
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    yield conn
+                except BaseException:
+                    conn.execute('ROLLBACK')
+                    raise
+                conn.execute('COMMIT')
+            finally:
+                conn.close()
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def sync_history(historydir, outputdir, workdir, ledger=None,
+                 pattern='*.nc.tar', ignore_types=[], storetype='directory',
+                 grid='gn', tag='v1', timedim='time', site=None,
+                 recall_command=None, indexdir=None, extract=True,
+                 stale_after=None, max_members=None, debug=False, **kwargs):
+    """ bring the stores up to date with a history directory: new archives
+    are scanned into the ledger, then the units (variable of a member)
+    not converted yet, or failed, are claimed and converted. Units done
+    are skipped without opening their store. Several workers (jobs of a
+    batch system) can sync from the same ledger at the same time.
+
+    PARAMETERS:
+    ===========
+
+    historydir: str
+        directory of the history archives
+    outputdir: str
+        root of the zarr stores
+    workdir: str
+        scratch directory for the extracted members
+    ledger: str
+        path of the ledger, defaults to {outputdir}/sync_ledger.sqlite
+    pattern: str
+        glob pattern of the archives in historydir
+    ignore_types: list
+        member types that are not converted
+    storetype: str
+        'directory' or 'zip'
+    grid, tag: str
+        grid and version of the stores (see infer_store_path)
+    timedim: str
+        time dimension
+    site: str
+        tape system of the site (see site_specific)
+    recall_command: str
+        tape recall command, overrides the one of the site
+    indexdir: str
+        directory of the tar indexes
+    extract: bool
+        extract the members into workdir, otherwise read uncompressed
+        members in place
+    stale_after: float
+        seconds after which a unit claimed by a worker that did not finish
+        it can be claimed again, None to never take over
+    max_members: int
+        stop after converting this many members, e.g. to fit in the time
+        limit of a batch job (the members of a compressed archive are
+        claimed and converted together, in one pass over the archive)
+    debug: bool
+        print debug information
+    kwargs:
+        options of export_nc_out_to_zarr_stores
+
+    RETURNS:
+    ========
+
+    errors: list
+        archives that could not be scanned and units that could not be
+        converted in this run
+    """
+    if ledger is None:
+        ledger = ledger_path(outputdir)
+    errors = scan_history(historydir, outputdir, workdir, ledger,
+                          pattern=pattern, ignore_types=ignore_types,
+                          storetype=storetype, grid=grid, tag=tag,
+                          timedim=timedim, site=site,
+                          recall_command=recall_command, indexdir=indexdir,
+                          debug=debug)
+
+    export_kwargs = dict(kwargs, outputdir=outputdir, storetype=storetype,
+                         grid=grid, tag=tag, timedim=timedim, site=site,
+                         debug=debug, recall_command=recall_command)
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    run = uuid.uuid4().hex
+    nmembers = 0
+    while max_members is None or nmembers < max_members:
+        claim = claim_units(ledger, worker, run, stale_after=stale_after)
+        if claim is None:
+            break
+        archive, members = claim
+        if debug:
+            print(f'{worker} converting {members} from {archive}')
+        archive_errors = convert_units(archive, members, workdir,
+                                       export_kwargs, extract=extract,
+                                       indexdir=indexdir,
+                                       ignore_types=ignore_types)
+        for ncfile, variables in members.items():
+            finish_units(ledger, archive, ncfile, variables,
+                         archive_errors[ncfile], worker, run)
+            errors += archive_errors[ncfile]
+        nmembers += len(members)
+    return errors
+
+
+def scan_history(historydir, outputdir, workdir, ledger, pattern='*.nc.tar',
+                 ignore_types=[], storetype='directory', grid='gn',
+                 tag='v1', timedim='time', site=None, recall_command=None,
+                 indexdir=None, debug=False):
+    """ add the units of the archives of historydir not scanned yet to the
+    ledger. Only the headers and time axis of the members are read. The
+    new archives are recalled from tape in one batch. Returns the list of
+    archives that could not be scanned (they are scanned again next
+    time). """
+    archives = [os.path.abspath(archive) for archive in
+                sorted(glob.glob(os.path.join(historydir, pattern)))]
+    conn = connect_ledger(ledger)
+    try:
+        scanned = set([row[0] for row in
+                       conn.execute('SELECT archive FROM archives')])
+    finally:
+        conn.close()
+    new_archives = [archive for archive in archives
+                    if archive not in scanned]
+    if len(new_archives) == 0:
+        return []
+
+    finish_recall(recall_from_tape(new_archives, site=site,
+                                   command=recall_command, debug=debug))
+    errors = []
+    for archive in new_archives:
+        if debug:
+            print(f'scanning {archive}')
+        try:
+            units, compression = archive_units(
+                archive, outputdir, workdir, ignore_types=ignore_types,
+                storetype=storetype, grid=grid, tag=tag, timedim=timedim,
+                indexdir=indexdir, debug=debug)
+        except Exception as e:
+            errors.append(error_record(archive, None, e))
+            continue
+        with ledger_transaction(ledger) as conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO units (archive, member, variable, '
+                'store, time_first, time_last) VALUES (:archive, :member, '
+                ':variable, :store, :time_first, :time_last)', units)
+            conn.execute('INSERT OR IGNORE INTO archives (archive, scanned, '
+                         'compression) VALUES (?, ?, ?)',
+                         (archive, time.ctime(), compression))
+    return errors
+
+
+def archive_units(archive, outputdir, workdir, ignore_types=[],
+                  storetype='directory', grid='gn', tag='v1',
+                  timedim='time', indexdir=None, debug=False):
+    """ units of the members of an archive, and its compression (None
+    for a plain tar). Members of uncompressed archives are read in place,
+    the others are streamed through workdir. """
+    index = get_tar_index(archive, cachedir=indexdir, debug=debug)
+    unit_kwargs = {'storetype': storetype, 'grid': grid, 'tag': tag,
+                   'timedim': timedim}
+    units = []
+    if index['compression'] is not None:
+        os.makedirs(workdir, exist_ok=True)
+        for ncfile in stream_ncfiles_from_archive(archive, workdir,
+                                                  ignore_types=ignore_types):
+            units += member_units(archive, ncfile, f'{workdir}/{ncfile}',
+                                  outputdir, **unit_kwargs)
+            os.remove(f'{workdir}/{ncfile}')
+        return units, index['compression']
+    for ncfile in list_files_archive(archive, index=index):
+        if is_ignored(ncfile, ignore_types):
+            continue
+        fileobj = open_ncfile_from_archive(archive, ncfile, index)
+        try:
+            units += member_units(archive, ncfile, fileobj, outputdir,
+                                  **unit_kwargs)
+        finally:
+            fileobj.close()
+    return units, None
+
+
+def member_units(archive, ncfile, source, outputdir, storetype='directory',
+                 grid='gn', tag='v1', timedim='time'):
+    """ one unit (dict with the columns of the ledger) per variable of a
+    member, read from source (path or file object) """
+    fileobj = None if isinstance(source, str) else source
+    spec = inspect_ncfile(source if fileobj is None else ncfile,
+                          timedim=timedim, fileobj=fileobj)
+    component_code = define_component_code(ncfile, timedim=timedim,
+                                           fileobj=fileobj, spec=spec)
+    time_first, time_last = None, None
+    if spec['ntimes'] > 0 and timedim in spec['variables']:
+        ds = open_dataset(source, {}, decode_times=False, spec=spec)
+        times = ds[timedim].values
+        time_first, time_last = float(times[0]), float(times[-1])
+        ds.close()
+    units = []
+    for variable, var_spec in spec['variables'].items():
+        storepath = infer_store_path(ncfile, variable, outputdir,
+                                     component_code, grid=grid, tag=tag)
+        timed = timedim in var_spec['dims']
+        units.append({'archive': archive, 'member': ncfile,
+                      'variable': variable,
+                      'store': store_name(storepath, variable, storetype),
+                      'time_first': time_first if timed else None,
+                      'time_last': time_last if timed else None})
+    return units
+
+
+def claim_units(ledger, worker, run, stale_after=None):
+    """ claim the claimable units of the next member, in a single
+    immediate transaction so that two workers never claim the same unit.
+    The members of a compressed archive (as recorded by scan_history)
+    cannot be read alone: the claimable units of all its members are
+    claimed at once, and the archive is read once for all of them.
+
+    PARAMETERS:
+    ===========
+
+    ledger: str
+        path of the ledger
+    worker: str
+        name of the worker (host:pid)
+    run: str
+        id of the run of the worker, units failed in this run are not
+        claimed again by it
+    stale_after: float
+        seconds after which running units can be taken over
+
+    RETURNS:
+    ========
+
+    claim: tuple
+        (archive, members), members maps each claimed member to its
+        variables (in archive order), None if there is nothing to do
+    """
+    now = time.time()
+    params = {'run': run,
+              'stale': now - stale_after if stale_after is not None else 0}
+    with ledger_transaction(ledger) as conn:
+        # the archive itself is not opened while the ledger is locked
+        row = conn.execute(f'SELECT u.archive, u.member, a.compression '
+                           f'FROM units u LEFT JOIN archives a '
+                           f'ON a.archive = u.archive '
+                           f'WHERE {claimable} ORDER BY u.id LIMIT 1',
+                           params).fetchone()
+        if row is None:
+            return None
+        archive, ncfile, compression = row
+        if compression is not None:
+            rows = conn.execute(
+                f'SELECT u.id, u.member, u.variable FROM units u '
+                f'WHERE u.archive = :archive AND {claimable} ORDER BY u.id',
+                dict(params, archive=archive)).fetchall()
+        else:
+            rows = conn.execute(
+                f'SELECT u.id, u.member, u.variable FROM units u '
+                f'WHERE u.archive = :archive AND u.member = :member '
+                f'AND {claimable} ORDER BY u.id',
+                dict(params, archive=archive, member=ncfile)).fetchall()
+        conn.executemany('UPDATE units SET status = \'running\', '
+                         'worker = ?, run = ?, claimed = ?, error = NULL '
+                         'WHERE id = ?',
+                         [(worker, run, now, unit_id)
+                          for unit_id, member, variable in rows])
+    members = {}
+    for unit_id, member, variable in rows:
+        members.setdefault(member, []).append(variable)
+    return archive, members
+
+
+def convert_units(archive, members, workdir, export_kwargs, extract=True,
+                  indexdir=None, ignore_types=[]):
+    """ convert the claimed variables of the members of an archive.
+    Compressed archives are streamed once for all the members.
+    Returns the errors of each member. """
+    site = export_kwargs.get('site')
+    recall_command = export_kwargs.get('recall_command')
+    debug = export_kwargs.get('debug', False)
+    errors = {ncfile: [] for ncfile in members}
+    try:
+        check = finish_recall(recall_from_tape([archive], site=site,
+                                               command=recall_command,
+                                               debug=debug))
+        if check != 0:
+            raise IOError(f'recall of {archive} failed ({check})')
+        index = get_tar_index(archive, cachedir=indexdir, debug=debug)
+    except Exception as e:
+        return {ncfile: [error_record(ncfile, None, e)]
+                for ncfile in members}
+
+    if index['compression'] is not None:
+        # read front to back once, the claimed members as they arrive
+        os.makedirs(workdir, exist_ok=True)
+        converted = set()
+        try:
+            for ncfile in stream_ncfiles_from_archive(
+                    archive, workdir, ignore_types=ignore_types):
+                if ncfile in members:
+                    errors[ncfile] = convert_streamed(
+                        archive, ncfile, members[ncfile], workdir,
+                        export_kwargs)
+                    converted.add(ncfile)
+                os.remove(f'{workdir}/{ncfile}')
+        except Exception as e:
+            for ncfile in members:
+                if ncfile not in converted:
+                    errors[ncfile] = [error_record(ncfile, None, e)]
+        for ncfile in members:
+            if ncfile not in converted and len(errors[ncfile]) == 0:
+                errors[ncfile] = [error_record(
+                    ncfile, None, IOError(f'{ncfile} not in {archive}'))]
+        return errors
+
+    if extract:
+        os.makedirs(workdir, exist_ok=True)
+    for ncfile, variables in members.items():
+        try:
+            errors[ncfile] = convert_member(
+                archive, ncfile, workdir, index, extract,
+                dict(export_kwargs, archive=archive, variables=variables))
+        except Exception as e:
+            errors[ncfile] = [error_record(ncfile, None, e)]
+        if extract and os.path.exists(f'{workdir}/{ncfile}'):
+            os.remove(f'{workdir}/{ncfile}')
+    return errors
+
+
+def convert_streamed(archive, ncfile, variables, workdir, export_kwargs):
+    """ convert the claimed variables of a member streamed into workdir,
+    returns the list of errors """
+    try:
+        return convert_member(archive, ncfile, workdir, None, True,
+                              dict(export_kwargs, archive=archive,
+                                   variables=variables), prefetched=True)
+    except Exception as e:
+        return [error_record(ncfile, None, e)]
+
+
+def finish_units(ledger, archive, ncfile, variables, errors, worker, run):
+    """ mark the claimed units of a member done, or failed (with their
+    error). An error without a variable fails the whole member. Units
+    taken over by another worker (see stale_after) are left to it. """
+    failed = {}
+    for record in errors:
+        if record['variable'] is None:
+            failed = {variable: record['error'] for variable in variables}
+            break
+        failed[record['variable']] = record['error']
+    rows = []
+    for variable in variables:
+        status = 'failed' if variable in failed else 'done'
+        rows.append((status, failed.get(variable), archive, ncfile,
+                     variable, worker, run))
+    with ledger_transaction(ledger) as conn:
+        conn.executemany('UPDATE units SET status = ?, error = ? '
+                         'WHERE archive = ? AND member = ? AND variable = ? '
+                         'AND worker = ? AND run = ?', rows)
+    return None
+
+
+def ledger_status(ledger):
+    """ number of units by status """
+    conn = connect_ledger(ledger)
+    try:
+        counts = dict(conn.execute('SELECT status, COUNT(*) FROM units '
+                                   'GROUP BY status').fetchall())
+    finally:
+        conn.close()
+    return counts
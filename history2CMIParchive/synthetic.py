@@ -0,0 +1,230 @@
+import xarray as _xr
+import numpy as _np
+import tarfile as _tarfile
+import shutil
+import time
+import os
+from .datasets import convert_archive_to_zarr_store
+from .datasets import convert_archives_to_zarr_store
+
+# FMS history members: frequency, vertical axis, horizontal grid and
+# component. Names follow the production runs so that
+# define_component_code and infer_store_path route them the same way.
+default_members = {
+    'ocean_static': {'freq': 'fx', 'vertical': None, 'grid': 'ocean'},
+    'ocean_month': {'freq': 'mon', 'vertical': 'z_l', 'grid': 'ocean'},
+    'ocean_month_z': {'freq': 'mon', 'vertical': 'z_l', 'grid': 'ocean'},
+    'ocean_month_d2': {'freq': 'mon', 'vertical': None, 'grid': 'ocean_d2'},
+    'ocean_annual_rho2': {'freq': 'yr', 'vertical': 'rho2_l',
+                          'grid': 'ocean'},
+    'ocean_daily': {'freq': 'day', 'vertical': None, 'grid': 'ocean'},
+    'ice_month': {'freq': 'mon', 'vertical': None, 'grid': 'ice'},
+    'ocean_Drake_Passage': {'freq': 'mon', 'vertical': 'z_l',
+                            'grid': 'section'},
+    'ocean_Bering_Strait': {'freq': 'mon', 'vertical': 'z_l',
+                            'grid': 'section'},
+}
+
+# variable names per component, numbered when more are asked for
+variable_names = {'ocean': ['thetao', 'so', 'uo', 'vo', 'agessc', 'tos',
+                            'sos', 'zos'],
+                  'ice': ['siconc', 'sithick', 'sisnthick', 'siu', 'siv'],
+                  'section': ['umo', 'vmo', 'thetao', 'so']}
+
+# noleap calendar
+days_per_month = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+
+def time_axis(year, freq):
+    """ time (days since 0001-01-01, noleap) of the records of a year """
+    start = 365 * (year - 1)
+    if freq == 'mon':
+        ends = _np.cumsum(days_per_month)
+        return start + ends - 0.5 * _np.array(days_per_month)
+    elif freq == 'day':
+        return start + _np.arange(365) + 0.5
+    elif freq == 'yr':
+        return _np.array([start + 182.5])
+    return None
+
+
+def define_member_dataset(member, spec, year, resolution=1, nvars=4,
+                          nz=5):
+    """ synthetic history file of one member for one year
+
+    PARAMETERS:
+    ===========
+
+    member: str
+        member type, e.g. ocean_month
+    spec: dict
+        frequency, vertical axis and grid of the member
+    year: int
+        model year
+    resolution: float
+        horizontal resolution (degrees)
+    nvars: int
+        number of variables
+    nz: int
+        number of vertical levels
+
+    RETURNS:
+    ========
+
+    ds: xarray.Dataset
+    """
+    grid = spec['grid']
+    if grid == 'ocean_d2':
+        resolution = 2 * resolution
+    if grid == 'ice':
+        xdim, ydim = 'xT', 'yT'
+    elif grid == 'section':
+        xdim, ydim = 'xq', 'yh'
+    else:
+        xdim, ydim = 'xh', 'yh'
+    lat = _np.arange(-90 + resolution / 2, 90, resolution)
+    lon = _np.arange(resolution / 2, 360, resolution)
+    if grid == 'section':
+        lon = lon[:1]
+
+    coords = {xdim: ([xdim], lon), ydim: ([ydim], lat)}
+    dims = [ydim, xdim]
+    shape = [len(lat), len(lon)]
+    vertical = spec['vertical']
+    if vertical is not None:
+        coords[vertical] = ([vertical], _np.arange(nz, dtype='f8'))
+        dims = [vertical] + dims
+        shape = [nz] + shape
+    times = time_axis(year, spec['freq'])
+    if times is not None:
+        coords['time'] = (['time'], times,
+                          {'units': 'days since 0001-01-01 00:00:00',
+                           'calendar': 'noleap'})
+        dims = ['time'] + dims
+        shape = [len(times)] + shape
+
+    # smooth large scale field plus noise, compresses like model output
+    rng = _np.random.default_rng(year)
+    base = _np.cos(_np.deg2rad(lat))[:, None] * \
+        _np.ones((len(lat), len(lon)))
+    names = variable_names['section' if grid == 'section' else
+                           'ice' if grid == 'ice' else 'ocean']
+    data_vars = {}
+    for k in range(nvars):
+        name = names[k] if k < len(names) else f'{names[k % len(names)]}{k}'
+        data = (k + 1) * base + 0.01 * rng.standard_normal(shape)
+        data_vars[name] = (dims, data.astype('f4'))
+    return _xr.Dataset(data_vars, coords=coords)
+
+
+def create_synthetic_history(outputdir, years, resolution=1, nvars=4, nz=5,
+                             members=None, compression=None,
+                             fmt='NETCDF4'):
+    """ write one history archive per year (YYYY0101.nc.tar) with FMS
+    member names
+
+    PARAMETERS:
+    ===========
+
+    outputdir: str
+        directory of the archives
+    years: list
+        model years
+    resolution: float
+        horizontal resolution (degrees)
+    nvars: int
+        number of variables of each member
+    nz: int
+        number of vertical levels
+    members: list
+        member types (keys of default_members), default all
+    compression: str
+        None, gz, bz2 or xz
+    fmt: str
+        netcdf format of the members
+
+    RETURNS:
+    ========
+
+    archives: list
+        paths of the archives
+    """
+    if members is None:
+        members = list(default_members.keys())
+    os.makedirs(outputdir, exist_ok=True)
+    tmpdir = f'{outputdir}/.synthetic'
+    os.makedirs(tmpdir, exist_ok=True)
+    archives = []
+    for year in years:
+        archive = f'{outputdir}/{year:04d}0101.nc.tar'
+        if compression is not None:
+            archive += f'.{compression}'
+        mode = 'w' if compression is None else f'w:{compression}'
+        with _tarfile.open(archive, mode) as arch:
+            for member in members:
+                ncfile = f'{year:04d}0101.{member}.nc'
+                ds = define_member_dataset(member, default_members[member],
+                                           year, resolution=resolution,
+                                           nvars=nvars, nz=nz)
+                ds.to_netcdf(f'{tmpdir}/{ncfile}', format=fmt)
+                arch.add(f'{tmpdir}/{ncfile}', arcname=ncfile)
+                os.remove(f'{tmpdir}/{ncfile}')
+        archives.append(archive)
+    shutil.rmtree(tmpdir)
+    return archives
+
+
+def run_load_test(archives, outputdir, workdir, **kwargs):
+    """ convert the archives with the full pipeline (one archive at a
+    time, or batched if batch_years/batch_bytes are given) and report
+    wall time, throughput and files created
+
+    PARAMETERS:
+    ===========
+
+    archives: list
+        paths of the archives
+    outputdir: str
+        root of the zarr stores
+    workdir: str
+        work directory for the extracted members
+    kwargs:
+        options of convert_archive_to_zarr_store
+
+    RETURNS:
+    ========
+
+    report: dict
+    """
+    nbytes = sum(os.path.getsize(archive) for archive in archives)
+    errors = []
+    start = time.perf_counter()
+    if 'batch_years' in kwargs or 'batch_bytes' in kwargs:
+        errors += convert_archives_to_zarr_store(archives=archives,
+                                                 outputdir=outputdir,
+                                                 workdir=workdir, **kwargs)
+    else:
+        for archive in archives:
+            errors += convert_archive_to_zarr_store(archive=archive,
+                                                    outputdir=outputdir,
+                                                    workdir=workdir,
+                                                    **kwargs)
+    wall_time = time.perf_counter() - start
+
+    nfiles, nstores, store_bytes = 0, 0, 0
+    for root, dirs, files in os.walk(outputdir):
+        nfiles += len(files)
+        for f in files:
+            store_bytes += os.path.getsize(os.path.join(root, f))
+            if f.endswith('.zip') or f == '.zgroup':
+                nstores += 1
+
+    report = {'archives': len(archives),
+              'archive_bytes': nbytes,
+              'wall_time': wall_time,
+              'throughput_MBps': nbytes / 1e6 / max(wall_time, 1e-9),
+              'stores': nstores,
+              'files_created': nfiles,
+              'store_bytes': store_bytes,
+              'errors': len(errors)}
+    return report
@@ -1,23 +1,354 @@
 import tarfile as _tarfile
+import io as _io
+import sys
+import yaml
+import os
 
+# size of the blocks copied when extracting a member from its offset
+copy_blocksize = 16 * 1024 * 1024
 
-def list_files_archive(archivefile):
-    """ returns list of netcdf files contained in a tar file """
-    assert _tarfile.is_tarfile(archivefile)
-    arch = _tarfile.open(name=archivefile, mode='r')
-    allfiles = arch.getnames()
+# magic numbers of the compressions supported by tarfile
+compression_magic = {'gz': b'\x1f\x8b', 'bz2': b'BZh',
+                     'xz': b'\xfd7zXZ\x00'}
+
+
+def list_files_archive(archivefile, index=None):
+    """ returns list of netcdf files contained in a tar file
+
+    PARAMETERS:
+    ===========
+
+    archivefile: str
+        path to tar file
+    index: dict
+        member index from get_tar_index, avoids walking the tar headers
+
+    RETURNS:
+    ========
+
+    ncfiles: list
+    """
+    if index is not None:
+        allfiles = [member['name'] for member in index['members']]
+    else:
+        assert _tarfile.is_tarfile(archivefile)
+        arch = _tarfile.open(name=archivefile, mode='r')
+        allfiles = arch.getnames()
+        arch.close()
     ncfiles = []
     for f in allfiles:
         if f.endswith('.nc'):
             ncfiles.append(f)
-    arch.close()
     return ncfiles
 
 
-def extract_ncfile_from_archive(archivefile, ncfile, destination):
-    """ extract a single netcdf file from archivefile into destination """
+def extract_ncfile_from_archive(archivefile, ncfile, destination, index=None):
+    """ extract a single netcdf file from archivefile into destination
+
+    PARAMETERS:
+    ===========
+
+    archivefile: str
+        path to tar file
+    ncfile: str
+        name of the member to extract
+    destination: str
+        directory where the member is extracted
+    index: dict
+        member index from get_tar_index, if provided and the archive is
+        not compressed the member is copied straight from its offset
+    """
+    member = None
+    if index is not None and index['compression'] is None:
+        member = find_member(index, ncfile)
+    if member is None:
+        # fall back to tarfile, that scans the headers
+        assert _tarfile.is_tarfile(archivefile)
+        arch = _tarfile.open(name=archivefile, mode='r')
+        arch.extract(ncfile, path=destination)
+        arch.close()
+        return None
+
+    target = os.path.join(destination, member['name'])
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(archivefile, 'rb') as src, open(target, 'wb') as dst:
+        src.seek(member['offset_data'])
+        remaining = member['size']
+        while remaining > 0:
+            block = src.read(min(copy_blocksize, remaining))
+            if not block:
+                raise IOError(f'{archivefile} is truncated, '
+                              f'cannot extract {ncfile}')
+            dst.write(block)
+            remaining -= len(block)
+    # same permissions and time stamp as tarfile would give
+    os.chmod(target, member['mode'])
+    os.utime(target, (member['mtime'], member['mtime']))
+    return None
+
+
+def stream_ncfiles_from_archive(archivefile, destination, ignore_types=[]):
+    """ read archivefile once, front to back, and yield the names of the
+    netcdf members as they are extracted into destination. Works on
+    compressed archives and on stdin (archivefile = '-'). Members are
+    filtered on their header, ignored ones are never written to disk.
+
+    PARAMETERS:
+    ===========
+
+    archivefile: str
+        path to tar file, or '-' to read from stdin
+    destination: str
+        directory where the members are extracted
+    ignore_types: list
+        members matching any of these patterns are skipped
+
+    RETURNS:
+    ========
+
+    generator of str
+    """
+    if archivefile == '-':
+        arch = _tarfile.open(fileobj=sys.stdin.buffer, mode='r|*')
+    else:
+        arch = _tarfile.open(name=archivefile, mode='r|*')
+    for member in arch:
+        if not member.isfile() or not member.name.endswith('.nc'):
+            continue
+        if is_ignored(member.name, ignore_types):
+            continue
+        # in stream mode, only the current member can be extracted
+        arch.extract(member, path=destination)
+        yield member.name
+    arch.close()
+    return None
+
+
+def is_ignored(ncfile, ignore_types):
+    """ True if ncfile matches any of the ignored file types """
+    for filetype in ignore_types:
+        if filetype in ncfile:
+            return True
+    return False
+
+
+def archive_compression(archivefile):
+    """ return the compression of archivefile (gz, bz2, xz) or None """
+    with open(archivefile, 'rb') as f:
+        magic = f.read(6)
+    for compression, signature in compression_magic.items():
+        if magic.startswith(signature):
+            return compression
+    return None
+
+
+def build_tar_index(archivefile):
+    """ walk the headers of archivefile once and build its member index
+
+    PARAMETERS:
+    ===========
+
+    archivefile: str
+        path to tar file
+
+    RETURNS:
+    ========
+
+    index: dict
+        description of the archive (size, mtime, compression) and for
+        each member its name, header offset, data offset, size, mode and
+        mtime
+    """
     assert _tarfile.is_tarfile(archivefile)
+    stat = os.stat(archivefile)
+    members = []
     arch = _tarfile.open(name=archivefile, mode='r')
-    arch.extract(ncfile, path=destination)
+    for member in arch:
+        if member.isfile():
+            members.append({'name': member.name,
+                            'offset': member.offset,
+                            'offset_data': member.offset_data,
+                            'size': member.size,
+                            'mode': member.mode,
+                            'mtime': member.mtime})
     arch.close()
+
+    index = {'archive': os.path.basename(archivefile),
+             'archive_size': stat.st_size,
+             'archive_mtime': stat.st_mtime,
+             'compression': archive_compression(archivefile),
+             'members': members}
+    return index
+
+
+def tar_index_path(archivefile, cachedir=None):
+    """ path of the sidecar index, next to the archive by default """
+    if cachedir is None:
+        cachedir = os.path.dirname(os.path.abspath(archivefile))
+    return f'{cachedir}/{os.path.basename(archivefile)}.index.yml'
+
+
+def get_tar_index(archivefile, cachedir=None, debug=False):
+    """ return the member index of archivefile, from the cached sidecar
+    if it is still valid or by scanning the archive (and caching it)
+
+    PARAMETERS:
+    ===========
+
+    archivefile: str
+        path to tar file
+    cachedir: str
+        directory for the index, defaults to the archive directory
+    debug: bool
+        print debug information
+
+    RETURNS:
+    ========
+
+    index: dict
+    """
+    indexfile = tar_index_path(archivefile, cachedir=cachedir)
+    stat = os.stat(archivefile)
+
+    if os.path.exists(indexfile):
+        with open(indexfile) as f:
+            index = yaml.load(f, Loader=yaml.FullLoader)
+            f.close()
+        # the archive has not been modified since it was indexed
+        if (index['archive_size'] == stat.st_size) and \
+           (index['archive_mtime'] == stat.st_mtime):
+            if debug:
+                print(f'using tar index {indexfile}')
+            return index
+
+    if debug:
+        print(f'indexing {archivefile}')
+    index = build_tar_index(archivefile)
+
+    # write the sidecar atomically, archive directory may be read-only
+    try:
+        os.makedirs(os.path.dirname(indexfile), exist_ok=True)
+        with open(f'{indexfile}.tmp', 'w') as fnew:
+            yaml.dump(index, fnew, default_flow_style=False)
+        os.replace(f'{indexfile}.tmp', indexfile)
+    except OSError:
+        print(f'WARNING: cannot write tar index {indexfile}')
+    return index
+
+
+def find_member(index, ncfile):
+    """ return the entry of ncfile in the index, None if not found """
+    for member in index['members']:
+        if member['name'] == ncfile:
+            return member
     return None
+
+
+def open_ncfile_from_archive(archivefile, ncfile, index):
+    """ open a member of an uncompressed archive in place, without
+    copying it out of the tar
+
+    PARAMETERS:
+    ===========
+
+    archivefile: str
+        path to tar file
+    ncfile: str
+        name of the member to open
+    index: dict
+        member index from get_tar_index
+
+    RETURNS:
+    ========
+
+    fileobj: TarMemberFile
+        read-only file object bounded to the member bytes
+    """
+    if index['compression'] is not None:
+        raise ValueError(f'{archivefile} is compressed, '
+                         'members cannot be opened in place')
+    member = find_member(index, ncfile)
+    if member is None:
+        raise KeyError(f'{ncfile} not found in {archivefile}')
+    return TarMemberFile(archivefile, member['offset_data'], member['size'])
+
+
+class TarMemberFile(_io.RawIOBase):
+    """ read-only file object over the byte range [offset, offset + size)
+    of a tar file. Reads are positional so several readers can share the
+    same descriptor. Closing only releases the descriptor: readers such as
+    scipy close the file they are given, and the member may be opened
+    again (or pickled to another process) afterwards. """
+
+    def __init__(self, archivefile, offset, size):
+        self.archivefile = archivefile
+        self.offset = offset
+        self.size = size
+        self._position = 0
+        self._fd = None
+
+    def __reduce__(self):
+        return (TarMemberFile, (self.archivefile, self.offset, self.size))
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, position, whence=_io.SEEK_SET):
+        if whence == _io.SEEK_SET:
+            self._position = position
+        elif whence == _io.SEEK_CUR:
+            self._position += position
+        elif whence == _io.SEEK_END:
+            self._position = self.size + position
+        else:
+            raise ValueError(f'invalid whence {whence}')
+        if self._position < 0:
+            raise ValueError('negative seek position')
+        return self._position
+
+    def _descriptor(self):
+        if self._fd is None:
+            self._fd = os.open(self.archivefile, os.O_RDONLY)
+        return self._fd
+
+    def read(self, size=-1):
+        remaining = max(self.size - self._position, 0)
+        nbytes = remaining if (size is None or size < 0) else \
+            min(size, remaining)
+        if nbytes == 0:
+            return b''
+        data = os.pread(self._descriptor(), nbytes,
+                        self.offset + self._position)
+        self._position += len(data)
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        nbytes = min(len(view), max(self.size - self._position, 0))
+        if nbytes == 0:
+            return 0
+        if hasattr(os, 'preadv'):
+            # read straight into the caller buffer
+            nread = os.preadv(self._descriptor(), [view[:nbytes]],
+                              self.offset + self._position)
+        else:
+            data = os.pread(self._descriptor(), nbytes,
+                            self.offset + self._position)
+            nread = len(data)
+            view[:nread] = data
+        self._position += nread
+        return nread
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,125 @@
+import pytest
+import yaml
+import os
+
+
+def build(files, varname='thetao', chunks={'time': 1}):
+    from history2CMIParchive.yaml_utils import create_build_history
+    return create_build_history('/archive/history', '/pp', 'zip', True,
+                                'time', chunks, 'gn', 'v1', 'OM4p25',
+                                'gfdl', varname, files)
+
+
+def test_record_builds(tmpdir):
+    from history2CMIParchive.build_catalog import record_builds
+    from history2CMIParchive.build_catalog import read_build_history
+    from history2CMIParchive.build_catalog import stores_built_from
+    from history2CMIParchive.build_catalog import list_stores
+
+    catalog = f'{tmpdir}/build_history.sqlite'
+    files = [{f'{year}0101.nc.tar': f'{year}0101.ocean_month.nc'}
+             for year in [1958, 1959, 1960]]
+
+    # bulk insert of the variables of an archive
+    nfiles = record_builds(catalog, [('/pp/Omon/thetao', build(files[:1])),
+                                     ('/pp/Omon/so',
+                                      build(files[:1], varname='so'))])
+    assert nfiles == 2
+    assert list_stores(catalog) == [('/pp/Omon/so', 'so'),
+                                    ('/pp/Omon/thetao', 'thetao')]
+
+    # appends keep their order, files already there are left alone
+    assert record_builds(catalog, [('/pp/Omon/thetao', build(files))]) == 2
+    assert record_builds(catalog, [('/pp/Omon/thetao',
+                                    build(files[1:2]))]) == 0
+    history = read_build_history(catalog, '/pp/Omon/thetao', 'thetao')
+    assert history == build(files)
+    assert read_build_history(catalog, '/pp/Omon/uo', 'uo') is None
+
+    # indexed by source file
+    assert stores_built_from(catalog, '19580101.nc.tar') == \
+        [('/pp/Omon/so', 'so'), ('/pp/Omon/thetao', 'thetao')]
+    assert stores_built_from(catalog, '19590101.nc.tar',
+                             '19590101.ocean_month.nc') == \
+        [('/pp/Omon/thetao', 'thetao')]
+
+    # the build options cannot change, unless the store is overwritten
+    with pytest.raises(ValueError):
+        record_builds(catalog, [('/pp/Omon/thetao',
+                                 build(files, chunks={'time': 12}))])
+    # or the store is left out, the others are recorded
+    failed = []
+    assert record_builds(catalog, [('/pp/Omon/thetao',
+                                    build(files, chunks={'time': 12})),
+                                   ('/pp/Omon/so',
+                                    build(files, varname='so'))],
+                         failed=failed) == 2
+    assert [(storepath, e.__class__) for storepath, _, e in failed] == \
+        [('/pp/Omon/thetao', ValueError)]
+    assert read_build_history(catalog, '/pp/Omon/so', 'so') == \
+        build(files, varname='so')
+    assert read_build_history(catalog, '/pp/Omon/thetao', 'thetao') == \
+        build(files)
+    record_builds(catalog, [('/pp/Omon/thetao',
+                             build(files[2:], chunks={'time': 12}))],
+                  overwrite=True)
+    history = read_build_history(catalog, '/pp/Omon/thetao', 'thetao')
+    assert history == build(files[2:], chunks={'time': 12})
+
+
+def test_export_yaml(tmpdir):
+    from history2CMIParchive.build_catalog import record_builds
+    from history2CMIParchive.build_catalog import export_yaml
+    from history2CMIParchive.yaml_utils import update_yaml
+    from history2CMIParchive.yaml_utils import update_yaml_layout
+
+    catalog = f'{tmpdir}/build_history.sqlite'
+    yamldir = f'{tmpdir}/yaml'
+    sqldir = f'{tmpdir}/sql'
+    os.makedirs(yamldir)
+    os.makedirs(sqldir)
+    for year in [1958, 1959, 1960, 1959]:
+        files = [{f'{year}0101.nc.tar': f'{year}0101.ocean_month.nc'}]
+        update_yaml(yamldir, 'thetao', build(files))
+        record_builds(catalog, [(sqldir, build(files))])
+    update_yaml_layout(sqldir, 'thetao', 'analysis', {'chunks': {'time': 3}})
+
+    assert export_yaml(catalog) == [f'{sqldir}/thetao.yml']
+    with open(f'{yamldir}/thetao.yml') as f:
+        expected = yaml.load(f, Loader=yaml.FullLoader)
+    with open(f'{sqldir}/thetao.yml') as f:
+        exported = yaml.load(f, Loader=yaml.FullLoader)
+    assert exported.pop('layouts') == {'analysis': {'chunks': {'time': 3}}}
+    assert exported == expected
+
+
+def test_convert_with_catalog(tmpdir):
+    from history2CMIParchive.synthetic import create_synthetic_history
+    from history2CMIParchive.datasets import convert_archive_to_zarr_store
+    from history2CMIParchive.build_catalog import catalog_path
+    from history2CMIParchive.build_catalog import export_yaml
+
+    archives = create_synthetic_history(f'{tmpdir}/history', [1, 2],
+                                        resolution=10, nvars=2, nz=2,
+                                        members=['ocean_month'])
+    histories = {}
+    for backend in ['yaml', 'sqlite']:
+        ppdir = f'{tmpdir}/pp_{backend}'
+        for archive in archives:
+            errors = convert_archive_to_zarr_store(
+                archive=archive, outputdir=ppdir, workdir=f'{tmpdir}/work',
+                storetype='directory', domain='auto', jobs=2,
+                history_backend=backend)
+            assert errors == []
+        storepath = f'{ppdir}/Omon/thetao/gn/v1'
+        if backend == 'sqlite':
+            # nothing written next to the stores until exported
+            assert not os.path.exists(f'{storepath}/thetao.yml')
+            assert f'{storepath}/thetao.yml' in \
+                export_yaml(catalog_path(ppdir))
+        with open(f'{storepath}/thetao.yml') as f:
+            histories[backend] = yaml.load(f, Loader=yaml.FullLoader)
+
+    assert len(histories['sqlite']['files']) == 2
+    for key in ['options', 'varname', 'files']:
+        assert histories['sqlite'][key] == histories['yaml'][key]
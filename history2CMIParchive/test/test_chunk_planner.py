@@ -0,0 +1,101 @@
+import xarray as xr
+import numpy as np
+import pytest
+
+MB = 1024 * 1024
+
+
+@pytest.mark.parametrize("records", [1, 12, 365])
+def test_plan_variable_chunks_2d(records):
+    from history2CMIParchive.chunk_planner import plan_variable_chunks
+
+    # OM4p25 2D field, 6 MB per record
+    shape = (records, 1080, 1440)
+    dims = ('time', 'yh', 'xh')
+    chunks = plan_variable_chunks(shape, dims, 4, target_bytes=32 * MB)
+    assert chunks['yh'] == 1080 and chunks['xh'] == 1440
+    # time chunk divides the number of records and fits the target
+    assert records % chunks['time'] == 0
+    assert chunks['time'] * 1080 * 1440 * 4 <= 32 * MB
+    if records == 12:
+        assert chunks['time'] == 4
+
+
+def test_plan_variable_chunks_3d():
+    from history2CMIParchive.chunk_planner import plan_variable_chunks
+
+    # OM4p125 3D field, a single level is 24 MB
+    shape = (365, 75, 2240, 2880)
+    dims = ('time', 'z_l', 'yh', 'xh')
+    chunks = plan_variable_chunks(shape, dims, 4, target_bytes=32 * MB)
+    assert chunks == {'time': 1, 'z_l': 1, 'yh': 2240, 'xh': 2880}
+
+    # smaller target: horizontal split once a level does not fit
+    chunks = plan_variable_chunks(shape, dims, 4, target_bytes=8 * MB)
+    assert chunks['z_l'] == 1 and chunks['xh'] == 2880
+    assert chunks['yh'] * 2880 * 4 <= 8 * MB
+
+    # records_per_file of the files, not the length of the batch
+    chunks = plan_variable_chunks((24, 35, 10, 20), dims, 8,
+                                  records_per_file=12, target_bytes=MB)
+    assert chunks == {'time': 12, 'z_l': 35, 'yh': 10, 'xh': 20}
+
+
+def test_export_planned_chunks(tmpdir):
+    from history2CMIParchive.datasets import export_nc_out_to_zarr_stores
+    import yaml
+
+    nt = 12
+    data = np.random.rand(nt, 5, 18, 36).astype('f4')
+    ds = xr.Dataset({'thetao': (['time', 'z_l', 'yh', 'xh'], data),
+                     'tos': (['time', 'yh', 'xh'], data[:, 0])},
+                    coords={'time': (['time'], np.arange(nt))})
+    ds.to_netcdf(f'{tmpdir}/ocean_monthly.nc')
+
+    # a level of thetao (or tos record) is 2.6 kB
+    export_nc_out_to_zarr_stores(ncfile=f'{tmpdir}/ocean_monthly.nc',
+                                 outputdir=f'{tmpdir}/pp', domain='auto',
+                                 chunk_target=8 * 1024)
+    storepath = f'{tmpdir}/pp/Omon/thetao/gn/v1'
+    check = xr.open_zarr(f'{storepath}/thetao')
+    assert check['thetao'].encoding['chunks'] == (1, 3, 18, 36)
+    assert check['thetao'].equals(ds['thetao'])
+    check = xr.open_zarr(f'{tmpdir}/pp/Omon/tos/gn/v1/tos')
+    assert check['tos'].encoding['chunks'] == (3, 18, 36)
+
+    with open(f'{storepath}/thetao.yml') as f:
+        history = yaml.load(f, Loader=yaml.FullLoader)
+    assert history['options']['chunks'] == {'time': 1, 'z_l': 3,
+                                            'yh': 18, 'xh': 36}
+
+
+@pytest.mark.parametrize("manifest", [True, False])
+def test_export_existing_store_chunks(tmpdir, manifest):
+    from history2CMIParchive.datasets import export_nc_out_to_zarr_stores
+    from history2CMIParchive.zarr_stores import time_manifest_path
+    import os
+
+    nt = 12
+    data = np.random.rand(2 * nt, 5, 18, 36).astype('f4')
+    for year in [1, 2]:
+        ds = xr.Dataset({'thetao': (['time', 'z_l', 'yh', 'xh'],
+                                    data[(year - 1) * nt:year * nt])},
+                        coords={'time': (['time'],
+                                         np.arange((year - 1) * nt,
+                                                   year * nt))})
+        ds.to_netcdf(f'{tmpdir}/{year:04d}0101.ocean_monthly.nc')
+
+    storepath = f'{tmpdir}/pp/Omon/thetao/gn/v1'
+    export_nc_out_to_zarr_stores(ncfile=f'{tmpdir}/00010101.ocean_monthly.nc',
+                                 outputdir=f'{tmpdir}/pp', domain='auto',
+                                 chunk_target=8 * 1024)
+    if not manifest:
+        os.remove(time_manifest_path(storepath, 'thetao'))
+    # another target would plan other chunks, the store keeps its own
+    errors = export_nc_out_to_zarr_stores(
+        ncfile=f'{tmpdir}/00020101.ocean_monthly.nc',
+        outputdir=f'{tmpdir}/pp', domain='auto', chunk_target=1024 * 1024)
+    assert errors == []
+    check = xr.open_zarr(f'{storepath}/thetao')
+    assert check['thetao'].encoding['chunks'] == (1, 3, 18, 36)
+    assert np.array_equal(check['thetao'].values, data)
@@ -0,0 +1,107 @@
+import xarray as xr
+import pytest
+import subprocess as sp
+import os
+
+
+@pytest.fixture(scope='module')
+def client(tmpdir_factory):
+    from history2CMIParchive.cluster import open_client
+    from history2CMIParchive.cluster import close_client
+    scheduler = {'workers': 2, 'threads_per_worker': 1,
+                 'memory_limit': '1GB'}
+    client = open_client(scheduler,
+                         local_directory=str(tmpdir_factory.mktemp('dask')))
+    yield client
+    close_client(client, scheduler)
+
+
+def test_scheduler_spec():
+    from history2CMIParchive.cluster import scheduler_spec
+
+    assert scheduler_spec() is None
+    assert scheduler_spec(address='tcp://host:8786', workers=2) == \
+        'tcp://host:8786'
+    assert scheduler_spec(workers=2, memory_limit='4GB') == \
+        {'workers': 2, 'threads_per_worker': 1, 'memory_limit': '4GB'}
+
+
+def test_open_client(client):
+    from history2CMIParchive.cluster import open_client
+    from history2CMIParchive.cluster import close_client
+
+    assert open_client(None) is None
+    # an open client is shared, not closed by the callee
+    assert open_client(client) is client
+    close_client(client, client)
+    assert len(client.scheduler_info()['workers']) == 2
+    assert client.submit(sum, [1, 2]).result() == 3
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_convert_archive_to_zarr_store_dask(tmpdir, client, stream):
+    from history2CMIParchive.synthetic import create_synthetic_history
+    from history2CMIParchive.datasets import convert_archive_to_zarr_store
+    from history2CMIParchive.profiling import enable_profiling
+    from history2CMIParchive.profiling import disable_profiling
+    from history2CMIParchive.profiling import read_profile
+
+    archives = create_synthetic_history(f'{tmpdir}/history', [1, 2],
+                                        resolution=30, nvars=2, nz=2,
+                                        members=['ocean_month',
+                                                 'ice_month'])
+    os.makedirs(f'{tmpdir}/work')
+    enable_profiling(f'{tmpdir}/profile.jsonl')
+    try:
+        for archive in archives:
+            errors = convert_archive_to_zarr_store(archive=archive,
+                                                   outputdir=f'{tmpdir}/pp',
+                                                   workdir=f'{tmpdir}/work',
+                                                   stream=stream,
+                                                   scheduler=client)
+            assert errors == []
+    finally:
+        disable_profiling()
+
+    for archive in archives:
+        _ = sp.check_call(f'cd {tmpdir}/history ; tar -xf {archive}',
+                          shell=True)
+    expected = xr.open_mfdataset([f'{tmpdir}/history/{year:04d}0101.'
+                                  f'ocean_month.nc' for year in [1, 2]],
+                                 combine='nested', concat_dim='time',
+                                 decode_times=False)
+    check_ds = xr.open_zarr(f'{tmpdir}/pp/Omon/thetao/gn/v1/thetao',
+                            decode_times=False)
+    assert check_ds['thetao'].equals(expected['thetao'])
+
+    # the tasks ran on the workers and recorded their memory
+    tasks = [r for r in read_profile(f'{tmpdir}/profile.jsonl')
+             if r['stage'] == 'dask_task']
+    assert len(tasks) > 0
+    assert all(r['worker'] in client.scheduler_info()['workers']
+               for r in tasks)
+    assert all(r['rss_peak'] >= r['rss_start'] > 0 for r in tasks)
+    expected_task = 'export_variable' if stream else 'convert_member'
+    assert set(r['task'] for r in tasks) == {expected_task}
+
+
+def test_export_nc_out_to_zarr_stores_dask(tmpdir):
+    from history2CMIParchive.synthetic import create_synthetic_history
+    from history2CMIParchive.datasets import export_nc_out_to_zarr_stores
+
+    create_synthetic_history(f'{tmpdir}/history', [1], resolution=30,
+                             nvars=2, nz=2, members=['ocean_month'])
+    _ = sp.check_call(f'cd {tmpdir}/history ; tar -xf 00010101.nc.tar',
+                      shell=True)
+    ncfile = f'{tmpdir}/history/00010101.ocean_month.nc'
+
+    # a local cluster started and stopped for the file
+    errors = export_nc_out_to_zarr_stores(ncfile=ncfile,
+                                          outputdir=f'{tmpdir}/pp',
+                                          domain='OM4',
+                                          scheduler={'workers': 1})
+    assert errors == []
+    expected = xr.open_dataset(ncfile, decode_times=False)
+    check_ds = xr.open_zarr(f'{tmpdir}/pp/Omon/thetao/gn/v1/thetao',
+                            decode_times=False)
+    assert check_ds['thetao'].equals(expected['thetao'])
@@ -289,3 +289,291 @@ def test_convert_archive_to_zarr_store(tmpdir, storetype, consolidated,
             store_history = yaml.load(f, Loader=yaml.FullLoader)
             f.close()
         assert len(store_history['files']) == 1
+
+
+@pytest.mark.parametrize("ncformat", ['NETCDF4', 'NETCDF3_64BIT'])
+def test_convert_archive_to_zarr_store_in_place(tmpdir, ncformat):
+    from history2CMIParchive.datasets import convert_archive_to_zarr_store
+
+    hisdir = f'{tmpdir}/history'
+    workdir = f'{tmpdir}/tmp'
+    ppdir = f'{tmpdir}/pp'
+    os.makedirs(hisdir)
+    os.makedirs(workdir)
+
+    ds_1 = define_test_dataset(resolution=5, nt=12)
+    ds_1.to_netcdf(f'{hisdir}/ocean_monthly.nc', format=ncformat)
+    _ = sp.check_call(f'cd {hisdir} ; tar -cf 1900101.tar ocean_monthly.nc',
+                      shell=True)
+
+    convert_archive_to_zarr_store(archive=f'{hisdir}/1900101.tar',
+                                  outputdir=ppdir, workdir=workdir,
+                                  storetype='directory', domain='OM4',
+                                  extract=False)
+
+    # nothing was copied to the work directory
+    assert os.listdir(workdir) == []
+    check_ds = xr.open_zarr(f'{ppdir}/Omon/thetao/gn/v1/thetao')
+    assert check_ds['thetao'].equals(ds_1['thetao'])
+
+
+def test_convert_archive_to_zarr_store_stream(tmpdir):
+    from history2CMIParchive.datasets import convert_archive_to_zarr_store
+
+    hisdir = f'{tmpdir}/history'
+    workdir = f'{tmpdir}/tmp'
+    ppdir = f'{tmpdir}/pp'
+    os.makedirs(hisdir)
+    os.makedirs(workdir)
+
+    ds_1 = define_test_dataset(resolution=5, nt=12)
+    ds_1.to_netcdf(f'{hisdir}/ocean_monthly.nc')
+    ds_1.to_netcdf(f'{hisdir}/ocean_static.nc')
+    _ = sp.check_call(f'cd {hisdir} ; tar -czf 1900101.tar.gz *.nc',
+                      shell=True)
+
+    convert_archive_to_zarr_store(archive=f'{hisdir}/1900101.tar.gz',
+                                  outputdir=ppdir, workdir=workdir,
+                                  ignore_types=['static'],
+                                  storetype='directory', domain='OM4',
+                                  stream=True)
+
+    # converted members are removed, ignored ones never extracted
+    assert os.listdir(workdir) == []
+    assert not os.path.exists(f'{ppdir}/Ofx')
+    check_ds = xr.open_zarr(f'{ppdir}/Omon/thetao/gn/v1/thetao')
+    assert check_ds['thetao'].equals(ds_1['thetao'])
+
+
+@pytest.mark.parametrize("parallel", ['thread', 'process'])
+def test_export_nc_out_to_zarr_stores_parallel(tmpdir, parallel):
+    from history2CMIParchive.datasets import export_nc_out_to_zarr_stores
+
+    ds_1 = define_test_dataset(resolution=5, nt=12)
+    ds_1.to_netcdf(f'{tmpdir}/ocean_monthly.nc')
+    ppdir = f'{tmpdir}/pp'
+
+    # a file in place of the so store directory makes its write fail
+    os.makedirs(f'{ppdir}/Omon/so/gn')
+    _ = sp.check_call(f'touch {ppdir}/Omon/so/gn/v1', shell=True)
+
+    errors = export_nc_out_to_zarr_stores(ncfile=f'{tmpdir}/ocean_monthly.nc',
+                                          outputdir=ppdir, domain='OM4',
+                                          jobs=4, parallel=parallel)
+
+    # the other variables are written, the failure is reported
+    assert len(errors) == 1
+    assert errors[0]['variable'] == 'so'
+    check_ds = xr.open_zarr(f'{ppdir}/Omon/thetao/gn/v1/thetao')
+    assert check_ds['thetao'].equals(ds_1['thetao'])
+    for variable in ['time', 'xh', 'yh', 'z_l']:
+        assert os.path.exists(f'{ppdir}/Omon/{variable}/gn/v1/{variable}.yml')
+
+
+def test_convert_archive_to_zarr_store_nprocs(tmpdir):
+    from history2CMIParchive.datasets import convert_archive_to_zarr_store
+
+    hisdir = f'{tmpdir}/history'
+    workdir = f'{tmpdir}/tmp'
+    ppdir = f'{tmpdir}/pp'
+    os.makedirs(hisdir)
+    os.makedirs(workdir)
+
+    ds_1 = define_test_dataset(resolution=5, nt=12)
+    ds_1.to_netcdf(f'{hisdir}/ocean_monthly.nc')
+    ds_1.to_netcdf(f'{hisdir}/ice_monthly.nc')
+    ds_2 = define_test_dataset(resolution=5, nt=1)
+    ds_2.to_netcdf(f'{hisdir}/ocean_annual.nc')
+    _ = sp.check_call(f'cd {hisdir} ; tar -cf 1900101.tar *.nc', shell=True)
+
+    errors = convert_archive_to_zarr_store(archive=f'{hisdir}/1900101.tar',
+                                           outputdir=ppdir, workdir=workdir,
+                                           storetype='directory',
+                                           domain='OM4', nprocs=3)
+
+    assert errors == []
+    for code, ds in zip(['Omon', 'SImon', 'Oyr'], [ds_1, ds_1, ds_2]):
+        check_ds = xr.open_zarr(f'{ppdir}/{code}/thetao/gn/v1/thetao')
+        assert check_ds['thetao'].equals(ds['thetao'])
+
+
+@pytest.mark.parametrize("batch", [{'batch_years': 2},
+                                   {'batch_bytes': 1},
+                                   {}])
+def test_convert_archives_to_zarr_store(tmpdir, batch):
+    from history2CMIParchive.datasets import convert_archives_to_zarr_store
+
+    hisdir = f'{tmpdir}/history'
+    workdir = f'{tmpdir}/tmp'
+    ppdir = f'{tmpdir}/pp'
+    os.makedirs(hisdir)
+    os.makedirs(workdir)
+
+    # three years of monthly and annual files
+    archives = []
+    ds_month, ds_annual = [], []
+    for k, year in enumerate([1900, 1901, 1902]):
+        ds_1 = define_test_dataset(resolution=5, nt=12)
+        ds_1['time'] = ds_1['time'] + 12 * k
+        ds_1.to_netcdf(f'{hisdir}/{year}0101.ocean_month.nc')
+        ds_2 = define_test_dataset(resolution=5, nt=1)
+        ds_2['time'] = ds_2['time'] + k
+        ds_2.to_netcdf(f'{hisdir}/{year}0101.ocean_annual.nc')
+        _ = sp.check_call(f'cd {hisdir} ; tar -cf {year}0101.nc.tar '
+                          f'{year}0101.*.nc ; rm {year}0101.*.nc',
+                          shell=True)
+        archives.append(f'{hisdir}/{year}0101.nc.tar')
+        ds_month.append(ds_1)
+        ds_annual.append(ds_2)
+
+    errors = convert_archives_to_zarr_store(archives=archives,
+                                            outputdir=ppdir, workdir=workdir,
+                                            storetype='directory',
+                                            domain='OM4', **batch)
+    assert errors == []
+    assert os.listdir(workdir) == []
+
+    check_ds = xr.open_zarr(f'{ppdir}/Omon/thetao/gn/v1/thetao')
+    assert check_ds['thetao'].equals(xr.concat(ds_month, dim='time')['thetao'])
+    check_ds = xr.open_zarr(f'{ppdir}/Oyr/thetao/gn/v1/thetao')
+    assert check_ds['thetao'].equals(xr.concat(ds_annual,
+                                               dim='time')['thetao'])
+
+    with open(f'{ppdir}/Omon/thetao/gn/v1/thetao.yml') as f:
+        store_history = yaml.load(f, Loader=yaml.FullLoader)
+    assert len(store_history['files']) == 3
+
+
+def test_member_type():
+    from history2CMIParchive.datasets import member_type
+
+    assert member_type('./19580101.ocean_month.nc') == 'ocean_month.nc'
+    assert member_type('ocean_month.nc') == 'ocean_month.nc'
+
+
+@pytest.mark.parametrize("batched", [False, True])
+def test_convert_archive_to_zarr_store_recall(tmpdir, batched):
+    from history2CMIParchive.datasets import convert_archive_to_zarr_store
+    from history2CMIParchive.datasets import convert_archives_to_zarr_store
+
+    hisdir = f'{tmpdir}/history'
+    workdir = f'{tmpdir}/tmp'
+    ppdir = f'{tmpdir}/pp'
+    os.makedirs(hisdir)
+    os.makedirs(workdir)
+
+    archives, datasets = [], []
+    for k, year in enumerate([1900, 1901]):
+        ds = define_test_dataset(resolution=5, nt=12)
+        ds['time'] = ds['time'] + 12 * k
+        ds.to_netcdf(f'{hisdir}/{year}0101.ocean_month.nc')
+        ds.isel(time=slice(0, 1)).to_netcdf(
+            f'{hisdir}/{year}0101.ocean_annual.nc')
+        _ = sp.check_call(f'cd {hisdir} ; tar -cf {year}0101.nc.tar '
+                          f'{year}0101.*.nc ; rm {year}0101.*.nc',
+                          shell=True)
+        archives.append(f'{hisdir}/{year}0101.nc.tar')
+        datasets.append(ds)
+
+    # stand-in for the tape system, slow and logging its calls
+    log = f'{tmpdir}/recall.log'
+    kwargs = {'outputdir': ppdir, 'workdir': workdir, 'storetype': 'zip',
+              'domain': 'OM4',
+              'recall_command': f'sleep 0.5 ; echo {{files}} >> {log}'}
+    errors = convert_archive_to_zarr_store(archive=archives[0], **kwargs)
+    assert errors == []
+    # nothing to recall when the stores are created
+    assert not os.path.exists(log)
+
+    if batched:
+        errors = convert_archives_to_zarr_store(archives=archives[1:],
+                                                **kwargs)
+    else:
+        errors = convert_archive_to_zarr_store(archive=archives[1], **kwargs)
+    assert errors == []
+
+    # a single recall covered every store of both members
+    with open(log) as f:
+        lines = f.readlines()
+    assert len(lines) == 1
+    recalled = lines[0].split()
+    for code in ['Omon', 'Oyr']:
+        for variable in ['thetao', 'so', 'time']:
+            fstore = f'{ppdir}/{code}/{variable}/gn/v1/{variable}.zip'
+            assert os.path.abspath(fstore) in recalled
+
+    check_ds = xr.open_zarr(f'{ppdir}/Omon/thetao/gn/v1/thetao.zip')
+    assert check_ds['thetao'].equals(xr.concat(datasets,
+                                               dim='time')['thetao'])
+
+
+def count_opens(monkeypatch):
+    """ count the calls to xarray.open_dataset from datasets """
+    from history2CMIParchive import datasets
+    opens = []
+    open_dataset = datasets._xr.open_dataset
+
+    def counting_open_dataset(*args, **kwargs):
+        opens.append(args[0])
+        return open_dataset(*args, **kwargs)
+    monkeypatch.setattr(datasets._xr, 'open_dataset', counting_open_dataset)
+    return opens
+
+
+def test_inspect_ncfile(tmpdir, monkeypatch):
+    from history2CMIParchive.datasets import inspect_ncfile
+    from history2CMIParchive.datasets import define_component_code
+    from history2CMIParchive.datasets import open_dataset
+
+    ds = define_test_dataset(resolution=10, nz=3, nt=12)
+    ncfile = f'{tmpdir}/19000101.ocean_unknown_freq.nc'
+    ds.to_netcdf(ncfile)
+
+    opens = count_opens(monkeypatch)
+    spec = inspect_ncfile(ncfile)
+    assert spec['dims'] == {'time': 12, 'z': 3, 'y': 18, 'x': 36,
+                            'xh': 36, 'yh': 18, 'z_l': 3}
+    assert spec['variables']['thetao'] == {'dims': ['time', 'z', 'y', 'x'],
+                                           'shape': [12, 3, 18, 36],
+                                           'dtype': 'float64'}
+    assert spec['ntimes'] == 12
+    assert spec['frequency'] == 'mon'
+    assert len(opens) == 1
+
+    # the spec is cached, the component code needs no open
+    assert inspect_ncfile(ncfile) is spec
+    assert define_component_code(ncfile) == 'Omon'
+    assert len(opens) == 1
+
+    # chunked open in a single pass
+    ds_open = open_dataset(ncfile, {'time': 1, 'z': 1}, spec=spec)
+    assert len(opens) == 2
+    assert ds_open['thetao'].chunks[:2] == ((1,) * 12, (1,) * 3)
+    ds_open.close()
+
+    # a rewritten file is inspected again
+    ds.isel(time=slice(0, 1)).to_netcdf(ncfile)
+    assert inspect_ncfile(ncfile)['frequency'] == 'yr'
+    assert len(opens) == 3
+
+    # file objects other than tar members are not cached
+    for k in range(2):
+        with open(ncfile, 'rb') as fileobj:
+            assert inspect_ncfile(ncfile, fileobj=fileobj)['ntimes'] == 1
+    assert len(opens) == 5
+
+
+def test_export_nc_out_to_zarr_stores_opens(tmpdir, monkeypatch):
+    from history2CMIParchive.datasets import export_nc_out_to_zarr_stores
+
+    ncfile = f'{tmpdir}/19000101.ocean_unknown_freq.nc'
+    define_test_dataset(resolution=10, nz=3, nt=12).to_netcdf(ncfile)
+
+    opens = count_opens(monkeypatch)
+    errors = export_nc_out_to_zarr_stores(ncfile=ncfile,
+                                          outputdir=f'{tmpdir}/pp',
+                                          domain='OM4')
+    assert errors == []
+    # header read once, then the chunked open
+    assert len(opens) == 2
+    assert os.path.exists(f'{tmpdir}/pp/Omon/thetao/gn/v1/thetao')
@@ -0,0 +1,66 @@
+import xarray as xr
+import numpy as np
+import pytest
+
+
+def test_make_compressor():
+    from history2CMIParchive.encoding import make_compressor
+    from numcodecs import Blosc
+
+    codec = make_compressor('zstd:3:bitshuffle')
+    assert codec.cname == 'zstd'
+    assert codec.clevel == 3
+    assert codec.shuffle == Blosc.BITSHUFFLE
+    codec = make_compressor('lz4')
+    assert codec.clevel == 5 and codec.shuffle == Blosc.SHUFFLE
+    assert make_compressor(None) is None
+    with pytest.raises(ValueError):
+        make_compressor('snappy:5')
+    with pytest.raises(ValueError):
+        make_compressor('lz4:5:twist')
+
+
+def test_write_with_compressor(tmpdir):
+    from history2CMIParchive.datasets import export_nc_out_to_zarr_stores
+
+    nt = 12
+    data = np.random.rand(nt, 10, 20)
+    ds = xr.Dataset({'tos': (['time', 'yh', 'xh'], data),
+                     'sos': (['time', 'yh', 'xh'], data)},
+                    coords={'time': (['time'], np.arange(nt))})
+    ds.to_netcdf(f'{tmpdir}/ocean_monthly.nc')
+    ppdir = f'{tmpdir}/pp'
+    export_nc_out_to_zarr_stores(ncfile=f'{tmpdir}/ocean_monthly.nc',
+                                 outputdir=ppdir, domain='OM4',
+                                 compressor='zstd:3:bitshuffle',
+                                 codec_overrides={'sos': 'lz4:1:noshuffle'})
+    tos = xr.open_zarr(f'{ppdir}/Omon/tos/gn/v1/tos')
+    assert tos['tos'].encoding['compressor'].cname == 'zstd'
+    sos = xr.open_zarr(f'{ppdir}/Omon/sos/gn/v1/sos')
+    assert sos['sos'].encoding['compressor'].cname == 'lz4'
+    assert sos['sos'].encoding['compressor'].clevel == 1
+
+    # appends keep the codec of the store
+    ds['time'] = ds['time'] + nt
+    ds.to_netcdf(f'{tmpdir}/ocean_monthly_2.nc')
+    export_nc_out_to_zarr_stores(ncfile=f'{tmpdir}/ocean_monthly_2.nc',
+                                 outputdir=ppdir, domain='OM4',
+                                 compressor='lz4:5:shuffle')
+    tos = xr.open_zarr(f'{ppdir}/Omon/tos/gn/v1/tos')
+    assert len(tos['time']) == 2 * nt
+    assert tos['tos'].encoding['compressor'].cname == 'zstd'
+
+
+def test_benchmark_codecs():
+    from history2CMIParchive.encoding import benchmark_codecs
+
+    data = np.round(np.random.rand(12, 50, 60), 2)
+    ds = xr.Dataset({'tos': (['time', 'yh', 'xh'], data)}).chunk({'time': 1})
+    report = benchmark_codecs(ds, candidates=['lz4:5:shuffle', 'zstd:9'],
+                              nsample=3, repeat=1)
+    assert len(report) == 2
+    for record in report:
+        assert record['variable'] == 'tos'
+        assert record['ratio'] > 1
+        assert record['compress_MBps'] > 0
+        assert record['decompress_MBps'] > 0
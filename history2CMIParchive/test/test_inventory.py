@@ -0,0 +1,105 @@
+import xarray as xr
+import numpy as np
+import pytest
+import csv
+import os
+
+
+def test_audit_time_axis():
+    from history2CMIParchive.inventory import audit_time_axis
+
+    # mid-month times of a noleap calendar, month lengths vary
+    bounds = np.cumsum([0] + [31, 28, 31, 30, 31, 30,
+                              31, 31, 30, 31, 30, 31] * 2)
+    monthly = 0.5 * (bounds[:-1] + bounds[1:])
+    audit = audit_time_axis(monthly)
+    assert audit['nt'] == 24
+    assert audit['first'] == 15.5
+    assert audit['last'] == monthly[-1]
+    for key in ['gaps', 'duplicates', 'decreasing', 'irregular']:
+        assert audit[key] == 0
+
+    # a missing month, a repeated month, a year written twice
+    audit = audit_time_axis(np.concatenate([monthly[:5], monthly[6:]]))
+    assert audit['gaps'] == 1
+    audit = audit_time_axis(np.concatenate([monthly[:5], monthly[4:]]))
+    assert audit['duplicates'] == 1
+    audit = audit_time_axis(np.concatenate([monthly, monthly[12:]]))
+    assert audit['decreasing'] == 1
+    assert audit['gaps'] == 0
+
+    audit = audit_time_axis(np.array([]))
+    assert audit['nt'] == 0 and audit['first'] is None
+
+
+@pytest.mark.parametrize("jobs, parallel", [(1, 'thread'), (2, 'thread'),
+                                            (2, 'process')])
+def test_inventory_stores(tmpdir, jobs, parallel):
+    from history2CMIParchive.synthetic import create_synthetic_history
+    from history2CMIParchive.datasets import convert_archive_to_zarr_store
+    from history2CMIParchive.inventory import inventory_stores
+    from history2CMIParchive.inventory import write_inventory
+
+    archives = create_synthetic_history(f'{tmpdir}/history', [1, 2],
+                                        resolution=10, nvars=1, nz=2,
+                                        members=['ocean_month'])
+    ppdir = f'{tmpdir}/pp'
+    for archive in archives:
+        for storetype, tag in [('directory', 'v1'), ('zip', 'v2')]:
+            errors = convert_archive_to_zarr_store(
+                archive=archive, outputdir=ppdir, workdir=f'{tmpdir}/work',
+                storetype=storetype, domain='auto', tag=tag)
+            assert errors == []
+
+    # a store with a missing month and one written twice
+    storepath = f'{ppdir}/Omon/thetao/gn/v1'
+    ds = xr.open_zarr(f'{storepath}/thetao', decode_times=False)
+    bad = xr.concat([ds.isel(time=slice(0, 5)), ds.isel(time=slice(6, 24)),
+                     ds.isel(time=slice(12, 24))], dim='time').load()
+    for var in bad.variables:
+        bad[var].encoding = {}
+    bad.to_zarr(f'{ppdir}/Omon/thetao/gn/v3/thetao', consolidated=True)
+    # leftover of an interrupted write
+    os.makedirs(f'{ppdir}/Omon/thetao/gn/v2/thetao.zip_tmp')
+    os.makedirs(f'{ppdir}/Omon/thetao/gn/v4/thetao_tmp')
+
+    rows = inventory_stores(ppdir, jobs=jobs, parallel=parallel)
+    # coordinates have their own stores
+    assert ('Omon', 'z_l', 'gn', 'v1') in \
+        [(row['component'], row['variable'], row['grid'], row['tag'])
+         for row in rows]
+    rows = {(row['tag'], row['storetype']): row for row in rows
+            if row['variable'] == 'thetao'}
+    assert sorted(rows) == [('v1', 'directory'), ('v2', 'zip'),
+                            ('v3', 'directory'), ('v4', None)]
+
+    for tag in ['v1', 'v2']:
+        row = rows[(tag, 'directory' if tag == 'v1' else 'zip')]
+        assert row['shape'][0] == 24 and row['nt'] == 24
+        assert row['dims'][0] == 'time'
+        assert row['chunks'][0] == 12
+        assert row['time_first'] == ds['time'].values[0]
+        assert row['time_last'] == ds['time'].values[-1]
+        assert row['time_units'] == ds['time'].attrs['units']
+        assert row['bytes'] > 0
+        assert row['error'] is None
+    assert rows[('v1', 'directory')]['files'] > 1
+    assert rows[('v1', 'directory')]['flags'] == ''
+    assert rows[('v2', 'zip')]['files'] == 1
+    assert rows[('v2', 'zip')]['flags'] == 'tmp_store'
+
+    row = rows[('v3', 'directory')]
+    assert row['nt'] == 35
+    assert (row['gaps'], row['decreasing'], row['duplicates']) == (1, 1, 0)
+    assert row['flags'] == 'gaps;decreasing'
+    assert rows[('v4', None)]['flags'] == 'tmp_store'
+    assert rows[('v4', None)]['error'] == 'missing store'
+
+    csvfile = f'{tmpdir}/inventory.csv'
+    write_inventory(list(rows.values()), csvfile)
+    with open(csvfile, newline='') as f:
+        table = list(csv.DictReader(f))
+    assert len(table) == 4
+    assert table[0]['shape'] == 'x'.join(
+        [str(n) for n in rows[('v1', 'directory')]['shape']])
+    assert table[0]['dims'].startswith('time,')
@@ -0,0 +1,113 @@
+import xarray as xr
+import numpy as np
+import pytest
+import os
+
+
+members = ['ocean_month', 'ocean_annual_rho2']
+
+
+@pytest.fixture
+def history(tmpdir):
+    from history2CMIParchive.synthetic import create_synthetic_history
+
+    hisdir = f'{tmpdir}/history'
+    create_synthetic_history(hisdir, [1, 2, 3], resolution=10, nvars=2,
+                             nz=2, members=members)
+    return hisdir
+
+
+def test_room_for_archive():
+    from history2CMIParchive.pipeline import room_for_archive
+
+    # the next archive to convert always goes through
+    assert room_for_archive(0, 0, 100, lookahead=1, scratch_limit=10)
+    assert room_for_archive(1, 50, 40, lookahead=1, scratch_limit=100)
+    assert not room_for_archive(1, 50, 60, lookahead=1, scratch_limit=100)
+    assert not room_for_archive(2, 0, 1, lookahead=1)
+    assert room_for_archive(2, 0, 1, lookahead=2)
+
+
+@pytest.mark.parametrize("lookahead", [1, 2])
+@pytest.mark.parametrize("scratch_limit", [None, 1])
+def test_convert_year_range(tmpdir, history, lookahead, scratch_limit):
+    from history2CMIParchive.pipeline import convert_year_range
+    from history2CMIParchive.synthetic import define_member_dataset
+    from history2CMIParchive.synthetic import default_members
+
+    ppdir = f'{tmpdir}/pp'
+    workdir = f'{tmpdir}/work'
+    log = f'{tmpdir}/recall.log'
+    errors = convert_year_range(history, ppdir, workdir, 1, 3,
+                                lookahead=lookahead,
+                                scratch_limit=scratch_limit,
+                                recall_command=f'echo {{files}} >> {log}',
+                                storetype='directory', domain='auto')
+    assert errors == []
+
+    # each archive recalled once (the look-ahead ones concurrently)
+    with open(log) as f:
+        recalled = [os.path.basename(line.strip()) for line in f]
+    assert sorted(recalled) == ['00010101.nc.tar', '00020101.nc.tar',
+                                '00030101.nc.tar']
+
+    # stores appended in year order, scratch cleaned up
+    for member, code in zip(members, ['Omon', 'Oyr']):
+        expected = xr.concat([define_member_dataset(
+            member, default_members[member], year, resolution=10, nvars=2,
+            nz=2) for year in [1, 2, 3]], dim='time')
+        grid = 'gn_rho2' if 'rho2' in member else 'gn'
+        check_ds = xr.open_zarr(f'{ppdir}/{code}/thetao/{grid}/v1/thetao',
+                                decode_times=False)
+        assert np.array_equal(check_ds['time'].values,
+                              expected['time'].values)
+        assert np.allclose(check_ds['thetao'].values,
+                           expected['thetao'].values)
+    assert os.listdir(workdir) == ['.index']
+
+
+def test_convert_year_range_overlap(tmpdir, history):
+    from history2CMIParchive.pipeline import convert_year_range
+    from history2CMIParchive.profiling import enable_profiling
+    from history2CMIParchive.profiling import disable_profiling
+    from history2CMIParchive.profiling import read_profile
+
+    profile = f'{tmpdir}/profile.jsonl'
+    enable_profiling(profile)
+    try:
+        errors = convert_year_range(history, f'{tmpdir}/pp',
+                                    f'{tmpdir}/work', 1, 3, lookahead=1,
+                                    recall_command='sleep 0.5 ; ls {files}',
+                                    storetype='directory', domain='auto')
+    finally:
+        disable_profiling()
+    assert errors == []
+
+    records = read_profile(profile)
+    start = {(r['stage'], r['file']): r['start'] for r in records
+             if r['stage'] in ['recall_archive', 'convert_archive']}
+    end = {(r['stage'], r['file']): r['start'] + r['wall_time']
+           for r in records
+           if r['stage'] in ['recall_archive', 'convert_archive']}
+    # the next year is recalled while the current one converts
+    assert start[('recall_archive', '00020101.nc.tar')] < \
+        end[('convert_archive', '00010101.nc.tar')]
+    # and years are converted in order
+    assert end[('convert_archive', '00010101.nc.tar')] <= \
+        start[('convert_archive', '00020101.nc.tar')]
+
+
+def test_convert_year_range_missing_year(tmpdir, history):
+    from history2CMIParchive.pipeline import convert_year_range
+
+    ppdir = f'{tmpdir}/pp'
+    os.remove(f'{history}/00020101.nc.tar')
+    errors = convert_year_range(history, ppdir, f'{tmpdir}/work', 1, 3,
+                                storetype='directory', domain='auto')
+    assert len(errors) == 1
+    assert errors[0]['file'].endswith('00020101.nc.tar')
+
+    # year 3 is not appended after the gap
+    check_ds = xr.open_zarr(f'{ppdir}/Omon/thetao/gn/v1/thetao',
+                            decode_times=False)
+    assert len(check_ds['time']) == 12
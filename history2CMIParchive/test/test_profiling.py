@@ -0,0 +1,90 @@
+import pytest
+
+
+@pytest.fixture
+def profile(tmpdir):
+    from history2CMIParchive.profiling import enable_profiling
+    from history2CMIParchive.profiling import disable_profiling
+    path = f'{tmpdir}/profile.jsonl'
+    enable_profiling(path)
+    yield path
+    disable_profiling()
+
+
+def test_stage(tmpdir):
+    from history2CMIParchive.profiling import stage
+    from history2CMIParchive.profiling import profile_file
+
+    # disabled: nothing is written
+    assert profile_file() is None
+    with stage('noop') as record:
+        record['chunks'] = 1
+
+
+def test_untimed(profile):
+    from history2CMIParchive.profiling import stage
+    from history2CMIParchive.profiling import untimed
+    from history2CMIParchive.profiling import read_profile
+    import time
+
+    with stage('measured') as record:
+        with untimed(record):
+            time.sleep(0.2)
+            record['bytes_written'] = 1
+    record = read_profile(profile)[0]
+    assert record['wall_time'] < 0.1
+    assert record['bytes_written'] == 1
+    assert 'untimed' not in record
+
+
+def test_memory_sampler():
+    from history2CMIParchive.profiling import memory_sampler
+    import numpy as np
+    import time
+
+    record = {}
+    with memory_sampler(record, interval=0.01):
+        block = np.ones(50 * 1024 * 1024 // 8)
+        time.sleep(0.1)
+        del block
+    assert record['rss_peak'] >= record['rss_start'] + 40 * 1024 * 1024
+    assert record['rss_peak'] >= record['rss_end']
+
+
+@pytest.mark.parametrize("nprocs", [1, 2])
+def test_profile_conversion(tmpdir, profile, nprocs):
+    from history2CMIParchive.synthetic import create_synthetic_history
+    from history2CMIParchive.datasets import convert_archive_to_zarr_store
+    from history2CMIParchive.profiling import read_profile
+    from history2CMIParchive.profiling import summarize_profile
+
+    archives = create_synthetic_history(f'{tmpdir}/history', [1, 2],
+                                        resolution=30, nvars=2, nz=2,
+                                        members=['ocean_month',
+                                                 'ocean_static'])
+    for archive in archives:
+        convert_archive_to_zarr_store(archive=archive,
+                                      outputdir=f'{tmpdir}/pp',
+                                      workdir=f'{tmpdir}/work',
+                                      nprocs=nprocs)
+
+    records = read_profile(profile)
+    stages = set(record['stage'] for record in records)
+    assert {'extract', 'export_file', 'open_dataset', 'appending_needed',
+            'write_store', 'time_manifest', 'update_yaml',
+            'lock_wait'} <= stages
+    writes = [r for r in records if r['stage'] == 'write_store' and
+              r['variable'] == 'thetao' and 'ocean_month' in r['file']]
+    writes.sort(key=lambda r: r['file'])
+    assert len(writes) == 2
+    assert writes[0]['mode'] == 'w'
+    assert writes[1]['mode'] == 'a'
+    assert writes[1]['bytes_read'] == 12 * 2 * 6 * 12 * 4
+    assert writes[1]['bytes_written'] > 0
+    # OM4p25 preset: 12 records, 1 level
+    assert writes[1]['chunks'] == 2
+
+    summary = summarize_profile(profile, top=3)
+    assert len(summary['hotspots']) == 3
+    totals = [entry['total_time'] for entry in summary['stages']]
+    assert totals == sorted(totals, reverse=True)
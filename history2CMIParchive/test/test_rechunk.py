@@ -0,0 +1,119 @@
+import xarray as xr
+import numpy as np
+import pytest
+import yaml
+import os
+
+
+def create_test_store(storepath, storetype, nt=24):
+    """ store chunked for appending: 1 record, 1 level """
+    data = np.random.rand(nt, 3, 20, 30).astype('f4')
+    ds = xr.Dataset({'thetao': (['time', 'z_l', 'yh', 'xh'], data)},
+                    coords={'time': (['time'], np.arange(nt)),
+                            'yh': (['yh'], np.arange(20.)),
+                            'xh': (['xh'], np.arange(30.))})
+    ds = ds.chunk({'time': 1, 'z_l': 1})
+    os.makedirs(storepath, exist_ok=True)
+    fstore = f'{storepath}/thetao' if storetype == 'directory' else \
+        f'{storepath}/thetao.zip'
+    ds.to_zarr(fstore, mode='w', consolidated=True)
+    return ds
+
+
+@pytest.mark.parametrize("storetype", ['directory', 'zip'])
+@pytest.mark.parametrize("max_mem", [2 ** 14, 2 ** 20])
+def test_rechunk_store(tmpdir, storetype, max_mem):
+    from history2CMIParchive.rechunk import rechunk_store
+
+    storepath = f'{tmpdir}/Omon/thetao/gn/v1'
+    ds = create_test_store(storepath, storetype)
+    target = {'time': -1, 'yh': 10, 'xh': 10}
+    fout = rechunk_store(storepath, 'thetao', target, storetype=storetype,
+                         max_mem=max_mem)
+
+    check = xr.open_zarr(fout)
+    assert check['thetao'].encoding['chunks'] == (24, 1, 10, 10)
+    assert check['thetao'].equals(ds['thetao'])
+    assert check['xh'].equals(ds['xh'])
+    leftovers = [f for f in os.listdir(storepath)
+                 if 'intermediate' in f or 'staging' in f or
+                 'rechunk' in f]
+    assert leftovers == []
+
+    with open(f'{storepath}/thetao.yml') as f:
+        history = yaml.load(f, Loader=yaml.FullLoader)
+    assert history['layouts']['analysis']['store'] == fout
+    assert history['layouts']['analysis']['chunks']['time'] == 24
+
+
+def test_rechunk_store_resume(tmpdir, monkeypatch):
+    from history2CMIParchive.rechunk import rechunk_store
+    from history2CMIParchive.rechunk import read_progress
+    import history2CMIParchive.rechunk as rechunk
+
+    storepath = f'{tmpdir}/Omon/thetao/gn/v1'
+    ds = create_test_store(storepath, 'directory')
+    target = {'time': -1, 'yh': 10, 'xh': 10}
+
+    # interrupted during the second stage
+    calls = {'n': 0}
+    write_progress = rechunk.write_progress
+
+    def crash(progress_file, progress):
+        write_progress(progress_file, progress)
+        calls['n'] += 1
+        if progress['stage'] == 1 and progress['blocks_done'] == 3:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(rechunk, 'write_progress', crash)
+    with pytest.raises(KeyboardInterrupt):
+        rechunk_store(storepath, 'thetao', target, max_mem=2 ** 14)
+    monkeypatch.undo()
+    progress = read_progress(f'{storepath}/thetao.analysis.rechunk.yml')
+    assert progress['stage'] == 1 and progress['blocks_done'] == 3
+
+    fout = rechunk_store(storepath, 'thetao', target, max_mem=2 ** 14)
+    check = xr.open_zarr(fout)
+    assert check['thetao'].equals(ds['thetao'])
+
+
+@pytest.mark.parametrize("storetype", ['directory', 'zip'])
+def test_rechunk_store_resume_swap(tmpdir, monkeypatch, storetype):
+    from history2CMIParchive.rechunk import rechunk_store
+    import history2CMIParchive.rechunk as rechunk
+
+    storepath = f'{tmpdir}/Omon/thetao/gn/v1'
+    ds = create_test_store(storepath, storetype)
+    target = {'time': -1, 'yh': 10, 'xh': 10}
+
+    # interrupted once the copy is in {fout}.new
+    def crash(fstore):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(rechunk, 'swap_in_store', crash)
+    with pytest.raises(KeyboardInterrupt):
+        rechunk_store(storepath, 'thetao', target, storetype=storetype)
+    monkeypatch.undo()
+
+    fout = rechunk_store(storepath, 'thetao', target, storetype=storetype)
+    check = xr.open_zarr(fout)
+    assert check['thetao'].encoding['chunks'] == (24, 1, 10, 10)
+    assert check['thetao'].equals(ds['thetao'])
+    assert not os.path.exists(f'{fout}.new')
+    assert not os.path.exists(f'{fout}.rechunk.yml')
+
+
+def test_copy_block():
+    from history2CMIParchive.rechunk import copy_block
+
+    # appending layout to time series: too large in one step
+    shape = [720, 75, 1080, 1440]
+    source = [12, 1, 1080, 1440]
+    target = [720, 1, 60, 60]
+    mem = 256 * 1024 ** 2
+    assert copy_block(source, target, shape, 4, mem, grow=False) is None
+    intermediate = [min(s, t) for s, t in zip(source, target)]
+    assert copy_block(source, intermediate, shape, 4, mem) == source
+    assert copy_block(intermediate, target, shape, 4, mem)[:2] == [720, 1]
+    with pytest.raises(ValueError):
+        copy_block(source, target, shape, 4, 1024)
@@ -0,0 +1,158 @@
+import xarray as xr
+import numpy as np
+import pytest
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+
+members = ['ocean_month', 'ocean_annual_rho2']
+
+
+@pytest.fixture
+def history(tmpdir):
+    from history2CMIParchive.synthetic import create_synthetic_history
+
+    hisdir = f'{tmpdir}/history'
+    create_synthetic_history(hisdir, [1, 2, 3], resolution=10, nvars=2,
+                             nz=2, members=members)
+    return hisdir
+
+
+def expected_dataset(member, years):
+    from history2CMIParchive.synthetic import define_member_dataset
+    from history2CMIParchive.synthetic import default_members
+
+    return xr.concat([define_member_dataset(
+        member, default_members[member], year, resolution=10, nvars=2,
+        nz=2) for year in years], dim='time')
+
+
+def convert_year(history, ppdir, workdir, year, **kwargs):
+    from history2CMIParchive.datasets import convert_archive_to_zarr_store
+
+    return convert_archive_to_zarr_store(
+        archive=f'{history}/{year:04d}0101.nc.tar', outputdir=ppdir,
+        workdir=workdir, storetype='directory', domain='auto',
+        preallocate=(1, 3), **kwargs)
+
+
+def test_preallocated_out_of_order(tmpdir, history):
+    from history2CMIParchive.regions import read_regions
+    from history2CMIParchive.regions import missing_years
+
+    ppdir = f'{tmpdir}/pp'
+    storepath = f'{ppdir}/Omon/thetao/gn/v1'
+    assert convert_year(history, ppdir, f'{tmpdir}/work', 2) == []
+
+    # the store covers the whole run, only year 2 is written
+    assert read_regions(storepath, 'thetao') == {'firstyear': 1,
+                                                 'lastyear': 3,
+                                                 'records_per_year': 12,
+                                                 'filled': '010'}
+    assert missing_years(storepath, 'thetao') == [1, 3]
+    check_ds = xr.open_zarr(f'{storepath}/thetao', decode_times=False)
+    expected = expected_dataset('ocean_month', [1, 2, 3])
+    assert check_ds['thetao'].shape == expected['thetao'].shape
+    assert np.isnan(check_ds['time'].values[:12]).all()
+    assert np.array_equal(check_ds['time'].values[12:24],
+                          expected['time'].values[12:24])
+    assert np.isnan(check_ds['thetao'].isel(time=0).values).all()
+
+    for year in [3, 1]:
+        assert convert_year(history, ppdir, f'{tmpdir}/work', year) == []
+    for member, code in zip(members, ['Omon', 'Oyr']):
+        grid = 'gn_rho2' if 'rho2' in member else 'gn'
+        storepath = f'{ppdir}/{code}/thetao/{grid}/v1'
+        assert read_regions(storepath, 'thetao')['filled'] == '111'
+        expected = expected_dataset(member, [1, 2, 3])
+        check_ds = xr.open_zarr(f'{storepath}/thetao', decode_times=False)
+        assert np.array_equal(check_ds['time'].values,
+                              expected['time'].values)
+        assert np.allclose(check_ds['thetao'].values,
+                           expected['thetao'].values)
+    # as well as the store of the time coordinate
+    check_ds = xr.open_zarr(f'{ppdir}/Oyr/time/gn_rho2/v1/time',
+                            decode_times=False)
+    assert np.array_equal(check_ds['time'].values, expected['time'].values)
+    # coordinates without time are written once
+    check_ds = xr.open_zarr(f'{ppdir}/Omon/xh/gn/v1/xh', decode_times=False)
+    assert np.array_equal(check_ds['xh'].values, expected['xh'].values)
+
+
+def test_preallocated_filled_regions(tmpdir, history):
+    from history2CMIParchive.datasets import export_nc_out_to_zarr_stores
+    from history2CMIParchive.regions import write_to_region
+    from history2CMIParchive.tar_utilities import extract_ncfile_from_archive
+
+    ppdir = f'{tmpdir}/pp'
+    workdir = f'{tmpdir}/work'
+    extract_ncfile_from_archive(f'{history}/00010101.nc.tar',
+                                '00010101.ocean_month.nc', workdir)
+    ncfile = f'{workdir}/00010101.ocean_month.nc'
+    assert export_nc_out_to_zarr_stores(ncfile=ncfile, outputdir=ppdir,
+                                        domain='auto',
+                                        preallocate=(1, 3)) == []
+
+    # a filled region is not written again, unless overwritten
+    storepath = f'{ppdir}/Omon/thetao/gn/v1'
+    da = expected_dataset('ocean_month', [1])['thetao'].chunk({'time': 12})
+    preallocate = {'firstyear': 1, 'lastyear': 3, 'year': 1,
+                   'records_per_year': 12}
+    assert not write_to_region(da + 1, storepath, preallocate)
+    assert write_to_region(da + 1, storepath, preallocate, overwrite=True)
+    check_ds = xr.open_zarr(f'{storepath}/thetao', decode_times=False)
+    assert np.allclose(check_ds['thetao'].isel(time=slice(0, 12)).values,
+                       da.values + 1)
+
+    # years outside of the run, other run range, zip stores
+    with pytest.raises(ValueError):
+        write_to_region(da, storepath, dict(preallocate, year=4))
+    with pytest.raises(ValueError):
+        write_to_region(da, storepath, dict(preallocate, lastyear=4))
+    with pytest.raises(ValueError):
+        write_to_region(da, f'{tmpdir}/zip', preallocate, storetype='zip')
+    # regions are not written by slabs
+    with pytest.raises(ValueError):
+        write_to_region(da, storepath, preallocate, max_mem=10 ** 6)
+    with pytest.raises(ValueError):
+        export_nc_out_to_zarr_stores(ncfile=ncfile, outputdir=ppdir,
+                                     domain='auto', preallocate=(1, 3),
+                                     max_mem=10 ** 6)
+
+
+def test_preallocated_parallel_years(tmpdir, history):
+    ppdir = f'{tmpdir}/pp'
+    executor = ProcessPoolExecutor(max_workers=3,
+                                   mp_context=mp.get_context('spawn'))
+    futures = [executor.submit(convert_year, history, ppdir,
+                               f'{tmpdir}/work{year}', year)
+               for year in [3, 1, 2]]
+    for future in futures:
+        assert future.result() == []
+    executor.shutdown()
+
+    expected = expected_dataset('ocean_month', [1, 2, 3])
+    for variable in ['thetao', 'so']:
+        check_ds = xr.open_zarr(f'{ppdir}/Omon/{variable}/gn/v1/{variable}',
+                                decode_times=False)
+        assert np.array_equal(check_ds['time'].values,
+                              expected['time'].values)
+        assert np.allclose(check_ds[variable].values,
+                           expected[variable].values)
+
+
+def test_region_of_files_calendar():
+    from history2CMIParchive.datasets import region_of_files
+
+    ncfiles = ['00020101.ocean_daily.nc']
+    spec = {'ntimes': 365, 'frequency': 'day', 'calendar': 'noleap'}
+    assert region_of_files(ncfiles, [spec], (1, 3)) == \
+        {'firstyear': 1, 'lastyear': 3, 'year': 2, 'records_per_year': 365}
+    # daily files of leap years do not fit a fixed region per year
+    with pytest.raises(ValueError):
+        region_of_files(ncfiles, [dict(spec, calendar='gregorian')], (1, 3))
+    with pytest.raises(ValueError):
+        region_of_files(ncfiles, [dict(spec, calendar=None)], (1, 3))
+    # monthly files do
+    spec = {'ntimes': 12, 'frequency': 'mon', 'calendar': 'gregorian'}
+    assert region_of_files(ncfiles, [spec], (1, 3))['records_per_year'] == 12
@@ -0,0 +1,82 @@
+import time
+import os
+
+
+def test_recall_from_tape_no_tape(tmpdir):
+    from history2CMIParchive.site_specific import recall_from_tape
+    from history2CMIParchive.site_specific import finish_recall
+
+    recall = recall_from_tape([f'{tmpdir}/thetao.zip'])
+    assert recall is None
+    assert finish_recall(recall) == 0
+
+
+def test_recall_from_tape(tmpdir):
+    from history2CMIParchive.site_specific import recall_from_tape
+    from history2CMIParchive.site_specific import wait_for_recall
+    from history2CMIParchive.site_specific import is_recalled
+    from history2CMIParchive.site_specific import finish_recall
+
+    # stand-in for the tape system: slow, logs what it is asked for
+    log = f'{tmpdir}/recall.log'
+    command = f'sleep 1 ; echo {{files}} >> {log}'
+    files = [f'{tmpdir}/so.zip', f'{tmpdir}/thetao.zip', f'{tmpdir}/so.zip']
+
+    start = time.perf_counter()
+    recall = recall_from_tape(files, command=command)
+    assert time.perf_counter() - start < 0.5
+    assert not os.path.exists(log)
+
+    assert is_recalled(recall, f'{tmpdir}/thetao.zip')
+    assert not is_recalled(recall, f'{tmpdir}/uo.zip')
+    assert not is_recalled(None, f'{tmpdir}/thetao.zip')
+
+    assert wait_for_recall(recall) == 0
+    assert time.perf_counter() - start >= 1
+    with open(log) as f:
+        lines = f.readlines()
+    assert lines == [f'{tmpdir}/so.zip {tmpdir}/thetao.zip\n']
+
+    statusdir = os.path.dirname(recall['status'])
+    assert finish_recall(recall) == 0
+    assert not os.path.exists(statusdir)
+
+
+def test_recall_from_tape_failure(tmpdir):
+    from history2CMIParchive.site_specific import recall_from_tape
+    from history2CMIParchive.site_specific import finish_recall
+
+    recall = recall_from_tape([f'{tmpdir}/thetao.zip'], command='exit 3')
+    assert finish_recall(recall) == 3
+
+
+def test_recall_from_tape_shared_status(tmpdir):
+    from history2CMIParchive.site_specific import recall_from_tape
+    from history2CMIParchive.site_specific import wait_for_recall
+    from history2CMIParchive.site_specific import finish_recall
+
+    recall = recall_from_tape([f'{tmpdir}/thetao.zip'],
+                              command='sleep 1 ; true',
+                              statusdir=f'{tmpdir}/work')
+    assert recall['status'].startswith(f'{tmpdir}/work/')
+    # a worker of another host only sees the status file, and gives up
+    remote = dict(recall, status=f'{tmpdir}/missing/status')
+    assert wait_for_recall(remote, timeout=0.2) == 1
+    assert finish_recall(recall) == 0
+
+
+def test_fetch_store_failed_recall(tmpdir, monkeypatch):
+    from history2CMIParchive.site_specific import recall_from_tape
+    from history2CMIParchive.site_specific import finish_recall
+    import history2CMIParchive.zarr_stores as zarr_stores
+
+    fetched = []
+    monkeypatch.setattr(zarr_stores, 'get_from_tape',
+                        lambda mydir, myfile, site=None, debug=False:
+                        fetched.append(myfile) or 0)
+    recall = recall_from_tape([f'{tmpdir}/thetao.zip'], command='exit 3')
+    # the store is recalled alone when the batch fails
+    assert zarr_stores.fetch_store(f'{tmpdir}', 'thetao',
+                                   recall=recall) == 0
+    assert fetched == ['thetao.zip']
+    assert finish_recall(recall) == 3
@@ -0,0 +1,93 @@
+import xarray as xr
+import numpy as np
+import pytest
+
+
+def define_dataset(nt=12, nz=6, ny=10, nx=20, t0=0):
+    """ daily-like 3D field, chunked as opened from a history file """
+    data = np.random.rand(nt, nz, ny, nx).astype('f4')
+    data[:, :, 0, 0] = np.nan
+    ds = xr.Dataset({'thetao': (['time', 'z_l', 'yh', 'xh'], data)},
+                    coords={'time': (['time'], np.arange(t0, t0 + nt,
+                                                         dtype='f8')),
+                            'z_l': (['z_l'], np.arange(nz, dtype='f8')),
+                            'yh': (['yh'], np.arange(ny, dtype='f8')),
+                            'xh': (['xh'], np.arange(nx, dtype='f8'))})
+    ds['thetao'].encoding['_FillValue'] = 1e20
+    return ds.chunk({'time': 2, 'z_l': 1})
+
+
+def test_plan_slabs():
+    from history2CMIParchive.slabs import plan_slabs
+
+    dims = ['time', 'z_l', 'yh', 'xh']
+    shape = [12, 6, 10, 20]
+    record = 6 * 10 * 20 * 4
+    # whole records, ending on the chunks of the store
+    slabs = plan_slabs(shape, dims, 4, [4, 1, 10, 20], 5 * record)
+    assert [s['time'] for s in slabs] == [slice(0, 4), slice(4, 8),
+                                          slice(8, 12)]
+    # store of 6 records: the first slab completes its last chunk
+    slabs = plan_slabs(shape, dims, 4, [4, 1, 10, 20], 5 * record,
+                       offset=6)
+    assert [s['time'] for s in slabs] == [slice(0, 2), slice(2, 6),
+                                          slice(6, 10), slice(10, 12)]
+    # records of a chunk larger than the budget: whole chunks of levels
+    slabs = plan_slabs(shape, dims, 4, [4, 1, 10, 20], 3 * record)
+    assert len(slabs) == 3 * 2
+    assert slabs[0] == {'time': slice(0, 4), 'z_l': slice(0, 4)}
+    assert slabs[1] == {'time': slice(0, 4), 'z_l': slice(4, 6)}
+    slabs = plan_slabs(shape, dims, 4, [4, 2, 10, 20], 2 * record)
+    assert len(slabs) == 3 * 3
+    assert slabs[-1] == {'time': slice(8, 12), 'z_l': slice(4, 6)}
+    # a chunk of the store does not fit
+    with pytest.raises(ValueError):
+        plan_slabs(shape, dims, 4, [4, 2, 10, 20], record // 2)
+
+
+@pytest.mark.parametrize("storetype", ['directory', 'zip'])
+@pytest.mark.parametrize("max_mem", [2 * 6 * 10 * 20 * 4, 2 * 10 * 20 * 4])
+def test_write_to_zarr_store_slabs(tmpdir, capsys, storetype, max_mem):
+    from history2CMIParchive.zarr_stores import write_to_zarr_store
+    from history2CMIParchive.zarr_stores import store_name
+    from history2CMIParchive.zarr_stores import read_time_manifest
+
+    ds_1 = define_dataset(t0=0)
+    ds_2 = define_dataset(t0=12)
+    storepath = f'{tmpdir}/thetao'
+    for ds in [ds_1, ds_2]:
+        assert write_to_zarr_store(ds['thetao'], storepath,
+                                   storetype=storetype, max_mem=max_mem)
+    # time chunks of 2 records, by level chunks when they do not fit
+    nslabs = 6 if max_mem > 2 * 10 * 20 * 4 else 6 * 6
+    assert f'written in {nslabs} slab(s)' in capsys.readouterr().out
+
+    fstore = store_name(storepath, 'thetao', storetype)
+    check_ds = xr.open_zarr(fstore, consolidated=True)
+    expected = xr.concat([ds_1, ds_2], dim='time')
+    assert check_ds['thetao'].equals(expected['thetao'])
+    assert check_ds['thetao'].encoding['chunks'] == (2, 1, 10, 20)
+    assert check_ds['thetao'].encoding['_FillValue'] == np.float32(1e20)
+    assert read_time_manifest(storepath, 'thetao', storetype)['nt'] == 24
+
+
+def test_write_to_zarr_store_slabs_profile(tmpdir):
+    from history2CMIParchive.zarr_stores import write_to_zarr_store
+    from history2CMIParchive.profiling import enable_profiling
+    from history2CMIParchive.profiling import disable_profiling
+    from history2CMIParchive.profiling import read_profile
+
+    ds = define_dataset()
+    enable_profiling(f'{tmpdir}/profile.jsonl')
+    try:
+        write_to_zarr_store(ds['thetao'], f'{tmpdir}/thetao',
+                            max_mem=2 * 6 * 10 * 20 * 4)
+    finally:
+        disable_profiling()
+    records = read_profile(f'{tmpdir}/profile.jsonl')
+    slabs = [r for r in records if r['stage'] == 'write_slab']
+    assert len(slabs) == 6
+    assert all(r['bytes_read'] <= 2 * 6 * 10 * 20 * 4 for r in slabs)
+    write = [r for r in records if r['stage'] == 'write_store'][0]
+    assert write['slabs'] == 6
+    assert write['rss_peak'] >= write['rss_start'] > 0
@@ -0,0 +1,197 @@
+import xarray as xr
+import numpy as np
+import pytest
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+
+members = ['ocean_month', 'ocean_annual_rho2']
+
+
+@pytest.fixture
+def history(tmpdir):
+    from history2CMIParchive.synthetic import create_synthetic_history
+
+    hisdir = f'{tmpdir}/history'
+    create_synthetic_history(hisdir, [1, 2, 3], resolution=10, nvars=2,
+                             nz=2, members=members)
+    return hisdir
+
+
+def check_stores(ppdir, years):
+    from history2CMIParchive.synthetic import define_member_dataset
+    from history2CMIParchive.synthetic import default_members
+
+    for member, code in zip(members, ['Omon', 'Oyr']):
+        expected = xr.concat([define_member_dataset(
+            member, default_members[member], year, resolution=10, nvars=2,
+            nz=2) for year in years], dim='time')
+        grid = 'gn_rho2' if 'rho2' in member else 'gn'
+        for variable in ['thetao', 'so']:
+            check_ds = xr.open_zarr(f'{ppdir}/{code}/{variable}/{grid}/v1/'
+                                    f'{variable}', decode_times=False)
+            assert np.array_equal(check_ds['time'].values,
+                                  expected['time'].values)
+            assert np.allclose(check_ds[variable].values,
+                               expected[variable].values)
+
+
+def test_sync_history(tmpdir, history, monkeypatch):
+    from history2CMIParchive.sync import sync_history
+    from history2CMIParchive.sync import ledger_path
+    from history2CMIParchive.sync import ledger_status
+    from history2CMIParchive.synthetic import create_synthetic_history
+    import history2CMIParchive.sync as sync
+
+    ppdir = f'{tmpdir}/pp'
+    workdir = f'{tmpdir}/work'
+    errors = sync_history(history, ppdir, workdir, domain='auto')
+    assert errors == []
+    check_stores(ppdir, [1, 2, 3])
+    status = ledger_status(ledger_path(ppdir))
+    assert list(status) == ['done']
+
+    # nothing left to do: no member is converted again
+    converted = []
+
+    def count_convert(archive, ncfile, *args, **kwargs):
+        converted.append(ncfile)
+        return []
+
+    monkeypatch.setattr(sync, 'convert_member', count_convert)
+    assert sync_history(history, ppdir, workdir, domain='auto') == []
+    assert converted == []
+    monkeypatch.undo()
+
+    # a new year only brings its own units
+    create_synthetic_history(history, [4], resolution=10, nvars=2, nz=2,
+                             members=members)
+    assert sync_history(history, ppdir, workdir, domain='auto') == []
+    assert ledger_status(ledger_path(ppdir))['done'] == \
+        status['done'] * 4 // 3
+    check_stores(ppdir, [1, 2, 3, 4])
+
+
+def test_sync_history_failed_units(tmpdir, history, monkeypatch):
+    from history2CMIParchive.sync import sync_history
+    from history2CMIParchive.sync import ledger_path
+    import history2CMIParchive.datasets as datasets
+    import sqlite3
+
+    ppdir = f'{tmpdir}/pp'
+    workdir = f'{tmpdir}/work'
+    export_variable = datasets.export_variable
+
+    def failing_export(da, storepath, rebuild_dict, write_kwargs,
+                       ncfile=None):
+        if da.name == 'so' and ncfile == '00020101.ocean_month.nc':
+            raise IOError('disk full')
+        return export_variable(da, storepath, rebuild_dict, write_kwargs,
+                               ncfile=ncfile)
+
+    monkeypatch.setattr(datasets, 'export_variable', failing_export)
+    errors = sync_history(history, ppdir, workdir, domain='auto')
+    assert len(errors) == 1 and errors[0]['variable'] == 'so'
+    monkeypatch.undo()
+
+    # the store is not appended to after the failed year
+    conn = sqlite3.connect(ledger_path(ppdir))
+    rows = conn.execute("SELECT member, status, error FROM units "
+                        "WHERE variable = 'so' AND member LIKE '%month%' "
+                        "ORDER BY member").fetchall()
+    conn.close()
+    assert rows == [('00010101.ocean_month.nc', 'done', None),
+                    ('00020101.ocean_month.nc', 'failed',
+                     'OSError: disk full'),
+                    ('00030101.ocean_month.nc', 'todo', None)]
+
+    # the next run only redoes the failed variable and the ones after it
+    assert sync_history(history, ppdir, workdir, domain='auto') == []
+    check_stores(ppdir, [1, 2, 3])
+
+
+def test_sync_history_workers(tmpdir, history):
+    from history2CMIParchive.sync import sync_history
+    from history2CMIParchive.sync import ledger_path
+    from history2CMIParchive.sync import ledger_status
+    import sqlite3
+
+    ppdir = f'{tmpdir}/pp'
+    executor = ProcessPoolExecutor(max_workers=3,
+                                   mp_context=mp.get_context('spawn'))
+    futures = [executor.submit(sync_history, history, ppdir,
+                               f'{tmpdir}/work{k}', domain='auto')
+               for k in range(3)]
+    for future in futures:
+        assert future.result() == []
+    executor.shutdown()
+
+    check_stores(ppdir, [1, 2, 3])
+    assert list(ledger_status(ledger_path(ppdir))) == ['done']
+    # units recorded once, whatever the number of workers scanning
+    conn = sqlite3.connect(ledger_path(ppdir))
+    counts = conn.execute('SELECT COUNT(*) FROM units '
+                          'GROUP BY archive').fetchall()
+    narchives = conn.execute('SELECT COUNT(*) FROM archives').fetchone()
+    conn.close()
+    assert len(counts) == 3 and len(set(counts)) == 1
+    assert narchives == (3,)
+
+
+def test_sync_history_compressed(tmpdir, monkeypatch):
+    from history2CMIParchive.sync import sync_history
+    from history2CMIParchive.synthetic import create_synthetic_history
+    from history2CMIParchive.sync import ledger_path
+    import history2CMIParchive.sync as sync
+    import sqlite3
+
+    history = f'{tmpdir}/history'
+    create_synthetic_history(history, [1, 2, 3], resolution=10, nvars=2,
+                             nz=2, members=members, compression='gz')
+    streams = []
+    stream = sync.stream_ncfiles_from_archive
+
+    def count_streams(archive, *args, **kwargs):
+        streams.append(archive)
+        return stream(archive, *args, **kwargs)
+
+    monkeypatch.setattr(sync, 'stream_ncfiles_from_archive', count_streams)
+    ppdir = f'{tmpdir}/pp'
+    errors = sync_history(history, ppdir, f'{tmpdir}/work',
+                          pattern='*.nc.tar.gz', domain='auto')
+    assert errors == []
+    check_stores(ppdir, [1, 2, 3])
+    # read once to scan and once to convert, not once per member
+    assert len(streams) == 2 * 3
+    # the compression was recorded by the scan
+    conn = sqlite3.connect(ledger_path(ppdir))
+    assert set(row[0] for row in conn.execute(
+        'SELECT compression FROM archives')) == {'gz'}
+    conn.close()
+
+
+def test_finish_units_taken_over(tmpdir, history):
+    from history2CMIParchive.sync import scan_history
+    from history2CMIParchive.sync import claim_units
+    from history2CMIParchive.sync import finish_units
+    from history2CMIParchive.sync import ledger_path
+    import sqlite3
+
+    ppdir = f'{tmpdir}/pp'
+    ledger = ledger_path(ppdir)
+    assert scan_history(history, ppdir, f'{tmpdir}/work', ledger) == []
+    archive, claimed = claim_units(ledger, 'slow', 'run1')
+    # the unit of the slow worker is stale and taken over
+    archive, taken = claim_units(ledger, 'fast', 'run2', stale_after=-1)
+    assert taken == claimed
+    ncfile, variables = list(taken.items())[0]
+    finish_units(ledger, archive, ncfile, variables, [], 'fast', 'run2')
+    error = {'file': ncfile, 'variable': None, 'error': 'killed'}
+    finish_units(ledger, archive, ncfile, variables, [error], 'slow',
+                 'run1')
+
+    conn = sqlite3.connect(ledger)
+    rows = conn.execute('SELECT status, worker FROM units WHERE member = ?',
+                        (ncfile,)).fetchall()
+    conn.close()
+    assert set(rows) == {('done', 'fast')}
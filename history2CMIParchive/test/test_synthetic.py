@@ -0,0 +1,67 @@
+import xarray as xr
+import tarfile
+import pytest
+import os
+
+
+@pytest.mark.parametrize("compression", [None, 'gz'])
+def test_create_synthetic_history(tmpdir, compression):
+    from history2CMIParchive.synthetic import create_synthetic_history
+    from history2CMIParchive.synthetic import default_members
+    from history2CMIParchive.datasets import define_component_code
+    from history2CMIParchive.datasets import infer_store_path
+
+    archives = create_synthetic_history(f'{tmpdir}/history', [1, 2],
+                                        resolution=10, nvars=2, nz=3,
+                                        compression=compression)
+    suffix = '' if compression is None else '.gz'
+    assert archives == [f'{tmpdir}/history/00010101.nc.tar{suffix}',
+                        f'{tmpdir}/history/00020101.nc.tar{suffix}']
+    assert not os.path.exists(f'{tmpdir}/history/.synthetic')
+
+    workdir = f'{tmpdir}/work'
+    with tarfile.open(archives[1]) as arch:
+        names = arch.getnames()
+        arch.extractall(workdir)
+    assert sorted(names) == sorted(f'00020101.{member}.nc'
+                                   for member in default_members)
+
+    expected = {'ocean_static': ('Ofx', 'gn'),
+                'ocean_month': ('Omon', 'gn'),
+                'ocean_month_z': ('Omon', 'gn_z'),
+                'ocean_month_d2': ('Omon', 'gn_d2'),
+                'ocean_annual_rho2': ('Oyr', 'gn_rho2'),
+                'ocean_daily': ('Oday', 'gn'),
+                'ice_month': ('SImon', 'gn'),
+                'ocean_Drake_Passage': ('Omon', 'gn_Drake_Passage')}
+    for member, (code, grid) in expected.items():
+        ncfile = f'{workdir}/00020101.{member}.nc'
+        assert define_component_code(ncfile) == code
+        storepath = infer_store_path(ncfile, 'var', '/pp', code)
+        assert storepath == f'/pp/{code}/var/{grid}/v1'
+
+    ds = xr.open_dataset(f'{workdir}/00020101.ocean_month.nc',
+                         decode_times=False)
+    assert ds['thetao'].dims == ('time', 'z_l', 'yh', 'xh')
+    assert ds['thetao'].shape == (12, 3, 18, 36)
+    assert ds['time'].values[0] == 365 + 15.5
+
+
+def test_run_load_test(tmpdir):
+    from history2CMIParchive.synthetic import create_synthetic_history
+    from history2CMIParchive.synthetic import run_load_test
+
+    archives = create_synthetic_history(f'{tmpdir}/history', [1, 2],
+                                        resolution=30, nvars=2, nz=2,
+                                        members=['ocean_month',
+                                                 'ocean_static'])
+    report = run_load_test(archives, f'{tmpdir}/pp', f'{tmpdir}/work',
+                           domain='OM4p25')
+    assert report['archives'] == 2
+    assert report['errors'] == 0
+    # 2 variables and 4 coordinates of ocean_month, 2 + 2 of ocean_static
+    assert report['stores'] == 10
+    assert report['files_created'] > report['stores']
+    assert report['throughput_MBps'] > 0
+    check = xr.open_zarr(f'{tmpdir}/pp/Omon/thetao/gn/v1/thetao')
+    assert len(check['time']) == 24
@@ -0,0 +1,127 @@
+import numpy as np
+import tarfile
+import pytest
+import os
+import io
+
+
+def create_test_archive(tmpdir, name='19000101.nc.tar', mode='w'):
+    """ write a small tar file with fake netcdf members """
+    members = {'19000101.ocean_month.nc': np.arange(1000).tobytes(),
+               '19000101.ocean_static.nc': np.arange(10).tobytes(),
+               '19000101.ocean_month.nc.md5': b'checksum'}
+    archive = f'{tmpdir}/{name}'
+    with tarfile.open(archive, mode) as arch:
+        for member, data in members.items():
+            info = tarfile.TarInfo(member)
+            info.size = len(data)
+            info.mode = 0o644
+            arch.addfile(info, io.BytesIO(data))
+    return archive, members
+
+
+def test_build_tar_index(tmpdir):
+    from history2CMIParchive.tar_utilities import build_tar_index
+
+    archive, members = create_test_archive(tmpdir)
+    index = build_tar_index(archive)
+
+    assert index['compression'] is None
+    assert len(index['members']) == 3
+    with open(archive, 'rb') as f:
+        for entry in index['members']:
+            f.seek(entry['offset_data'])
+            assert f.read(entry['size']) == members[entry['name']]
+
+
+@pytest.mark.parametrize("cachedir", [None, 'cache'])
+def test_get_tar_index(tmpdir, cachedir):
+    from history2CMIParchive.tar_utilities import get_tar_index
+    from history2CMIParchive.tar_utilities import tar_index_path
+
+    if cachedir is not None:
+        cachedir = f'{tmpdir}/{cachedir}'
+    archive, members = create_test_archive(tmpdir)
+    index = get_tar_index(archive, cachedir=cachedir)
+    indexfile = tar_index_path(archive, cachedir=cachedir)
+    assert os.path.exists(indexfile)
+
+    # second call reads the sidecar
+    assert get_tar_index(archive, cachedir=cachedir) == index
+
+    # a modified archive invalidates the sidecar
+    archive, members = create_test_archive(tmpdir)
+    os.utime(archive, (0, 0))
+    assert get_tar_index(archive, cachedir=cachedir)['archive_mtime'] == 0
+
+
+@pytest.mark.parametrize("mode", ['w', 'w:gz'])
+def test_extract_ncfile_from_archive(tmpdir, mode):
+    from history2CMIParchive.tar_utilities import get_tar_index
+    from history2CMIParchive.tar_utilities import list_files_archive
+    from history2CMIParchive.tar_utilities import extract_ncfile_from_archive
+
+    archive, members = create_test_archive(tmpdir, mode=mode)
+    index = get_tar_index(archive)
+    assert index['compression'] == (None if mode == 'w' else 'gz')
+
+    ncfiles = list_files_archive(archive, index=index)
+    assert ncfiles == list_files_archive(archive)
+    assert len(ncfiles) == 2
+
+    for ncfile in ncfiles:
+        extract_ncfile_from_archive(archive, ncfile, f'{tmpdir}/out',
+                                    index=index)
+        with open(f'{tmpdir}/out/{ncfile}', 'rb') as f:
+            assert f.read() == members[ncfile]
+        fstat = os.stat(f'{tmpdir}/out/{ncfile}')
+        assert oct(fstat.st_mode)[-3:] == '644'
+
+
+def test_open_ncfile_from_archive(tmpdir):
+    from history2CMIParchive.tar_utilities import get_tar_index
+    from history2CMIParchive.tar_utilities import open_ncfile_from_archive
+    import pickle
+
+    archive, members = create_test_archive(tmpdir)
+    index = get_tar_index(archive)
+    ncfile = '19000101.ocean_month.nc'
+
+    fileobj = open_ncfile_from_archive(archive, ncfile, index)
+    assert fileobj.read() == members[ncfile]
+    fileobj.seek(-8, os.SEEK_END)
+    assert fileobj.read(100) == members[ncfile][-8:]
+    # closing releases the descriptor, the member can be read again
+    fileobj.close()
+    fileobj.seek(0)
+    assert fileobj.read(8) == members[ncfile][:8]
+    # and sent to another process
+    fileobj = pickle.loads(pickle.dumps(fileobj))
+    assert fileobj.read() == members[ncfile]
+
+    with pytest.raises(KeyError):
+        open_ncfile_from_archive(archive, 'missing.nc', index)
+
+    archive, members = create_test_archive(tmpdir, name='gz.tar',
+                                           mode='w:gz')
+    with pytest.raises(ValueError):
+        open_ncfile_from_archive(archive, ncfile, get_tar_index(archive))
+
+
+@pytest.mark.parametrize("mode", ['w', 'w:gz'])
+def test_stream_ncfiles_from_archive(tmpdir, mode):
+    from history2CMIParchive.tar_utilities import stream_ncfiles_from_archive
+
+    archive, members = create_test_archive(tmpdir, mode=mode)
+    destination = f'{tmpdir}/out'
+
+    streamed = []
+    for ncfile in stream_ncfiles_from_archive(archive, destination,
+                                              ignore_types=['static']):
+        # member is on disk while it is being processed
+        with open(f'{destination}/{ncfile}', 'rb') as f:
+            assert f.read() == members[ncfile]
+        streamed.append(ncfile)
+
+    assert streamed == ['19000101.ocean_month.nc']
+    assert not os.path.exists(f'{destination}/19000101.ocean_static.nc')
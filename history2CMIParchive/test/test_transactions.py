@@ -0,0 +1,127 @@
+import xarray as xr
+import numpy as np
+import pytest
+import hashlib
+import os
+
+
+def define_test_dataset(nt=12, t0=0):
+    """ small dataset chunked along time """
+    data = np.random.rand(nt, 10, 20)
+    ds = xr.Dataset({'thetao': (['time', 'yh', 'xh'], data)},
+                    coords={'time': (['time'], np.arange(t0, t0 + nt))})
+    return ds.chunk({'time': 1})
+
+
+def failing_dataset(ds, fail_after):
+    """ dataset whose computation crashes after fail_after time records """
+    def crash(block, block_info=None):
+        if block_info[0]['array-location'][0][0] >= fail_after:
+            raise RuntimeError('simulated crash')
+        return block
+    bad = ds.copy()
+    bad['thetao'].data = bad['thetao'].data.map_blocks(crash,
+                                                       dtype='float64')
+    return bad
+
+
+def checksum(fstore):
+    with open(fstore, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+@pytest.mark.parametrize("storetype", ['directory', 'zip'])
+@pytest.mark.parametrize("hard_crash", [True, False])
+def test_append_rollback(tmpdir, storetype, hard_crash, monkeypatch):
+    from history2CMIParchive.transactions import replace_store
+    from history2CMIParchive.transactions import append_to_store
+    from history2CMIParchive.transactions import recover_store
+    from history2CMIParchive.transactions import journal_path
+    import history2CMIParchive.transactions as transactions
+
+    fstore = f'{tmpdir}/thetao' if storetype == 'directory' else \
+        f'{tmpdir}/thetao.zip'
+    ds_ref = define_test_dataset()
+    replace_store(ds_ref, fstore, storetype)
+    if storetype == 'zip':
+        before = checksum(fstore)
+
+    # crash while the new chunks are being written
+    ds_add = failing_dataset(define_test_dataset(t0=12), fail_after=6)
+    if hard_crash:
+        # the process dies: nothing is undone until the next run
+        monkeypatch.setattr(transactions, 'recover_store',
+                            lambda fstore: None)
+    with pytest.raises(RuntimeError):
+        append_to_store(ds_add, fstore, storetype)
+    monkeypatch.undo()
+
+    if hard_crash:
+        assert os.path.exists(journal_path(fstore))
+        assert recover_store(fstore) == 'rollback'
+    assert not os.path.exists(journal_path(fstore))
+    check = xr.open_zarr(fstore)
+    assert check['thetao'].equals(ds_ref['thetao'])
+    if storetype == 'zip':
+        assert checksum(fstore) == before
+    else:
+        # orphan chunks are gone
+        assert len(os.listdir(f'{fstore}/thetao')) == 12 + 2
+
+    # the append can be redone
+    ds_add = define_test_dataset(t0=12)
+    append_to_store(ds_add, fstore, storetype)
+    check = xr.open_zarr(fstore)
+    assert check['thetao'].equals(xr.concat([ds_ref, ds_add],
+                                            dim='time')['thetao'])
+
+
+def test_append_rollforward(tmpdir, monkeypatch):
+    from history2CMIParchive.transactions import replace_store
+    from history2CMIParchive.transactions import append_to_store
+    from history2CMIParchive.transactions import recover_store
+    from history2CMIParchive.transactions import StagedMetadataStore
+    import history2CMIParchive.transactions as transactions
+
+    fstore = f'{tmpdir}/thetao'
+    ds_ref = define_test_dataset()
+    ds_add = define_test_dataset(t0=12)
+    replace_store(ds_ref, fstore, 'directory')
+
+    # crash while the metadata is committed
+    def crash(self):
+        raise RuntimeError('simulated crash')
+
+    monkeypatch.setattr(StagedMetadataStore, 'commit', crash)
+    monkeypatch.setattr(transactions, 'recover_store', lambda fstore: None)
+    with pytest.raises(RuntimeError):
+        append_to_store(ds_add, fstore, 'directory')
+    monkeypatch.undo()
+
+    # chunks are there, metadata not updated yet
+    assert len(xr.open_zarr(fstore)['time']) == 12
+    assert recover_store(fstore) == 'rollforward'
+    check = xr.open_zarr(fstore)
+    assert check['thetao'].equals(xr.concat([ds_ref, ds_add],
+                                            dim='time')['thetao'])
+
+
+@pytest.mark.parametrize("storetype", ['directory', 'zip'])
+def test_replace_rollback(tmpdir, storetype):
+    """ failures while writing the new store leave the old one intact """
+    from history2CMIParchive.transactions import replace_store
+    from history2CMIParchive.transactions import recover_store
+
+    fstore = f'{tmpdir}/thetao' if storetype == 'directory' else \
+        f'{tmpdir}/thetao.zip'
+    ds_ref = define_test_dataset()
+    replace_store(ds_ref, fstore, storetype)
+
+    ds_new = failing_dataset(define_test_dataset(), fail_after=6)
+    with pytest.raises(RuntimeError):
+        replace_store(ds_new, fstore, storetype)
+
+    assert recover_store(fstore) is None
+    assert not os.path.exists(f'{fstore}.new')
+    check = xr.open_zarr(fstore)
+    assert check['thetao'].equals(ds_ref['thetao'])
@@ -192,26 +192,25 @@ def test_write_to_zarr_store(tmpdir, storetype, consolidated, write_yaml):
                         storetype=storetype, consolidated=consolidated,
                         overwrite=True)
 
-    write_to_zarr_store(ds_bad1['thetao'], f'{tmpdir}',
+    write_to_zarr_store(ds_bad2['thetao'], f'{tmpdir}',
                         storetype=storetype, consolidated=consolidated)
 
     # check the store have not been updated
     temp_from_zarr = read_store(tmpdir, 'thetao', storetype, consolidated)
     assert ds_ref['thetao'] == temp_from_zarr
 
-    write_to_zarr_store(ds_bad2['thetao'], f'{tmpdir}',
+    write_to_zarr_store(ds_bad3['thetao'], f'{tmpdir}',
                         storetype=storetype, consolidated=consolidated)
 
     # check the store have not been updated
     temp_from_zarr = read_store(tmpdir, 'thetao', storetype, consolidated)
     assert ds_ref['thetao'] == temp_from_zarr
 
-    write_to_zarr_store(ds_bad3['thetao'], f'{tmpdir}',
+    # partly overlapping data: only the new records are appended
+    write_to_zarr_store(ds_bad1['thetao'], f'{tmpdir}',
                         storetype=storetype, consolidated=consolidated)
-
-    # check the store have not been updated
     temp_from_zarr = read_store(tmpdir, 'thetao', storetype, consolidated)
-    assert ds_ref['thetao'] == temp_from_zarr
+    assert np.array_equal(temp_from_zarr['time'].values, np.arange(1, 18))
 
     # ---------------------------------------------------------------
     # overwrite a second time
@@ -270,12 +269,14 @@ def test_appending_needed(tmpdir, storetype, consolidated):
     assert check
 
     # ----------------------------------------------------------------
-    # test bad stores
+    # partly overlapping: the tail is appended
     check = appending_needed(f'{tmpdir}', 'thetao',
                              storetype, ds_bad1['thetao'],
                              concat_dim='time', consolidated=consolidated)
-    assert not check
+    assert check
 
+    # ----------------------------------------------------------------
+    # test bad stores
     check = appending_needed(f'{tmpdir}', 'thetao',
                              storetype, ds_bad2['thetao'],
                              concat_dim='time', consolidated=consolidated)
@@ -294,3 +295,107 @@ def test_appending_needed(tmpdir, storetype, consolidated):
                              storetype, ds_add['xh'],
                              concat_dim='time', consolidated=consolidated)
     assert not check
+
+
+@pytest.mark.parametrize("storetype", ['directory', 'zip'])
+@pytest.mark.parametrize("chunks", [None, 4])
+def test_append_overlap(tmpdir, storetype, chunks, capsys):
+    from history2CMIParchive.zarr_stores import write_to_zarr_store
+    from history2CMIParchive.zarr_stores import append_start
+    from history2CMIParchive.zarr_stores import tail_chunks
+    from history2CMIParchive.zarr_stores import read_time_manifest
+
+    ds_write = ds_ref if chunks is None else ds_ref.chunk({'time': chunks})
+    write_to_zarr_store(ds_write['thetao'], f'{tmpdir}', storetype=storetype)
+
+    # a rerun segment starting 7 records before the end of the store
+    assert append_start(f'{tmpdir}', 'thetao', storetype,
+                        ds_bad1['thetao']) == 7
+    # fully overlapping, with a gap or out of order: nothing to append
+    assert append_start(f'{tmpdir}', 'thetao', storetype,
+                        ds_bad2['thetao']) is None
+    assert append_start(f'{tmpdir}', 'thetao', storetype,
+                        ds_bad3['thetao']) is None
+    assert append_start(f'{tmpdir}', 'thetao', storetype,
+                        ds_bad1['thetao'].isel(time=slice(None, None, -1))) \
+        is None
+
+    ds_overlap = ds_bad1.copy(deep=True)
+    ds_overlap['thetao'] = ds_overlap['thetao'] + 1
+    if chunks is not None:
+        ds_overlap = ds_overlap.chunk({'time': chunks})
+    assert write_to_zarr_store(ds_overlap['thetao'], f'{tmpdir}',
+                               storetype=storetype)
+    assert '7 records already in' in capsys.readouterr().out
+
+    check = read_store(tmpdir, 'thetao', storetype, True)
+    assert np.array_equal(check['time'].values, np.arange(1, 18))
+    # the records already stored are kept
+    assert np.allclose(check['thetao'].isel(time=slice(0, 12)).values, temp)
+    assert np.allclose(check['thetao'].isel(time=slice(12, 17)).values,
+                       temp[7:] + 1)
+    manifest = read_time_manifest(f'{tmpdir}', 'thetao', storetype)
+    assert (manifest['nt'], manifest['penultimate'], manifest['last']) == \
+        (17, 16, 17)
+
+    # a tail appended to a partial last chunk completes it first
+    assert tail_chunks(10, {'nt': 17, 'dims': ['time', 'z'],
+                            'chunks': [4, 15]}) == (3, 4, 3)
+    assert tail_chunks(2, {'nt': 16, 'dims': ['time', 'z'],
+                           'chunks': [4, 15]}) == (2,)
+
+    # and the next file appends after the trimmed one
+    ds_next = ds_ref.copy(deep=True)
+    ds_next['time'] = np.arange(18, 30)
+    assert write_to_zarr_store(ds_next['thetao'], f'{tmpdir}',
+                               storetype=storetype)
+    check = read_store(tmpdir, 'thetao', storetype, True)
+    assert np.array_equal(check['time'].values, np.arange(1, 30))
+
+
+@pytest.mark.parametrize("storetype", ['directory', 'zip'])
+def test_time_manifest(tmpdir, storetype, monkeypatch):
+    from history2CMIParchive.zarr_stores import write_to_zarr_store
+    from history2CMIParchive.zarr_stores import appending_needed
+    from history2CMIParchive.zarr_stores import read_time_manifest
+    from history2CMIParchive.zarr_stores import store_name
+    import history2CMIParchive.zarr_stores as zarr_stores
+
+    write_to_zarr_store(ds_ref['thetao'], f'{tmpdir}', storetype=storetype)
+    manifest = read_time_manifest(f'{tmpdir}', 'thetao', storetype)
+    assert manifest['nt'] == 12
+    assert manifest['first'] == 1
+    assert manifest['last'] == 12
+    assert manifest['penultimate'] == 11
+    assert manifest['dtype'] == 'float64'
+
+    write_to_zarr_store(ds_add['thetao'], f'{tmpdir}', storetype=storetype)
+    manifest = read_time_manifest(f'{tmpdir}', 'thetao', storetype)
+    assert manifest['nt'] == 24
+    assert manifest['first'] == 1
+    assert manifest['last'] == 24
+    assert manifest['penultimate'] == 23
+
+    # append decisions do not open the store
+    def no_open(*args, **kwargs):
+        raise AssertionError('store should not be opened')
+
+    monkeypatch.setattr(zarr_stores._xr, 'open_zarr', no_open)
+    ds_next = ds_add.copy(deep=True)
+    ds_next['time'] = ds_add['time'] + 12
+    assert appending_needed(f'{tmpdir}', 'thetao', storetype,
+                            ds_next['thetao'])
+    assert not appending_needed(f'{tmpdir}', 'thetao', storetype,
+                                ds_add['thetao'])
+    monkeypatch.undo()
+
+    # a store modified behind the manifest back makes it stale
+    fstore = store_name(f'{tmpdir}', 'thetao', storetype)
+    if storetype == 'directory':
+        fstore = f'{fstore}/thetao/.zarray'
+    os.utime(fstore, ns=(0, 0))
+    assert read_time_manifest(f'{tmpdir}', 'thetao', storetype) is None
+    assert appending_needed(f'{tmpdir}', 'thetao', storetype,
+                            ds_next['thetao'])
+    manifest = read_time_manifest(f'{tmpdir}', 'thetao', storetype)
+    assert manifest['nt'] == 24
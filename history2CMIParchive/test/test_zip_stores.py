@@ -0,0 +1,111 @@
+import xarray as xr
+import numpy as np
+import zipfile
+import pytest
+import os
+
+
+def define_test_dataset(nt=12, t0=0):
+    """ small dataset chunked along time """
+    data = np.random.rand(nt, 10, 20)
+    ds = xr.Dataset({'thetao': (['time', 'yh', 'xh'], data)},
+                    coords={'time': (['time'], np.arange(t0, t0 + nt))})
+    return ds.chunk({'time': 1})
+
+
+def zip_names(fstore):
+    with zipfile.ZipFile(fstore) as zf:
+        return zf.namelist()
+
+
+def test_compact_zip_store(tmpdir):
+    from history2CMIParchive.transactions import replace_store
+    from history2CMIParchive.transactions import append_to_store
+    from history2CMIParchive.zip_stores import compact_zip_store
+
+    fstore = f'{tmpdir}/thetao.zip'
+    datasets = [define_test_dataset(t0=12 * k) for k in range(4)]
+    replace_store(datasets[0], fstore, 'zip')
+    for ds in datasets[1:]:
+        append_to_store(ds, fstore, 'zip')
+    # each append adds a copy of the metadata
+    names = zip_names(fstore)
+    assert len(names) > len(set(names))
+
+    report = compact_zip_store(fstore)
+    names_after = zip_names(fstore)
+    assert len(names_after) == len(set(names))
+    assert report['members_dropped'] == len(names) - len(set(names))
+    assert report['bytes_reclaimed'] == \
+        report['bytes_before'] - report['bytes_after'] > 0
+    assert not os.path.exists(f'{fstore}.new')
+
+    check = xr.open_zarr(fstore)
+    ref = xr.concat(datasets, dim='time')
+    assert check['thetao'].equals(ref['thetao'])
+    with zipfile.ZipFile(fstore) as zf:
+        assert zf.testzip() is None
+
+
+def test_rewrite_append_zip(tmpdir):
+    from history2CMIParchive.transactions import replace_store
+    from history2CMIParchive.zip_stores import rewrite_append_zip
+
+    fstore = f'{tmpdir}/thetao.zip'
+    datasets = [define_test_dataset(t0=12 * k) for k in range(3)]
+    replace_store(datasets[0], fstore, 'zip')
+    for ds in datasets[1:]:
+        rewrite_append_zip(ds, fstore)
+        names = zip_names(fstore)
+        assert len(names) == len(set(names))
+    assert not os.path.exists(f'{fstore}.staging')
+
+    check = xr.open_zarr(fstore)
+    assert check['thetao'].equals(xr.concat(datasets, dim='time')['thetao'])
+
+
+def test_rewrite_append_zip_rollback(tmpdir):
+    from history2CMIParchive.transactions import replace_store
+    from history2CMIParchive.zip_stores import rewrite_append_zip
+
+    fstore = f'{tmpdir}/thetao.zip'
+    ds_ref = define_test_dataset()
+    replace_store(ds_ref, fstore, 'zip')
+
+    def crash(block):
+        raise RuntimeError('simulated crash')
+
+    bad = define_test_dataset(t0=12)
+    bad['thetao'].data = bad['thetao'].data.map_blocks(crash,
+                                                       dtype='float64')
+    with pytest.raises(RuntimeError):
+        rewrite_append_zip(bad, fstore)
+    for leftover in ['new', 'staging', 'journal.yml']:
+        assert not os.path.exists(f'{fstore}.{leftover}')
+    check = xr.open_zarr(fstore)
+    assert check['thetao'].equals(ds_ref['thetao'])
+
+
+@pytest.mark.parametrize("zip_append", ['inplace', 'rewrite'])
+def test_write_zip_append_and_compact(tmpdir, zip_append):
+    from history2CMIParchive.zarr_stores import write_to_zarr_store
+    from history2CMIParchive.zarr_stores import compact_store
+    from history2CMIParchive.zarr_stores import read_time_manifest
+
+    storepath = f'{tmpdir}/ocean_monthly/thetao/gn/v1'
+    datasets = [define_test_dataset(t0=12 * k) for k in range(3)]
+    for ds in datasets:
+        write_to_zarr_store(ds['thetao'], storepath, storetype='zip',
+                            zip_append=zip_append)
+    manifest = read_time_manifest(storepath, 'thetao', 'zip')
+    assert manifest['nt'] == 36
+
+    report = compact_store(storepath, 'thetao')
+    if zip_append == 'rewrite':
+        assert report['members_dropped'] == 0
+    else:
+        assert report['members_dropped'] > 0
+    # the manifest survives the compaction
+    assert read_time_manifest(storepath, 'thetao', 'zip')['nt'] == 36
+    check = xr.open_zarr(f'{storepath}/thetao.zip')
+    assert check['thetao'].equals(xr.concat(datasets, dim='time')['thetao'])
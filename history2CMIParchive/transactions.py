@@ -0,0 +1,339 @@
+import zarr as _zarr
+import zipfile
+import shutil
+import json
+import yaml
+import os
+
+# zarr metadata keys, only written to the store at commit time
+metadata_keys = ['.zarray', '.zattrs', '.zgroup', '.zmetadata']
+
+
+class StagedMetadataStore(_zarr.storage.Store):
+    """ overlay on a zarr store: chunks go straight to the underlying
+    store while metadata is held in memory until commit. Until then,
+    readers of the store see the arrays with their previous shape, and
+    the new chunks (beyond that shape) are invisible. """
+
+    def __init__(self, store):
+        self.store = store
+        self.staged = {}
+
+    @staticmethod
+    def is_metadata(key):
+        return key.split('/')[-1] in metadata_keys
+
+    def __getitem__(self, key):
+        if key in self.staged:
+            return self.staged[key]
+        return self.store[key]
+
+    def __setitem__(self, key, value):
+        if self.is_metadata(key):
+            self.staged[key] = bytes(value)
+        else:
+            self.store[key] = value
+
+    def __delitem__(self, key):
+        if key in self.staged:
+            del self.staged[key]
+        else:
+            del self.store[key]
+
+    def __contains__(self, key):
+        return (key in self.staged) or (key in self.store)
+
+    def __iter__(self):
+        for key in self.staged:
+            yield key
+        for key in self.store:
+            if key not in self.staged:
+                yield key
+
+    def __len__(self):
+        return len(set(self))
+
+    def listdir(self, path=''):
+        items = set(_zarr.storage.listdir(self.store, path))
+        prefix = path.rstrip('/') + '/' if path else ''
+        for key in self.staged:
+            if key.startswith(prefix):
+                items.add(key[len(prefix):].split('/')[0])
+        return sorted(items)
+
+    def commit(self):
+        """ write the staged metadata into the underlying store """
+        for key, value in self.staged.items():
+            self.store[key] = value
+        return None
+
+
+def journal_path(fstore):
+    """ path of the transaction journal of a store """
+    return f'{fstore}.journal.yml'
+
+
+def write_journal(fstore, journal):
+    """ write the journal atomically and durably """
+    jfile = journal_path(fstore)
+    with open(f'{jfile}.tmp', 'w') as fnew:
+        yaml.dump(journal, fnew, default_flow_style=False)
+        fnew.flush()
+        os.fsync(fnew.fileno())
+    os.replace(f'{jfile}.tmp', jfile)
+    return None
+
+
+def read_journal(fstore):
+    """ return the pending journal of the store, None if there is none """
+    jfile = journal_path(fstore)
+    if not os.path.exists(jfile):
+        return None
+    with open(jfile) as f:
+        journal = yaml.load(f, Loader=yaml.FullLoader)
+        f.close()
+    return journal
+
+
+def remove_journal(fstore):
+    """ end of transaction """
+    for jfile in [journal_path(fstore), f'{fstore}.journal.tail']:
+        if os.path.exists(jfile):
+            os.remove(jfile)
+    return None
+
+
+def remove_path(path):
+    """ remove a file or directory store if it exists """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+    return None
+
+
+def append_lengths(store, concat_dim='time'):
+    """ length along concat_dim and chunk size of each array of the store
+    that has concat_dim """
+    lengths = {}
+    for name in _zarr.storage.listdir(store):
+        if f'{name}/.zarray' not in store:
+            continue
+        zarray = json.loads(store[f'{name}/.zarray'])
+        zattrs = json.loads(store[f'{name}/.zattrs']) \
+            if f'{name}/.zattrs' in store else {}
+        dims = zattrs.get('_ARRAY_DIMENSIONS', [])
+        if concat_dim in dims:
+            axis = dims.index(concat_dim)
+            lengths[name] = {'axis': axis,
+                             'length': zarray['shape'][axis],
+                             'chunk': zarray['chunks'][axis]}
+    return lengths
+
+
+def append_to_store(ds, fstore, storetype, concat_dim='time',
+                    consolidated=True, fill=None):
+    """ append ds to an existing store as a transaction: the pre-append
+    state is recorded in a journal, new chunks are written first and the
+    metadata (shape) is only updated at commit
+
+    PARAMETERS:
+    ===========
+
+    ds: xarray.Dataset
+        data to append
+    fstore: str
+        full path of the store
+    storetype: str
+        zarr store type (directory, zip)
+    concat_dim: str
+        dimension along which to append
+    consolidated: bool
+        consolidate zarr metadata
+    fill: function
+        called with the (staged) store once ds is appended without
+        computing its dask arrays, writes them by regions before the
+        commit (see slabs.write_slabs)
+    """
+    compute = fill is None
+    base = None
+    try:
+        if storetype == 'directory':
+            base = _zarr.DirectoryStore(fstore)
+            lengths = append_lengths(base, concat_dim=concat_dim)
+            journal = {'operation': 'append', 'storetype': storetype,
+                       'state': 'staged', 'lengths': lengths}
+            write_journal(fstore, journal)
+            store = StagedMetadataStore(base)
+            ds.to_zarr(store, mode='a', append_dim=concat_dim,
+                       consolidated=consolidated, compute=compute)
+            if fill is not None:
+                fill(store)
+            # everything needed to roll forward
+            journal['state'] = 'committing'
+            journal['metadata'] = {key: value.decode('utf-8')
+                                   for key, value in store.staged.items()}
+            write_journal(fstore, journal)
+            store.commit()
+        elif storetype == 'zip':
+            # appending to a zip overwrites its central directory: keep a
+            # copy of the tail of the file to restore it
+            with zipfile.ZipFile(fstore) as zf:
+                start_dir = zf.start_dir
+            with open(fstore, 'rb') as f:
+                f.seek(start_dir)
+                tail = f.read()
+            with open(f'{fstore}.journal.tail', 'wb') as fnew:
+                fnew.write(tail)
+                fnew.flush()
+                os.fsync(fnew.fileno())
+            journal = {'operation': 'append', 'storetype': storetype,
+                       'state': 'staged', 'start_dir': start_dir}
+            write_journal(fstore, journal)
+            base = _zarr.ZipStore(fstore, mode='a')
+            store = StagedMetadataStore(base)
+            ds.to_zarr(store, mode='a', append_dim=concat_dim,
+                       consolidated=consolidated, compute=compute)
+            if fill is not None:
+                fill(store)
+            store.commit()
+            base.close()
+            journal['state'] = 'committed'
+            write_journal(fstore, journal)
+    except BaseException:
+        # undo now rather than at the next write
+        if storetype == 'zip' and base is not None:
+            base.close()
+        recover_store(fstore)
+        raise
+    remove_journal(fstore)
+    return None
+
+
+def replace_store(ds, fstore, storetype, consolidated=True, encoding=None,
+                  fill=None):
+    """ create (or overwrite) a store as a transaction: the new store is
+    written next to the old one and swapped in once complete
+
+    PARAMETERS:
+    ===========
+
+    ds: xarray.Dataset
+        data to write
+    fstore: str
+        full path of the store
+    storetype: str
+        zarr store type (directory, zip)
+    consolidated: bool
+        consolidate zarr metadata
+    encoding: dict
+        zarr encoding of the variables (e.g. compressor)
+    fill: function
+        called with the new store once ds is written without computing
+        its dask arrays, writes them by regions (see slabs.write_slabs)
+    """
+    fnew = f'{fstore}.new'
+    journal = {'operation': 'replace', 'storetype': storetype,
+               'state': 'writing'}
+    write_journal(fstore, journal)
+    remove_path(fnew)
+    try:
+        if storetype == 'directory':
+            store = _zarr.DirectoryStore(fnew)
+        elif storetype == 'zip':
+            store = _zarr.ZipStore(fnew, mode='w')
+        ds.to_zarr(store, mode='w', consolidated=consolidated,
+                   encoding=encoding, compute=fill is None)
+        if fill is not None:
+            fill(store)
+        if storetype == 'zip':
+            store.close()
+    except BaseException:
+        recover_store(fstore)
+        raise
+    journal['state'] = 'swapping'
+    write_journal(fstore, journal)
+    swap_in_store(fstore)
+    remove_journal(fstore)
+    return None
+
+
+def swap_in_store(fstore):
+    """ replace fstore by fstore.new, can be resumed at any step """
+    fnew = f'{fstore}.new'
+    fold = f'{fstore}.old'
+    if os.path.exists(fnew):
+        if os.path.exists(fstore):
+            remove_path(fold)
+            os.rename(fstore, fold)
+        os.rename(fnew, fstore)
+    remove_path(fold)
+    return None
+
+
+def recover_store(fstore, debug=False):
+    """ roll back or roll forward an interrupted transaction on fstore
+
+    RETURNS:
+    ========
+
+    action: str
+        'rollback', 'rollforward' or None if there was nothing to do
+    """
+    journal = read_journal(fstore)
+    if journal is None:
+        return None
+
+    action = None
+    if journal['operation'] == 'replace':
+        if journal['state'] == 'writing':
+            # new store incomplete, old one untouched
+            remove_path(f'{fstore}.new')
+            remove_path(f'{fstore}.staging')
+            action = 'rollback'
+        else:
+            swap_in_store(fstore)
+            action = 'rollforward'
+    elif journal['storetype'] == 'directory':
+        if journal['state'] == 'committing':
+            # all chunks are written, finish the metadata update
+            store = _zarr.DirectoryStore(fstore)
+            for key, value in journal['metadata'].items():
+                store[key] = value.encode('utf-8')
+            action = 'rollforward'
+        else:
+            # metadata not touched, only remove the orphan chunks
+            remove_orphan_chunks(fstore, journal['lengths'])
+            action = 'rollback'
+    elif journal['storetype'] == 'zip':
+        if journal['state'] == 'committed':
+            action = 'rollforward'
+        else:
+            # restore the file as it was before the append
+            with open(f'{fstore}.journal.tail', 'rb') as f:
+                tail = f.read()
+            with open(fstore, 'r+b') as f:
+                f.truncate(journal['start_dir'])
+                f.seek(journal['start_dir'])
+                f.write(tail)
+            action = 'rollback'
+    remove_journal(fstore)
+    if debug:
+        print(f'{action} of interrupted {journal["operation"]} on {fstore}')
+    return action
+
+
+def remove_orphan_chunks(fstore, lengths):
+    """ remove chunks written beyond the committed length of the arrays
+    (directory stores with '.' chunk separator) """
+    for name, info in lengths.items():
+        # first chunk index that holds no committed data
+        first_orphan = -(-info['length'] // info['chunk'])
+        arraydir = f'{fstore}/{name}'
+        for key in os.listdir(arraydir):
+            if key.startswith('.'):
+                continue
+            index = key.split('.')[info['axis']]
+            if index.isdigit() and int(index) >= first_orphan:
+                os.remove(f'{arraydir}/{key}')
+    return None
@@ -60,3 +60,32 @@ def update_yaml(storepath, varname, update_history, overwrite=False):
         yaml.dump(store_history, fnew, default_flow_style=False)
 
     return None
+
+
+def update_yaml_layout(storepath, varname, layout, description):
+    """ record an alternative layout (rechunked copy) of the store in its
+    history yaml
+
+    storepath: str
+        path for zarr store
+    varname: str
+        variable in zarr store
+    layout: str
+        name of the layout
+    description: dict
+        where the copy is and how it is chunked
+
+    """
+    ymlhistory = f'{storepath}/{varname}.yml'
+    store_history = {}
+    if os.path.exists(ymlhistory):
+        with open(ymlhistory) as f:
+            store_history = yaml.load(f, Loader=yaml.FullLoader)
+            f.close()
+    layouts = store_history.get('layouts', {})
+    layouts[layout] = description
+    store_history['layouts'] = layouts
+    with open(ymlhistory, 'w') as fnew:
+        yaml.dump(store_history, fnew, default_flow_style=False)
+
+    return None
@@ -2,8 +2,31 @@ import xarray as _xr
 import zarr as _zarr
 import subprocess
 from .site_specific import get_from_tape
+from .site_specific import wait_for_recall
+from .site_specific import is_recalled
 from .yaml_utils import update_yaml
+from .transactions import append_to_store
+from .transactions import replace_store
+from .transactions import recover_store
+from .zip_stores import rewrite_append_zip
+from .zip_stores import compact_zip_store
+from .encoding import variable_encoding
+from .profiling import stage
+from .profiling import profile_file
+from .profiling import memory_sampler
+from .profiling import untimed
+from .slabs import prepare_slabs
+from .slabs import slab_filler
+import numpy as _np
+import yaml
+import socket
+import getpass
+import itertools
+import json
+import datetime
 import os
+import fcntl
+from contextlib import contextmanager
 
 
 def create_zarr_store(ds, rootdir, ignore_vars=[],
@@ -149,138 +172,503 @@ def append_to_zarr_store(ds, rootdir, ignore_vars=[], concat_dim='time',
     return None
 
 
+# monthly/annual avg time interval can vary slightly because
+# of month length and leap days, hence need for tolerance
+time_rtol = 0.2
+
+
 def write_to_zarr_store(da, storepath, concat_dim='time',
                         storetype='directory', consolidated=True,
                         overwrite=False, site=None, debug=False,
-                        write_yaml=False, rebuild_dict={}):
-    """ create/append to a zarr store """
-    # by default, set write to true
-    write_store = True
+                        write_yaml=False, rebuild_dict={},
+                        zip_append='inplace', compressor=None, recall=None,
+                        history_backend='yaml', max_mem=None):
+    """ create/append to a zarr store. Zip stores are appended to in place
+    (zip_append='inplace') or rewritten without their superseded members
+    (zip_append='rewrite'). The compressor (see encoding.make_compressor)
+    is set when the store is created, appends keep the one of the store.
+    Zip stores part of a batched recall (see site_specific.recall_from_tape)
+    wait for it, the others are recalled alone. With write_yaml, the build
+    history yaml is updated here (history_backend='yaml'), the sqlite
+    catalog is updated by the caller. A variable larger than max_mem
+    bytes is written slab by slab (see slabs.write_slabs), in place for
+    zip stores, and its peak memory is reported. Returns True if data was
+    written """
+    # a store can be shared by files converted concurrently
+    with store_lock(storepath, da.name):
+        # by default, set write to true
+        write_store = True
+
+        # create temp dataset with new data
+        varname = da.name
+        ds = _xr.Dataset()
+        ds[varname] = da
+
+        # zarr store full name/path depends on type
+        if storetype == 'directory':
+            fstore = f'{storepath}/{varname}'
+        elif storetype == 'zip':
+            fstore = f'{storepath}/{varname}.zip'
 
-    # create temp dataset with new data
-    varname = da.name
-    ds = _xr.Dataset()
-    ds[varname] = da
+        # finish or undo a write interrupted by a crash
+        recover_store(fstore, debug=debug)
 
-    # zarr store full name/path depends on type
-    if storetype == 'directory':
-        fstore = f'{storepath}/{varname}'
-    elif storetype == 'zip':
-        fstore = f'{storepath}/{varname}.zip'
+        # check if file exists
+        store_exists = True if (os.path.exists(fstore)) else False
 
-    # check if file exists
-    store_exists = True if (os.path.exists(fstore)) else False
-
-    # check if an incomplete store exists
-    fstore_tmp = f'{fstore}_tmp'
-    tmp_store_exists = True if (os.path.exists(fstore_tmp)) else False
-    if tmp_store_exists:
-        print(f'ERROR: incomplete store exists for {fstore}')
-        print('you should consider rebuilding this store')
-        write_store = False
-        pass  # or raise exception?
-
-    # set zarr write/append mode
-    if store_exists and not overwrite:
-        zarrmode = 'a'
-        zarr_kwargs = {'mode': zarrmode, 'append_dim': concat_dim}
-        # edge case: if concat_dim not in dataarray, abort write
-        if concat_dim not in ds[varname].dims:
+        # check if an incomplete store exists, left by previous versions
+        # that renamed the store while writing
+        fstore_tmp = f'{fstore}_tmp'
+        tmp_store_exists = True if (os.path.exists(fstore_tmp)) else False
+        if tmp_store_exists:
+            print(f'ERROR: incomplete store exists for {fstore}')
+            print('you should consider rebuilding this store')
             write_store = False
-    else:
-        zarrmode = 'w'
-        zarr_kwargs = {'mode': zarrmode}
+            pass  # or raise exception?
+
+        # set zarr write/append mode
+        if store_exists and not overwrite:
+            zarrmode = 'a'
+            # edge case: if concat_dim not in dataarray, abort write
+            if concat_dim not in ds[varname].dims:
+                write_store = False
+        else:
+            zarrmode = 'w'
+
+        # the time manifest avoids opening (and recalling) the store
+        manifest = None
+        if store_exists and not overwrite:
+            manifest = read_time_manifest(storepath, varname, storetype)
+
+        # reload the store, if present
+        recalled = False
+        if storetype == 'zip' and store_exists and not overwrite \
+           and manifest is None:
+            with stage('get_from_tape', variable=varname):
+                check = fetch_store(storepath, varname, site=site,
+                                    debug=debug, recall=recall)
+            exit_code(check)
+            recalled = True
+
+        # check if append is the right thing to do
+        # would return updated value of write_store
+        if store_exists and not overwrite:
+            with stage('appending_needed', variable=varname,
+                       manifest=manifest is not None) as record:
+                start = append_start(storepath, varname, storetype,
+                                     ds[varname], concat_dim=concat_dim,
+                                     consolidated=consolidated,
+                                     manifest=manifest)
+                if start is not None:
+                    record['trimmed'] = start
+            if start is None:
+                write_store = False
+            else:
+                if manifest is None:
+                    # rebuilt from the store by append_start
+                    manifest = read_time_manifest(storepath, varname,
+                                                  storetype)
+                if start > 0:
+                    # only the records after the end of the store
+                    print(f'{varname}: {start} records already in '
+                          f'{fstore}, appending the last '
+                          f'{ds.sizes[concat_dim] - start}')
+                    ds = ds.isel({concat_dim: slice(start, None)})
+                    if ds[varname].chunks is not None:
+                        ds = ds.chunk({concat_dim: tail_chunks(
+                            ds.sizes[concat_dim], manifest, concat_dim)})
+
+        if write_store and storetype == 'zip' and store_exists \
+           and not overwrite and not recalled:
+            with stage('get_from_tape', variable=varname):
+                check = fetch_store(storepath, varname, site=site,
+                                    debug=debug, recall=recall)
+            exit_code(check)
+
+        # large variables are written a slab at a time
+        slabbed = write_store and max_mem is not None and \
+            concat_dim in ds[varname].dims and ds[varname].nbytes > max_mem
+        if slabbed:
+            ds = prepare_slabs(ds, varname, concat_dim=concat_dim)
+
+        if write_store:
+            # a zip store is measured by its growth (see written_size)
+            size_before = os.path.getsize(fstore) if profile_file() and \
+                storetype == 'zip' and zarrmode == 'a' else 0
+            # write as a transaction, that can be rolled back/forward
+            with stage('write_store', variable=varname,
+                       mode=zarrmode) as record, \
+                    memory_sampler(record, enabled=max_mem is not None):
+                fill = slab_filler(ds[varname], max_mem,
+                                   concat_dim=concat_dim,
+                                   consolidated=consolidated, debug=debug,
+                                   report=record) if slabbed else None
+                if zarrmode == 'a' and storetype == 'zip' and \
+                   zip_append == 'rewrite' and fill is None:
+                    rewrite_append_zip(ds, fstore, concat_dim=concat_dim,
+                                       consolidated=consolidated)
+                elif zarrmode == 'a':
+                    append_to_store(ds, fstore, storetype,
+                                    concat_dim=concat_dim,
+                                    consolidated=consolidated, fill=fill)
+                else:
+                    replace_store(ds, fstore, storetype,
+                                  consolidated=consolidated,
+                                  encoding=variable_encoding(varname,
+                                                             compressor),
+                                  fill=fill)
+                record['bytes_read'] = int(ds[varname].nbytes)
+                record['chunks'] = int(_np.prod([len(c) for c in
+                                                 ds[varname].chunks])) \
+                    if ds[varname].chunks is not None else 1
+                if profile_file():
+                    with untimed(record):
+                        record['bytes_written'] = written_size(
+                            fstore, varname, storetype, ds[varname].dims,
+                            ds.sizes.get(concat_dim, 0),
+                            concat_dim=concat_dim, size_before=size_before)
+            if max_mem is not None:
+                print(f'{varname}: peak RSS {record["rss_peak"] / 1e6:.1f} '
+                      f'MB, written in {record.get("slabs", 1)} slab(s)')
+            with stage('time_manifest', variable=varname):
+                update_time_manifest(storepath, varname, storetype,
+                                     ds[varname], concat_dim=concat_dim,
+                                     previous=manifest if zarrmode == 'a'
+                                     else None)
+            if write_yaml and history_backend == 'yaml':
+                with stage('update_yaml', variable=varname):
+                    update_yaml(storepath, varname, rebuild_dict,
+                                overwrite=overwrite)
+        ds.close()
+
+    return write_store
+
+
+@contextmanager
+def store_lock(storepath, varname):
+    """ hold an exclusive lock on the store of varname """
+    os.makedirs(storepath, exist_ok=True)
+    with open(f'{storepath}/{varname}.lock', 'w') as lockfile:
+        with stage('lock_wait', variable=varname):
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def fetch_store(storepath, varname, site=None, debug=False, recall=None):
+    """ bring the zip store of varname back from tape: wait for the
+    batched recall if it covers the store, else (or if the batched recall
+    failed) recall the store alone """
+    if is_recalled(recall, store_name(storepath, varname, 'zip')):
+        if debug:
+            print(f'waiting for the recall of {varname}.zip')
+        if wait_for_recall(recall) == 0:
+            return 0
+        print(f'batched recall failed, recalling {varname}.zip alone')
+    return get_from_tape(f'{storepath}', f'{varname}.zip', site=site,
+                         debug=debug)
+
+
+def compact_store(storepath, varname, site=None, debug=False):
+    """ compact the zip store of varname (see zip_stores.compact_zip_store)
+    keeping its time manifest valid
+
+    RETURNS:
+    ========
 
-    # reload the store, if present
-    if storetype == 'zip' and store_exists and not overwrite:
+    report: dict
+    """
+    with store_lock(storepath, varname):
+        fstore = store_name(storepath, varname, 'zip')
+        recover_store(fstore, debug=debug)
         check = get_from_tape(f'{storepath}', f'{varname}.zip',
                               site=site, debug=debug)
         exit_code(check)
+        manifest = read_time_manifest(storepath, varname, 'zip')
+        report = compact_zip_store(fstore)
+        # same content, only the signature of the store changed
+        if manifest is not None:
+            manifest['signature'] = store_signature(storepath, varname, 'zip')
+            save_time_manifest(storepath, varname, manifest)
+    if debug:
+        print(f'{fstore}: {report["bytes_reclaimed"]} bytes reclaimed, '
+              f'{report["members_dropped"]} members dropped')
+    return report
 
-    # check if append is the right thing to do
-    # would return updated value of write_store
-    if store_exists and not overwrite:
-        ok_to_append = appending_needed(storepath, varname,
-                                        storetype, ds[varname],
-                                        concat_dim=concat_dim,
-                                        consolidated=consolidated)
-        if not ok_to_append:
-            write_store = False
 
-    if write_store:
-        # rename into temp store
-        if store_exists:
-            check = subprocess.check_call(f'mv {fstore} {fstore_tmp}',
-                                          shell=True)
-            exit_code(check)
-        # open the temp store
-        if storetype == 'directory':
-            store = _zarr.DirectoryStore(fstore_tmp)
-        elif storetype == 'zip':
-            store = _zarr.ZipStore(fstore_tmp, mode=zarrmode)
-        # write to store
-        ds.to_zarr(store, consolidated=consolidated, **zarr_kwargs)
-        # and close store
-        if storetype == 'zip':
-            store.close()
-        # assuming all went ok at this point, revert to original name
-        check = subprocess.check_call(f'mv {fstore_tmp} {fstore}', shell=True)
-        exit_code(check)
-        if write_yaml:
-            update_yaml(storepath, varname, rebuild_dict, overwrite=overwrite)
-    ds.close()
+def appending_needed(storepath, variable, storetype, new_data,
+                     concat_dim='time', consolidated=True, manifest=None):
+    """ check if new data needs to be added to a zarr store, i.e. if some
+    of its records come after the store and continue its time axis
+    (see append_start) """
+    start = append_start(storepath, variable, storetype, new_data,
+                         concat_dim=concat_dim, consolidated=consolidated,
+                         manifest=manifest)
+    return start is not None
+
+
+def append_start(storepath, variable, storetype, new_data,
+                 concat_dim='time', consolidated=True, manifest=None):
+    """ index of the first record of new_data to append to a zarr store.
+    Records up to the last time of the store are already there (e.g. a
+    rerun segment overlapping the store) and are trimmed, the first record
+    kept must continue the time axis. The decision is taken from the time
+    manifest of the store when it is up to date, otherwise the store is
+    opened (and the manifest rebuilt)
 
-    return None
+    PARAMETERS:
+    ===========
 
+    storepath: str
+        path of the store
+    variable: str
+        name of the variable
+    storetype: str
+        'directory' or 'zip'
+    new_data: xarray.DataArray
+        data to append
+    concat_dim: str
+        time dimension
+    consolidated: bool
+        consolidated metadata
+    manifest: dict
+        time manifest of the store, read if not provided
 
-def appending_needed(storepath, variable, storetype, new_data,
-                     concat_dim='time', consolidated=True):
-    """ open a zarr store and check if new data needs
-    to be added """
-    # open current store
+    RETURNS:
+    ========
+
+    start: int
+        index along concat_dim of the first record to append, None if
+        there is nothing to append (no new record, gap in the time axis,
+        variable without time)
+    """
+    if manifest is None:
+        manifest = read_time_manifest(storepath, variable, storetype)
+    if manifest is None:
+        manifest = time_manifest_from_store(storepath, variable, storetype,
+                                            concat_dim=concat_dim,
+                                            consolidated=consolidated)
+        save_time_manifest(storepath, variable, manifest)
+
+    if manifest['nt'] is None:
+        return None
+
+    new_times = new_data[concat_dim].values
+    # searchsorted needs the new time axis in order
+    if len(new_times) == 0 or _np.any(_np.diff(new_times) <= 0):
+        return None
+
+    # test posteriority: first record after the end of the store
+    last_current_frame = manifest['last']
+    start = int(_np.searchsorted(new_times, last_current_frame,
+                                 side='right'))
+    if start == len(new_times):
+        return None
+    new_frame = new_times[start]
+
+    # test for gaps in time axis
+    if manifest['nt'] >= 2:
+        prev_current_frame = manifest['penultimate']
+        dt_old = last_current_frame - prev_current_frame
+        dt_new = new_frame - last_current_frame
+        dt_min = dt_old * (1 - time_rtol)
+        dt_max = dt_old * (1 + time_rtol)
+        if not (dt_min < dt_new < dt_max):
+            return None
+    return start
+
+
+def tail_chunks(ntail, manifest, concat_dim='time'):
+    """ chunks along concat_dim of ntail records appended to the store
+    of manifest: the first one completes the last chunk of the store, so
+    that no store chunk is written by two dask chunks """
+    zchunk = manifest['chunks'][manifest['dims'].index(concat_dim)]
+    first = min(zchunk - manifest['nt'] % zchunk, ntail)
+    chunks = [first] + [zchunk] * ((ntail - first) // zchunk)
+    if sum(chunks) < ntail:
+        chunks.append(ntail - sum(chunks))
+    return tuple(chunks)
+
+
+def written_size(fstore, varname, storetype, dims, nrecords,
+                 concat_dim='time', size_before=0):
+    """ bytes written to the store by a write of nrecords records of
+    varname (with dimensions dims): the growth of a zip store (of
+    size_before bytes before the write), or the size of the chunks of a
+    directory store from the first chunk touched by the write. Only the
+    chunks of the write are looked at, not the whole store. """
+    if storetype == 'zip':
+        return os.path.getsize(fstore) - size_before
+    vardir = f'{fstore}/{varname}'
+    with open(f'{vardir}/.zarray') as f:
+        zarray = json.load(f)
+    shape, chunks = zarray['shape'], zarray['chunks']
+    if len(shape) == 0:
+        return os.path.getsize(f'{vardir}/0')
+    separator = zarray.get('dimension_separator') or '.'
+    ranges = []
+    for dim, n, chunk in zip(dims, shape, chunks):
+        first = (n - nrecords) // chunk if dim == concat_dim else 0
+        ranges.append(range(first, -(-n // chunk)))
+    size = 0
+    for index in itertools.product(*ranges):
+        key = f'{vardir}/' + separator.join(str(i) for i in index)
+        # chunks of fill values only are not written
+        if os.path.exists(key):
+            size += os.path.getsize(key)
+    return size
+
+
+def store_name(storepath, varname, storetype):
+    """ full path of the zarr store, depends on type """
     if storetype == 'directory':
-        fstore = f'{storepath}/{variable}'
+        fstore = f'{storepath}/{varname}'
     elif storetype == 'zip':
-        fstore = f'{storepath}/{variable}.zip'
+        fstore = f'{storepath}/{varname}.zip'
+    return fstore
 
+
+def store_signature(storepath, varname, storetype):
+    """ size and modification time of the part of the store that changes
+    on every write: the zip file or the metadata of the variable array """
+    fstore = store_name(storepath, varname, storetype)
+    if storetype == 'directory':
+        fstore = f'{fstore}/{varname}/.zarray'
+    if not os.path.exists(fstore):
+        return None
+    stat = os.stat(fstore)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def time_manifest_path(storepath, varname):
+    """ path of the time manifest, next to the store """
+    return f'{storepath}/{varname}.manifest.yml'
+
+
+def read_time_manifest(storepath, varname, storetype):
+    """ return the time manifest of the store, None if it is missing or
+    stale (store modified after the manifest was written) """
+    manifest_file = time_manifest_path(storepath, varname)
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file) as f:
+        manifest = yaml.load(f, Loader=yaml.FullLoader)
+        f.close()
+    if manifest is None or manifest.get('signature') != \
+       store_signature(storepath, varname, storetype):
+        return None
+    return manifest
+
+
+def store_chunks(storepath, varname, storetype, site=None, debug=False,
+                 recall=None):
+    """ chunks of varname in its existing store, by dimension: from the
+    time manifest, else from the metadata of the array (a zip store is
+    then brought back from tape first, see fetch_store). None if there is
+    no store yet. """
+    fstore = store_name(storepath, varname, storetype)
+    if not os.path.exists(fstore):
+        return None
+    manifest = read_time_manifest(storepath, varname, storetype)
+    if manifest is not None:
+        return dict(zip(manifest['dims'], manifest['chunks']))
+    if storetype == 'zip':
+        exit_code(fetch_store(storepath, varname, site=site, debug=debug,
+                              recall=recall))
+        store = _zarr.ZipStore(fstore, mode='r')
+    else:
+        store = _zarr.DirectoryStore(fstore)
     try:
-        current = _xr.open_zarr(f'{fstore}', decode_times=False,
-                                consolidated=consolidated)
-    except:
-        raise IOError(f'{fstore} is not readable, file must be damaged. \
-                       Rebuild store needeed')
+        array = _zarr.open_group(store, mode='r')[varname]
+        chunks = dict(zip(array.attrs['_ARRAY_DIMENSIONS'], array.chunks))
+    finally:
+        store.close()
+    return chunks
 
 
+def time_manifest_from_store(storepath, varname, storetype,
+                             concat_dim='time', consolidated=True):
+    """ build the time manifest by opening the store (slow path) """
+    fstore = store_name(storepath, varname, storetype)
+    try:
+        current = _xr.open_zarr(f'{fstore}', decode_times=False,
+                                consolidated=consolidated)
+    except Exception:
+        raise IOError(f'{fstore} is not readable, file must be damaged. '
+                      'Rebuild store needeed')
     if concat_dim in current.dims:
+        times = current[concat_dim].values
+    else:
+        times = None
+    manifest = time_manifest(current[varname], times, storepath, varname,
+                             storetype)
+    current.close()
+    return manifest
+
+
+def update_time_manifest(storepath, varname, storetype, da,
+                         concat_dim='time', previous=None):
+    """ time manifest of the store after da was written (previous=None)
+    or appended (previous = manifest before the append) """
+    if concat_dim in da.dims:
+        times = da[concat_dim].values
+    else:
+        times = None
+    if previous is not None and times is not None:
+        # only the tail of the existing axis is needed
+        tail = [previous['penultimate'], previous['last']]
+        tail = [t for t in tail if t is not None]
+        times = _np.concatenate([_np.array(tail, dtype=times.dtype), times])
+        nt = previous['nt'] + len(da[concat_dim])
+    else:
+        nt = None if times is None else len(times)
+    manifest = time_manifest(da, times, storepath, varname, storetype,
+                             nt=nt, previous=previous)
+    save_time_manifest(storepath, varname, manifest)
+    return manifest
+
+
+def time_manifest(da, times, storepath, varname, storetype, nt=None,
+                  previous=None):
+    """ the time manifest: length, first/penultimate/last values of the
+    time axis, dtype and chunks of the variable and last writer """
+    def scalar(value):
+        return value.item() if hasattr(value, 'item') else value
+
+    if times is not None and len(times) > 0:
+        first = scalar(times[0]) if previous is None else previous['first']
+        last = scalar(times[-1])
+        penultimate = scalar(times[-2]) if len(times) >= 2 else None
+        nt = len(times) if nt is None else nt
+    else:
+        first, last, penultimate, nt = None, None, None, None
 
-        nt = len(current[concat_dim].values)
-        test_gap = True if (nt >=2) else False
-
-        last_current_frame = current[concat_dim].values[-1]
-        if test_gap:
-            prev_current_frame = current[concat_dim].values[-2]
-        new_frame = new_data[concat_dim].values[0]
-        current.close()
-
-        # test posteriority
-        posterior_ok = True if (new_frame > last_current_frame) else False
-        # test for gaps in time axis
-        if test_gap:
-            dt_old = last_current_frame - prev_current_frame
-            dt_new = new_frame - last_current_frame
-            # monthly/annual avg time interval can vary slightly because
-            # of month length and leap days, hence need for tolerance
-            rtol = 0.2
-            dt_min = dt_old * (1 - rtol)
-            dt_max = dt_old * (1 + rtol)
-            continuity_ok = True if (dt_min < dt_new < dt_max) else False
-        else:
-            continuity_ok = True  # only one segment
-        # final decision
-        append = True if (posterior_ok and continuity_ok) else False
+    if previous is not None:
+        chunks = previous['chunks']
+    elif da.chunks is not None:
+        chunks = [int(c[0]) for c in da.chunks]
     else:
-        append = False
-    return append
+        chunks = list(da.shape)
+
+    manifest = {'nt': nt, 'first': first, 'last': last,
+                'penultimate': penultimate, 'dtype': str(da.dtype),
+                'dims': list(da.dims), 'chunks': chunks,
+                'writer': {'host': socket.gethostname(),
+                           'user': getpass.getuser(), 'pid': os.getpid(),
+                           'date': datetime.datetime.now().isoformat()},
+                'signature': store_signature(storepath, varname, storetype)}
+    return manifest
+
+
+def save_time_manifest(storepath, varname, manifest):
+    """ write the manifest atomically """
+    manifest_file = time_manifest_path(storepath, varname)
+    with open(f'{manifest_file}.tmp', 'w') as fnew:
+        yaml.dump(manifest, fnew, default_flow_style=False)
+    os.replace(f'{manifest_file}.tmp', manifest_file)
+    return None
 
 
 def exit_code(return_code):
@@ -0,0 +1,194 @@
+import zarr as _zarr
+import zipfile
+import shutil
+import time
+import os
+from .transactions import write_journal
+from .transactions import remove_journal
+from .transactions import remove_path
+from .transactions import swap_in_store
+from .transactions import recover_store
+
+
+class CopyOnWriteStore(_zarr.storage.Store):
+    """ overlay on a read-only zarr store: reads fall through to the
+    source unless the key was written, all writes go to the upper store """
+
+    def __init__(self, source, upper):
+        self.source = source
+        self.upper = upper
+
+    def __getitem__(self, key):
+        if key in self.upper:
+            return self.upper[key]
+        return self.source[key]
+
+    def __setitem__(self, key, value):
+        self.upper[key] = value
+
+    def __delitem__(self, key):
+        del self.upper[key]
+
+    def __contains__(self, key):
+        return (key in self.upper) or (key in self.source)
+
+    def __iter__(self):
+        for key in self.upper:
+            yield key
+        for key in self.source:
+            if key not in self.upper:
+                yield key
+
+    def __len__(self):
+        return len(set(self))
+
+    def listdir(self, path=''):
+        items = set(_zarr.storage.listdir(self.source, path))
+        items.update(_zarr.storage.listdir(self.upper, path))
+        return sorted(items)
+
+
+def zip_entries(zf):
+    """ latest entry of each member name, in order of first appearance.
+    Zip stores appended to in place hold several copies of the metadata """
+    entries = {}
+    for info in zf.infolist():
+        entries[info.filename] = info
+    return entries
+
+
+def write_compacted_zip(source, destination, overrides=None):
+    """ stream the unique entries of the zip source, followed by the keys
+    of the zarr store overrides (that replace the source entries of the
+    same name), into a fresh zip destination in one sequential pass """
+    if overrides is None:
+        overrides = {}
+    new_keys = list(overrides.keys())
+    with zipfile.ZipFile(source) as zin, \
+            zipfile.ZipFile(destination, mode='w',
+                            compression=zipfile.ZIP_STORED,
+                            allowZip64=True) as zout:
+        for name, info in zip_entries(zin).items():
+            if name in overrides:
+                continue
+            entry = zipfile.ZipInfo(filename=name, date_time=info.date_time)
+            entry.compress_type = info.compress_type
+            entry.external_attr = info.external_attr
+            with zin.open(info) as fsrc, \
+                    zout.open(entry, mode='w', force_zip64=True) as fdst:
+                shutil.copyfileobj(fsrc, fdst, 16 * 1024 * 1024)
+        for name in new_keys:
+            # same entry attributes as zarr.ZipStore
+            entry = zipfile.ZipInfo(filename=name,
+                                    date_time=time.localtime(time.time())[:6])
+            entry.compress_type = zipfile.ZIP_STORED
+            entry.external_attr = 0o644 << 16
+            zout.writestr(entry, overrides[name])
+    return None
+
+
+def rewrite_append_zip(ds, fstore, concat_dim='time', consolidated=True):
+    """ append ds to the zip store fstore by writing a fresh, deduplicated
+    zip: new chunks and metadata are staged in a directory store next to
+    the zip, then merged with the existing members into fstore.new which
+    is swapped in (a transaction, see transactions.replace_store)
+
+    PARAMETERS:
+    ===========
+
+    ds: xarray.Dataset
+        data to append
+    fstore: str
+        full path of the zip store
+    concat_dim: str
+        dimension along which to append
+    consolidated: bool
+        consolidate zarr metadata
+    """
+    staging = f'{fstore}.staging'
+    fnew = f'{fstore}.new'
+    journal = {'operation': 'replace', 'storetype': 'zip',
+               'state': 'writing'}
+    write_journal(fstore, journal)
+    try:
+        remove_path(staging)
+        remove_path(fnew)
+        source = _zarr.ZipStore(fstore, mode='r')
+        upper = _zarr.DirectoryStore(staging)
+        ds.to_zarr(CopyOnWriteStore(source, upper), mode='a',
+                   append_dim=concat_dim, consolidated=consolidated)
+        source.close()
+        write_compacted_zip(fstore, fnew, overrides=upper)
+    except BaseException:
+        recover_store(fstore)
+        remove_path(staging)
+        raise
+    journal['state'] = 'swapping'
+    write_journal(fstore, journal)
+    swap_in_store(fstore)
+    remove_journal(fstore)
+    remove_path(staging)
+    return None
+
+
+def time_store_open(fstore):
+    """ seconds needed to open a zip store and read its metadata """
+    start = time.perf_counter()
+    store = _zarr.ZipStore(fstore, mode='r')
+    if '.zmetadata' in store:
+        group = _zarr.open_consolidated(store, mode='r')
+    else:
+        group = _zarr.open_group(store, mode='r')
+    for name in group.array_keys():
+        group[name].shape
+    store.close()
+    return time.perf_counter() - start
+
+
+def compact_zip_store(fstore):
+    """ rewrite a zip store without its duplicated members (and their
+    stale central directory entries)
+
+    PARAMETERS:
+    ===========
+
+    fstore: str
+        full path of the zip store
+
+    RETURNS:
+    ========
+
+    report: dict
+        store, bytes before/after and reclaimed, number of members
+        dropped, open time before/after (seconds)
+    """
+    recover_store(fstore)
+    bytes_before = os.path.getsize(fstore)
+    open_before = time_store_open(fstore)
+    with zipfile.ZipFile(fstore) as zf:
+        nmembers = len(zf.infolist())
+        nunique = len(zip_entries(zf))
+
+    fnew = f'{fstore}.new'
+    journal = {'operation': 'replace', 'storetype': 'zip',
+               'state': 'writing'}
+    write_journal(fstore, journal)
+    try:
+        write_compacted_zip(fstore, fnew)
+    except BaseException:
+        recover_store(fstore)
+        raise
+    journal['state'] = 'swapping'
+    write_journal(fstore, journal)
+    swap_in_store(fstore)
+    remove_journal(fstore)
+
+    bytes_after = os.path.getsize(fstore)
+    report = {'store': fstore,
+              'bytes_before': bytes_before,
+              'bytes_after': bytes_after,
+              'bytes_reclaimed': bytes_before - bytes_after,
+              'members_dropped': nmembers - nunique,
+              'open_time_before': open_before,
+              'open_time_after': time_store_open(fstore)}
+    return report
@@ -12,5 +12,14 @@ setuptools.setup(
     url="https://github.com/raphaeldussin/history2CMIParchive",
     packages=['history2CMIParchive'],
     scripts=['history2CMIParchive/exe/history_nc_to_zarr.py',
-             'history2CMIParchive/exe/history_tar_to_zarr.py']
+             'history2CMIParchive/exe/history_tar_to_zarr.py',
+             'history2CMIParchive/exe/zarr_zip_compact.py',
+             'history2CMIParchive/exe/zarr_rechunk.py',
+             'history2CMIParchive/exe/zarr_codec_benchmark.py',
+             'history2CMIParchive/exe/history_synthetic_convert.py',
+             'history2CMIParchive/exe/history_profile_summary.py',
+             'history2CMIParchive/exe/history_years_to_zarr.py',
+             'history2CMIParchive/exe/history_catalog_to_yaml.py',
+             'history2CMIParchive/exe/zarr_inventory.py',
+             'history2CMIParchive/exe/history_sync_to_zarr.py']
 )